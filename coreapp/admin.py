@@ -7,5 +7,17 @@ admin.site.register(Restaurant)
 admin.site.register(Meal)
 admin.site.register(Customer)
 admin.site.register(Driver)
-admin.site.register(Order)
+
+class OrderAdmin(admin.ModelAdmin):
+    # An order is delivered by coreapp.orders.deliver_order() only, which
+    # also adds it to the report rollups, so the admin never sets DELIVERED
+    def get_readonly_fields(self, request, obj=None):
+        return ["status"] if obj else []
+
+    def formfield_for_choice_field(self, db_field, request, **kwargs):
+        if db_field.name == "status":
+            kwargs["choices"] = [choice for choice in Order.STATUS_CHOICES if choice[0] != Order.DELIVERED]
+        return super().formfield_for_choice_field(db_field, request, **kwargs)
+
+admin.site.register(Order, OrderAdmin)
 admin.site.register(OrderDetails)
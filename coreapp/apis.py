@@ -1,14 +1,23 @@
 import json
-from django.http import JsonResponse
-from coreapp.models import Restaurant, Meal, Order, OrderDetails
-from coreapp.serializers import RestaurantSerializer, MealSerializer, OrderSerializer, OrderStatusSerializer, OrderDriverSerializer
-from django.utils import timezone
-from oauth2_provider.models import AccessToken
+import hashlib
+from django.http import JsonResponse, HttpResponse
+from coreapp.models import Restaurant, Order, Driver
+from coreapp.geo import location_coordinates, get_radius, nearby_ready_orders, sort_nearby
+from coreapp.locations import save_location, current_location
+from coreapp.trajectories import parse_points, store_points, load_trajectory, downsample, get_max_points, \
+    visible_order, trajectory_json, point_time, TrajectoryError
+from coreapp.menus import get_menu_snapshot
+from coreapp.metrics import serialization_timer
+from coreapp.orders import place_order, claim_order, deliver_order, OrderError
+from coreapp.pagination import keyset_paginate, get_page_size, InvalidCursor
+from coreapp.payments import create_checkout_intent, PaymentError
+from coreapp.pubsub import hub, driver_channel
+from coreapp.reports import get_timezone, get_date_range, is_current_week, daily_totals, InvalidRange
+from coreapp.serializers import RestaurantSerializer, OrderSerializer, OrderStatusSerializer, OrderDriverSerializer, eager_load
+from coreapp.tokens import token_required
 from django.views.decorators.csrf import csrf_exempt
-import stripe
-from foodtasker.settings import STRIPE_API_KEY
-
-stripe.api_key = STRIPE_API_KEY
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 
 # Function based views
 
@@ -16,26 +25,65 @@ stripe.api_key = STRIPE_API_KEY
 # CUSTOMER
 # =========
 
+# The ETag of the restaurant list is built from the version stamps of
+# coreapp.models.Restaurant, without serializing anything. The page is loaded
+# once, a matching If-None-Match gets a 304 before anything is serialized.
+
+def restaurants_page_etag(request, page, next_cursor):
+    # The image urls are absolute, so the host is part of the response too
+    stamp = "%s|%s|%s" % (
+        request.build_absolute_uri("/"),
+        ",".join("%s:%s" % (restaurant.id, restaurant.version) for restaurant in page),
+        next_cursor
+    )
+    return hashlib.sha1(stamp.encode()).hexdigest()
+
 def customer_get_restaurants(request):
-    restaurants = RestaurantSerializer(
-        Restaurant.objects.all().order_by("-id"), 
-        many=True,
-        context={"request":request}
-        ).data
-    # At this point we've translated the model instance into Python native datatypes. 
-    # To finalise the serialization process we render the data into json.
-    # JSON is a set of rules defining how to represent data in text/string form
-    return JsonResponse({"restaurants":restaurants})
+    """
+      params:
+        1. cursor (optional) ---> "next" of the previous page
+        2. page_size (optional)
+      return:
+        {"restaurants": [...], "next": cursor or null}
+    """
+    try:
+        page, next_cursor = keyset_paginate(request, Restaurant.objects.all())
+    except InvalidCursor as e:
+        return JsonResponse({"status":"failed", "error":str(e)}, status=400)
+
+    # get_conditional_response() returns a 304 response if the client's copy is up to date
+    etag = quote_etag(restaurants_page_etag(request, page, next_cursor))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        with serialization_timer():
+            restaurants = RestaurantSerializer(
+                page, 
+                many=True,
+                context={"request":request}
+                ).data
+        # At this point we've translated the model instance into Python native datatypes. 
+        # To finalise the serialization process we render the data into json.
+        # JSON is a set of rules defining how to represent data in text/string form
+        response = JsonResponse({"restaurants":restaurants, "next":next_cursor})
+    response["ETag"] = etag
+    return response
 
 def customer_get_meals(request, restaurant_id):
-    meals = MealSerializer(
-        Meal.objects.filter(restaurant_id = restaurant_id).order_by("-id"),
-        many=True,
-        context={"request":request}
-    ).data
-    return JsonResponse({"meals":meals})
+    # The menu is served from its pre-rendered snapshot (see coreapp.menus)
+    snapshot = get_menu_snapshot(request, restaurant_id)
+    if snapshot is None:
+        return JsonResponse({"meals":[]})
+
+    etag, body = snapshot
+    # get_conditional_response() returns a 304 response if the client's copy is up to date
+    response = get_conditional_response(request, etag=quote_etag(etag))
+    if response is None:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = quote_etag(etag)
+    return response
 
 @csrf_exempt
+@token_required("customer")
 def customer_add_order(request):
     """
       params:
@@ -47,62 +95,31 @@ def customer_add_order(request):
       returns:
         {"status": "success"}
     """
-    # EXPIRES_IN -->  The lifetime in seconds of the access token.
-    # Get access token
-    access_token = AccessToken.objects.get(
-        token=request.POST.get("access_token"),
-       # __gt -> Greater than(Django ORM)
-       # This is the constraint for expiry
-        expires__gt = timezone.now()
-        )
-
-    # Get customer profile
-    customer = access_token.user.customer
-
-    # Check whether customer has any outstanding order
-    if Order.objects.filter(customer=customer).exclude(status=Order.DELIVERED):
-        return JsonResponse({"status":"failed", "error":"Your last order must be completed."})
-
-    # Check order's address
-    if not request.POST["address"]:
-        return JsonResponse({"status":"failed", "error":"Address is required."})
-
-    # Get order details
+    # The access token is checked by @token_required,
+    # which also gives us the customer profile id.
 
     # The json.loads() method can be used to parse a valid JSON string and 
     # convert it into a Python Dictionary
-    order_details = json.loads(request.POST["order_details"])
-
-    # Check if meals in only one restaurant and then calculate order total
-    order_total = 0
-    for meal in order_details:
-        if not Meal.objects.filter(id=meal["meal_id"], restaurant_id =request.POST["restaurant_id"]):
-            return JsonResponse({"status":"failed", "error": "Meals must be in only one restaurant"})
-        else:
-            order_total += Meal.objects.get(id=meal["meal_id"]).price * meal["quantity"]
-
-    # CREATE ORDER
-    if len(order_details)>0:
-        # Step 1 - Create an Order
-        order = Order.objects.create(
-            customer = customer,
-            restaurant_id = request.POST["restaurant_id"],
-            total = order_total,
-            status = Order.COOKING,
-            address = request.POST["address"]
+    try:
+        order_details = json.loads(request.POST.get("order_details", "[]"))
+    except ValueError:
+        return JsonResponse({"status":"failed", "error":"Order details are invalid."})
+
+    # Validate, price and create the order
+    try:
+        place_order(
+            customer_id = request.customer_id,
+            restaurant_id = request.POST.get("restaurant_id"),
+            address = request.POST.get("address"),
+            order_details = order_details
         )
-        # Step 2 - Create Order Details
-        for meal in order_details:
-            OrderDetails.objects.create(
-                order = order,
-                meal_id = meal["meal_id"],
-                quantity = meal["quantity"],
-                sub_total = Meal.objects.get(id=meal["meal_id"]).price * meal["quantity"]
-            )
+    except OrderError as e:
+        return JsonResponse({"status":"failed", "error":str(e)})
 
-        return JsonResponse({"status": "success"})
+    return JsonResponse({"status": "success"})
 
 @csrf_exempt
+@token_required("customer")
 def customer_get_latest_order(request):
     """
       params:
@@ -110,18 +127,14 @@ def customer_get_latest_order(request):
       return:
         {JSON data with all details of an order}
     """
-    access_token = AccessToken.objects.get(
-        token=request.GET.get("access_token"),
-        expires__gt =timezone.now()
-    )
-    customer = access_token.user.customer
-    order = OrderSerializer(
-        Order.objects.filter(customer=customer).last()
-    ).data
+    order = eager_load(Order.objects.filter(customer_id=request.customer_id), OrderSerializer).last()
+    with serialization_timer():
+        order = OrderSerializer(order).data
 
     return JsonResponse({"last_order": order})
 
 
+@token_required("customer")
 def customer_get_latest_order_status(request):
     """
       params:
@@ -129,75 +142,75 @@ def customer_get_latest_order_status(request):
       return:
         {JSON data with all details of an order}
     """
-    access_token = AccessToken.objects.get(
-        token=request.GET.get("access_token"),
-        expires__gt =timezone.now()
-    )
-    customer = access_token.user.customer
-    order_status = OrderStatusSerializer(
-        Order.objects.filter(customer=customer).last()
-    ).data
+    order = Order.objects.filter(customer_id=request.customer_id).last()
+    with serialization_timer():
+        order_status = OrderStatusSerializer(order).data
 
     return JsonResponse({"last_order_status": order_status})
 
 
+@token_required("customer")
 def customer_get_driver_location(request):
-    access_token = AccessToken.objects.get(
-        token=request.GET.get("access_token"),
-        expires__gt =timezone.now()
-    )
-
-    customer = access_token.user.customer
-    current_order = Order.objects.filter(customer=customer, status=Order.ONTHEWAY).last()
+    # Read the driver's location together with the order
+    current_order = Order.objects.filter(
+        customer_id=request.customer_id,
+        status=Order.ONTHEWAY
+    ).select_related("driver").last()
     if current_order:
-        location = current_order.driver.location
+        # The latest position received by this process, see coreapp.locations
+        location = current_location(current_order.driver)
     else:
         location = None
 
     return JsonResponse({"location": location})
 
 @csrf_exempt
+@token_required()
 def create_payment_intent(request):
     """
      params:
        1. access_token
        2. total
+       3. order_details (optional, json format) ---> the cart being paid for
      return:
       {"client_secret": client_secret}
     """
+    if request.method != "POST":
+        return JsonResponse({"status":"failed", "error":"Failed to create Payment Intent"})
 
-    # Get access_token
-    access_token = AccessToken.objects.get(
-        token=request.POST.get("access_token"),
-        expires__gt =timezone.now()
-    )
+    try:
+        cart = json.loads(request.POST.get("order_details", "null"))
+    except ValueError:
+        return JsonResponse({"status":"failed", "error":"Order details are invalid."})
 
-    # Get the orders total amount
-    total = request.POST["total"]
+    # Create a Payment Intent. this will create a client secret and return it to Mobile App.
+    # A retried request for the same cart returns the same intent (see coreapp.payments).
+    try:
+        intent = create_checkout_intent(request.identity, request.POST.get("total"), cart)
+    except PaymentError as e:
+        return JsonResponse({"status":"failed", "error":str(e)})
 
-    if request.method == "POST":
-        if access_token:
-            # Create a Payment Intent. this will create a client secret and return it to Mobile App.
-            try:
-                intent = stripe.PaymentIntent.create(
-                    amount = int(total) * 100, # Amount in cents
-                    currency = 'usd',
-                    description = "FoodTasker Order"
-                )
-                print(intent)
-                if intent:
-                    client_secret = intent.client_secret
-                    print(client_secret)
-                    return JsonResponse({"client_secret": client_secret})
-
-            except stripe.error.StripeError as e:
-                return JsonResponse({"status":"failed", "error":str(e)})
-            # Exception as e ---> we can access attributes of exception object eg..e.message, e.args
-            except Exception as e:
-                print(str(e))
-                return JsonResponse({"status":"failed", "error":str(e)})
+    return JsonResponse({"client_secret": intent.client_secret})
 
-        return JsonResponse({"status":"failed", "error":"Failed to create Payment Intent"})
+@token_required()
+def get_order_trajectory(request, order_id):
+    """
+    The route of a delivery, for its customer and its driver.
+      params:
+        1. access_token
+        2. max_points (optional) ---> TRAJECTORY_MAX_POINTS at most
+      return:
+        {"order_id": 1, "points": [[timestamp, lat, long], ...], "total": number of points stored}
+    """
+    if visible_order(order_id, request.customer_id, request.driver_id) is None:
+        return JsonResponse({"status":"failed", "error":"Order not found."}, status=404)
+
+    points = load_trajectory(order_id)
+    return JsonResponse({
+        "order_id": order_id,
+        "points": trajectory_json(downsample(points, get_max_points(request))),
+        "total": len(points),
+    })
 
 # ============
 # RESTAURANT
@@ -218,71 +231,80 @@ def restaurant_order_notification(request,last_request_time):
 
 
 def driver_get_ready_orders(request):
-    orders = OrderSerializer(
-        Order.objects.filter(status=Order.READY, driver=None).order_by("-id"),
-        many=True
-    ).data
-    return JsonResponse({"orders":orders})
-
-@csrf_exempt
-def driver_pick_order(request):
-    if request.method == "POST":
-        # Get access token
-        access_token = AccessToken.objects.get(
-            token=request.POST.get("access_token"),
-            expires__gt = timezone.now()
+    """
+      params:
+        1. cursor (optional) ---> "next" of the previous page
+        2. page_size (optional)
+      return:
+        {"orders": [...], "next": cursor or null}
+    """
+    try:
+        page, next_cursor = keyset_paginate(
+            request,
+            eager_load(Order.objects.filter(status=Order.READY, driver=None), OrderSerializer)
         )
+    except InvalidCursor as e:
+        return JsonResponse({"status":"failed", "error":str(e)}, status=400)
 
-        # Get driver
-        driver = access_token.user.driver
+    with serialization_timer():
+        orders = OrderSerializer(
+            page,
+            many=True
+        ).data
+    return JsonResponse({"orders":orders, "next":next_cursor})
 
-        # Check if this driver still have an outstanding order
-        if Order.objects.filter(driver=driver, status=Order.ONTHEWAY):
-            return JsonResponse({
-                "status": "failed",
-                "error": "Your outstanding order is not delivered yet."
-            })
+@token_required("driver")
+def driver_get_nearby_orders(request):
+    """
+      params:
+        1. access_token
+        2. radius (optional) ---> km around the driver's last location, see NEARBY_RADIUS_KM
+        3. page_size (optional) ---> the nearest page_size orders
+      return:
+        {"orders": [{..., "distance": km}, ...]} nearest first
+    """
+    # The ids come from the in-memory index of coreapp.geo, only the orders
+    # found are read from the database, with the same query whatever their number
+    nearby = nearby_ready_orders(request.driver_id, get_radius(request), get_page_size(request))
+    if nearby is None:
+        return JsonResponse({"status":"failed", "error":"Update your location first."})
+
+    # Read them back, an order picked up in the meantime is left out
+    orders = eager_load(Order.objects.filter(status=Order.READY, driver=None), OrderSerializer)\
+        .in_bulk([order_id for distance, order_id in nearby])
+    nearby = sort_nearby(nearby, orders)
+
+    with serialization_timer():
+        data = OrderSerializer([order for distance, order in nearby], many=True).data
+    for order, (distance, obj) in zip(data, nearby):
+        order["distance"] = round(distance, 3)
+    return JsonResponse({"orders":data})
 
-        # Process picking up an order
+@csrf_exempt
+@token_required("driver")
+def driver_pick_order(request):
+    if request.method == "POST":
+        # Process picking up an order, with a single conditional UPDATE
         try:
-            order = Order.objects.get(
-                id = request.POST["order_id"],
-                driver = None,
-                status = Order.READY
-            )
-
-            order.driver = driver
-            order.status = Order.ONTHEWAY
-            order.picked_at = timezone.now()
-            order.save()
-
-            return JsonResponse({"status":"success"})
-
-        # If order is picked up by another driver 
-        except Order.DoesNotExist:
-            return JsonResponse({
-                "status": "failed",
-                "error": "This order has been picked up by another"
-            })
-def driver_get_latest_order(request):
-    # Get access_token
-    access_token = AccessToken.objects.get(
-        token = request.GET["access_token"],
-        expires__gt = timezone.now()
-    )
+            claim_order(request.POST.get("order_id"), request.driver_id)
+        # If order is picked up by another driver, or this driver still have an outstanding order
+        except OrderError as e:
+            return JsonResponse({"status":"failed", "error":str(e)})
 
-    # Get Driver
-    driver = access_token.user.driver
+        return JsonResponse({"status":"success"})
 
+@token_required("driver")
+def driver_get_latest_order(request):
     # get the last order of this driver
-    order = OrderSerializer(
-        Order.objects.filter(driver=driver, status=Order.ONTHEWAY).last()
-    ).data
+    order = eager_load(Order.objects.filter(driver_id=request.driver_id, status=Order.ONTHEWAY), OrderSerializer).last()
+    with serialization_timer():
+        order = OrderSerializer(order).data
 
     return JsonResponse({"order":order})
 
 
 @csrf_exempt
+@token_required("driver")
 def driver_complete_order(request):
     """
      params:
@@ -294,89 +316,120 @@ def driver_complete_order(request):
     """
 
     if request.method == "POST":
-        # Get access_token
-        access_token = AccessToken.objects.get(
-            token = request.POST["access_token"],
-            expires__gt = timezone.now()
-        )
-
-        # Get Driver
-        driver = access_token.user.driver
-
         # Complete an order
-        order = Order.objects.get(id=request.POST["order_id"], driver=driver)
-        order.status = Order.DELIVERED
-        order.save()
+        try:
+            order = deliver_order(request.POST.get("order_id"), request.driver_id)
+        except OrderError as e:
+            return JsonResponse({"status":"failed", "error":str(e)})
+
+        # End the location streams of this delivery
+        hub.publish(driver_channel(request.driver_id), {"event": "delivered", "order_id": order.id})
 
         return JsonResponse({"status": "success"})
 
+@token_required("driver")
 def driver_get_revenue(request):
     """
-    return : {Mon:0,Tue:10,..... }
+      params:
+        1. access_token
+        2. tz (optional) ---> the driver's timezone, eg. "Asia/Kolkata"
+        3. period (optional) ---> "week" (default) or "month"
+        4. start, end (optional) ---> YYYY-MM-DD, a custom range, `end` excluded
+      return :
+        {"days": {"2024-01-29":0, "2024-01-30":10, ...}} for every range,
+        with "revenue": {Mon:0,Tue:10,..... } too for the current week (period=week)
     """
-    # Get access token
-    access_token = AccessToken.objects.get(
-            token = request.GET["access_token"],
-            expires__gt = timezone.now()
-        )
-    # Get driver
-    driver = access_token.user.driver
-
-    # Get revenue
-    from datetime import timedelta
-
-    revenue = {}
-    today = timezone.now()
-    # weekday() method to get the day of the week as a number, where Monday is 0 and Sunday is 6.
-    current_weekdays = [today + timedelta(days=i) for i in range(0- today.weekday(), 7-today.weekday())]
-    for day in current_weekdays:
-        orders = Order.objects.filter(
-            driver = driver,
-            status = Order.DELIVERED,
-            created_at__year = day.year,
-            created_at__month = day.month,
-            created_at__day = day.day
-        )
+    try:
+        tz = get_timezone(request.GET.get("tz"))
+        start, end = get_date_range(request.GET, tz)
+    except InvalidRange as e:
+        return JsonResponse({"status":"failed", "error":str(e)})
+
+    # Get revenue, one grouped query for the whole range
+    totals = daily_totals(
+        Order.objects.filter(driver_id=request.driver_id, status=Order.DELIVERED),
+        start, end, tz
+    )
 
+    response = {"days": {day.isoformat(): total["total"] for day, total in totals.items()}}
+    if is_current_week(request.GET):
         # strftime() method returns a string representing date and time using date, time or datetime object.
         # %a ---> Abbreviated weekday name. eg. Sun, Mon
-        revenue[day.strftime("%a")] = sum(order.total for order in orders)
+        response["revenue"] = {day.strftime("%a"): total["total"] for day, total in totals.items()}
 
-    return JsonResponse({"revenue": revenue})
+    return JsonResponse(response)
 
 @csrf_exempt
+@token_required("driver")
 def driver_update_location(request):
     """
         params:
         1. access_token
-        2. location eg. lat, long
+        2. location eg. lat, long, any other text is kept without coordinates
         return:
         {"status": "success}
     """
     if request.method == "POST":
-        access_token = AccessToken.objects.get(
-            token=request.POST["access_token"],
-            expires__gt = timezone.now()
-        )
+        location = request.POST.get("location")
+        if not location:
+            return JsonResponse({"status":"failed", "error":"Location is required."})
+        # None when the app does not send "lat, long"
+        latitude, longitude = location_coordinates(location)
 
-        driver = access_token.user.driver
+        # Kept in memory and written with the other drivers' locations, see coreapp.locations
+        save_location(request.driver_id, location, latitude, longitude)
 
-        driver.location = request.POST["location"]
-        driver.save()
+        # Push the new location to the customers streaming it
+        hub.publish(driver_channel(request.driver_id), {
+            "event": "location",
+            "location": location
+        })
 
     return JsonResponse({"status":"success"})
 
+@csrf_exempt
+@token_required("driver")
+def driver_upload_locations(request):
+    """
+    Many GPS points in one request, added to the route of the order on the way.
+        params:
+        1. access_token
+        2. points ---> JSON [[timestamp, lat, long], ...], timestamp in seconds since the epoch
+        return:
+        {"status": "success", "stored": number of new points}
+    """
+    if request.method != "POST":
+        return JsonResponse({"status":"failed", "error":"POST is required."}, status=405)
+
+    try:
+        points = parse_points(request.POST.get("points"))
+    except TrajectoryError as e:
+        return JsonResponse({"status":"failed", "error":str(e)})
+
+    order_id = Order.objects.filter(driver_id=request.driver_id, status=Order.ONTHEWAY)\
+        .values_list("id", flat=True).last()
+    # Points without a delivery only move the driver
+    stored = store_points(order_id, request.driver_id, points) if order_id else 0
+
+    # The newest point is the driver's location, like driver/location/update/.
+    # An upload sent again, or one sent late after a newer location, does not move the driver back.
+    if stored or not order_id:
+        milliseconds, latitude, longitude = points[-1]
+        location = "%s, %s" % (latitude, longitude)
+        if save_location(request.driver_id, location, latitude, longitude, point_time(points[-1])):
+            hub.publish(driver_channel(request.driver_id), {"event": "location", "location": location})
+
+    return JsonResponse({"status":"success", "stored":stored})
+
+@token_required("driver")
 def driver_get_profile(request):
-    access_token = AccessToken.objects.get(
-        token=request.GET["access_token"],
-        expires__gt = timezone.now()
-    )
-    driver = OrderDriverSerializer(
-        access_token.user.driver
-    ).data
+    driver = eager_load(Driver.objects.all(), OrderDriverSerializer).get(id=request.driver_id)
+    with serialization_timer():
+        driver = OrderDriverSerializer(driver).data
     return JsonResponse({"driver":driver})
 
 @csrf_exempt
+@token_required("driver")
 def driver_update_profile(request):
     """
     params:
@@ -388,16 +441,10 @@ def driver_update_profile(request):
      {"status":"success"}
     """
     if request.method == "POST":
-        access_token = AccessToken.objects.get(
-            token = request.POST["access_token"],
-            expires__gt = timezone.now()
-        )
-
-        driver = access_token.user.driver
-
         # Update driver's profile
-        driver.car_model = request.POST["car_model"]
-        driver.plate_number = request.POST["plate_number"]
-        driver.save()
+        Driver.objects.filter(id=request.driver_id).update(
+            car_model = request.POST["car_model"],
+            plate_number = request.POST["plate_number"]
+        )
 
     return JsonResponse({"status": "success"})
\ No newline at end of file
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class CoreappConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'coreapp'
+
+    def ready(self):
+        # Connect the signal receivers
+        from coreapp import signals
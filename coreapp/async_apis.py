@@ -0,0 +1,435 @@
+import json
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from coreapp.models import Restaurant, Order, Driver
+from coreapp.geo import location_coordinates, get_radius, nearby_ready_orders, sort_nearby
+from coreapp.locations import asave_location, current_location
+from coreapp.trajectories import parse_points, store_points, load_trajectory, downsample, get_max_points, \
+    visible_order, trajectory_json, point_time, TrajectoryError
+from coreapp.menus import aget_menu_snapshot
+from coreapp.metrics import serialization_timer
+from coreapp.orders import place_order, aclaim_order, deliver_order, OrderError
+from coreapp.pagination import akeyset_paginate, get_page_size, InvalidCursor
+from coreapp.payments import acreate_checkout_intent, PaymentError
+from coreapp.pubsub import hub, driver_channel
+from coreapp.reports import get_timezone, get_date_range, is_current_week, adaily_totals, InvalidRange
+from coreapp.serializers import RestaurantSerializer, OrderSerializer, OrderStatusSerializer, OrderDriverSerializer, eager_load
+from coreapp.tokens import atoken_required
+from coreapp.apis import restaurants_page_etag
+# The restaurant dashboard stays synchronous
+from coreapp.apis import restaurant_order_notification
+
+
+# Async versions of the APIs in apis.py, used when ASYNC_APIS is True in settings.py.
+# Served by ASGI (eg. `uvicorn foodtasker.asgi:application`) a request which
+# waits for the database does not hold a worker thread, the ORM calls are
+# awaited with the async queryset methods (afirst, alast, aupdate, async for).
+# The responses are the same as the ones of apis.py.
+#
+# Served by WSGI every async view runs in its own event loop, keep ASYNC_APIS
+# False there.
+
+
+def csrf_exempt(view):
+    # django.views.decorators.csrf.csrf_exempt wraps the view in a sync
+    # function (Django 4.2), Django would then run the async view in a thread.
+    # Marking the view itself keeps it a coroutine function.
+    view.csrf_exempt = True
+    return view
+
+
+def require_post(view):
+    # A GET to the sync versions fails with "didn't return an HttpResponse", say why instead
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != "POST":
+            return JsonResponse({"status":"failed", "error":"POST is required."}, status=405)
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+# =========
+# CUSTOMER
+# =========
+
+async def customer_get_restaurants(request):
+    """
+      params:
+        1. cursor (optional) ---> "next" of the previous page
+        2. page_size (optional)
+      return:
+        {"restaurants": [...], "next": cursor or null}
+    """
+    try:
+        page, next_cursor = await akeyset_paginate(request, Restaurant.objects.all())
+    except InvalidCursor as e:
+        return JsonResponse({"status":"failed", "error":str(e)}, status=400)
+
+    # The page is loaded anyway, its version stamps give the ETag without a second query
+    etag = quote_etag(restaurants_page_etag(request, page, next_cursor))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        with serialization_timer():
+            restaurants = RestaurantSerializer(
+                page,
+                many=True,
+                context={"request":request}
+                ).data
+        response = JsonResponse({"restaurants":restaurants, "next":next_cursor})
+    response["ETag"] = etag
+    return response
+
+async def customer_get_meals(request, restaurant_id):
+    # The menu is served from its pre-rendered snapshot (see coreapp.menus)
+    snapshot = await aget_menu_snapshot(request, restaurant_id)
+    if snapshot is None:
+        return JsonResponse({"meals":[]})
+
+    etag, body = snapshot
+    response = get_conditional_response(request, etag=quote_etag(etag))
+    if response is None:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = quote_etag(etag)
+    return response
+
+@csrf_exempt
+@atoken_required("customer")
+async def customer_add_order(request):
+    """
+      params:
+        1. access_token
+        2. restaurant_id
+        3. address
+        4. order_details(json format) example:
+            [{"meal_id":1, "quantity":2},{"meal_id":2, "quantity": 3}]
+      returns:
+        {"status": "success"}
+    """
+    try:
+        order_details = json.loads(request.POST.get("order_details", "[]"))
+    except ValueError:
+        return JsonResponse({"status":"failed", "error":"Order details are invalid."})
+
+    # The order is written in a transaction, transactions are not supported
+    # by the async ORM, so place_order() runs in a thread.
+    try:
+        await sync_to_async(place_order)(
+            customer_id = request.customer_id,
+            restaurant_id = request.POST.get("restaurant_id"),
+            address = request.POST.get("address"),
+            order_details = order_details
+        )
+    except OrderError as e:
+        return JsonResponse({"status":"failed", "error":str(e)})
+
+    return JsonResponse({"status": "success"})
+
+@csrf_exempt
+@atoken_required("customer")
+async def customer_get_latest_order(request):
+    """
+      params:
+        1. access_token
+      return:
+        {JSON data with all details of an order}
+    """
+    order = await eager_load(Order.objects.filter(customer_id=request.customer_id), OrderSerializer).alast()
+
+    # Everything the serializer reads is preloaded, serializing runs no query
+    with serialization_timer():
+        order = OrderSerializer(order).data
+    return JsonResponse({"last_order": order})
+
+
+@atoken_required("customer")
+async def customer_get_latest_order_status(request):
+    """
+      params:
+        1. access_token
+      return:
+        {JSON data with all details of an order}
+    """
+    order = await Order.objects.filter(customer_id=request.customer_id).alast()
+
+    with serialization_timer():
+        order_status = OrderStatusSerializer(order).data
+    return JsonResponse({"last_order_status": order_status})
+
+
+@atoken_required("customer")
+async def customer_get_driver_location(request):
+    # Read the driver's location together with the order
+    current_order = await Order.objects.filter(
+        customer_id=request.customer_id,
+        status=Order.ONTHEWAY
+    ).select_related("driver").alast()
+    if current_order:
+        location = current_location(current_order.driver)
+    else:
+        location = None
+
+    return JsonResponse({"location": location})
+
+@csrf_exempt
+@require_post
+@atoken_required()
+async def create_payment_intent(request):
+    """
+     params:
+       1. access_token
+       2. total
+       3. order_details (optional, json format) ---> the cart being paid for
+     return:
+      {"client_secret": client_secret}
+    """
+    try:
+        cart = json.loads(request.POST.get("order_details", "null"))
+    except ValueError:
+        return JsonResponse({"status":"failed", "error":"Order details are invalid."})
+
+    # The event loop serves other requests while the gateway answers
+    try:
+        intent = await acreate_checkout_intent(request.identity, request.POST.get("total"), cart)
+    except PaymentError as e:
+        return JsonResponse({"status":"failed", "error":str(e)})
+
+    return JsonResponse({"client_secret": intent.client_secret})
+
+@atoken_required()
+async def get_order_trajectory(request, order_id):
+    """
+    The route of a delivery, for its customer and its driver.
+      params:
+        1. access_token
+        2. max_points (optional) ---> TRAJECTORY_MAX_POINTS at most
+      return:
+        {"order_id": 1, "points": [[timestamp, lat, long], ...], "total": number of points stored}
+    """
+    if await sync_to_async(visible_order)(order_id, request.customer_id, request.driver_id) is None:
+        return JsonResponse({"status":"failed", "error":"Order not found."}, status=404)
+
+    points = await sync_to_async(load_trajectory)(order_id)
+    return JsonResponse({
+        "order_id": order_id,
+        "points": trajectory_json(downsample(points, get_max_points(request))),
+        "total": len(points),
+    })
+
+# ========
+# DRIVER
+# =========
+
+async def driver_get_ready_orders(request):
+    """
+      params:
+        1. cursor (optional) ---> "next" of the previous page
+        2. page_size (optional)
+      return:
+        {"orders": [...], "next": cursor or null}
+    """
+    try:
+        page, next_cursor = await akeyset_paginate(
+            request,
+            eager_load(Order.objects.filter(status=Order.READY, driver=None), OrderSerializer)
+        )
+    except InvalidCursor as e:
+        return JsonResponse({"status":"failed", "error":str(e)}, status=400)
+
+    with serialization_timer():
+        orders = OrderSerializer(page, many=True).data
+    return JsonResponse({"orders":orders, "next":next_cursor})
+
+@atoken_required("driver")
+async def driver_get_nearby_orders(request):
+    """
+      params:
+        1. access_token
+        2. radius (optional) ---> km around the driver's last location, see NEARBY_RADIUS_KM
+        3. page_size (optional) ---> the nearest page_size orders
+      return:
+        {"orders": [{..., "distance": km}, ...]} nearest first
+    """
+    # Reads the driver's location, and loads the index when it is too old
+    nearby = await sync_to_async(nearby_ready_orders)(request.driver_id, get_radius(request), get_page_size(request))
+    if nearby is None:
+        return JsonResponse({"status":"failed", "error":"Update your location first."})
+
+    # Read them back, an order picked up in the meantime is left out
+    orders = {
+        order.id: order
+        async for order in eager_load(Order.objects.filter(status=Order.READY, driver=None), OrderSerializer)
+            .filter(id__in=[order_id for distance, order_id in nearby])
+    }
+    nearby = sort_nearby(nearby, orders)
+
+    with serialization_timer():
+        data = OrderSerializer([order for distance, order in nearby], many=True).data
+    for order, (distance, obj) in zip(data, nearby):
+        order["distance"] = round(distance, 3)
+    return JsonResponse({"orders":data})
+
+@csrf_exempt
+@require_post
+@atoken_required("driver")
+async def driver_pick_order(request):
+    # Process picking up an order, with a single conditional UPDATE
+    try:
+        await aclaim_order(request.POST.get("order_id"), request.driver_id)
+    except OrderError as e:
+        return JsonResponse({"status":"failed", "error":str(e)})
+
+    return JsonResponse({"status":"success"})
+
+@atoken_required("driver")
+async def driver_get_latest_order(request):
+    # get the last order of this driver
+    order = await eager_load(
+        Order.objects.filter(driver_id=request.driver_id, status=Order.ONTHEWAY), OrderSerializer
+    ).alast()
+
+    with serialization_timer():
+        order = OrderSerializer(order).data
+    return JsonResponse({"order":order})
+
+@csrf_exempt
+@require_post
+@atoken_required("driver")
+async def driver_complete_order(request):
+    """
+     params:
+      1. access_token
+      2. order_id
+
+      return:
+      {"status": "success"}
+    """
+    # The status and the report rollups change in one transaction, see place_order above
+    try:
+        order = await sync_to_async(deliver_order)(request.POST.get("order_id"), request.driver_id)
+    except OrderError as e:
+        return JsonResponse({"status":"failed", "error":str(e)})
+
+    # End the location streams of this delivery
+    hub.publish(driver_channel(request.driver_id), {"event": "delivered", "order_id": order.id})
+
+    return JsonResponse({"status": "success"})
+
+@atoken_required("driver")
+async def driver_get_revenue(request):
+    """
+      params:
+        1. access_token
+        2. tz (optional) ---> the driver's timezone, eg. "Asia/Kolkata"
+        3. period (optional) ---> "week" (default) or "month"
+        4. start, end (optional) ---> YYYY-MM-DD, a custom range, `end` excluded
+      return :
+        {"days": {"2024-01-29":0, "2024-01-30":10, ...}} for every range,
+        with "revenue": {Mon:0,Tue:10,..... } too for the current week (period=week)
+    """
+    try:
+        tz = get_timezone(request.GET.get("tz"))
+        start, end = get_date_range(request.GET, tz)
+    except InvalidRange as e:
+        return JsonResponse({"status":"failed", "error":str(e)})
+
+    totals = await adaily_totals(
+        Order.objects.filter(driver_id=request.driver_id, status=Order.DELIVERED),
+        start, end, tz
+    )
+
+    response = {"days": {day.isoformat(): total["total"] for day, total in totals.items()}}
+    if is_current_week(request.GET):
+        # strftime() method returns a string representing date and time using date, time or datetime object.
+        # %a ---> Abbreviated weekday name. eg. Sun, Mon
+        response["revenue"] = {day.strftime("%a"): total["total"] for day, total in totals.items()}
+
+    return JsonResponse(response)
+
+@csrf_exempt
+@atoken_required("driver")
+async def driver_update_location(request):
+    """
+        params:
+        1. access_token
+        2. location eg. lat, long, any other text is kept without coordinates
+        return:
+        {"status": "success}
+    """
+    if request.method == "POST":
+        location = request.POST.get("location")
+        if not location:
+            return JsonResponse({"status":"failed", "error":"Location is required."})
+        # None when the app does not send "lat, long"
+        latitude, longitude = location_coordinates(location)
+
+        # Kept in memory and written with the other drivers' locations, see coreapp.locations
+        await asave_location(request.driver_id, location, latitude, longitude)
+
+        # Push the new location to the customers streaming it
+        hub.publish(driver_channel(request.driver_id), {
+            "event": "location",
+            "location": location
+        })
+
+    return JsonResponse({"status":"success"})
+
+@csrf_exempt
+@require_post
+@atoken_required("driver")
+async def driver_upload_locations(request):
+    """
+    Many GPS points in one request, added to the route of the order on the way.
+        params:
+        1. access_token
+        2. points ---> JSON [[timestamp, lat, long], ...], timestamp in seconds since the epoch
+        return:
+        {"status": "success", "stored": number of new points}
+    """
+    try:
+        points = parse_points(request.POST.get("points"))
+    except TrajectoryError as e:
+        return JsonResponse({"status":"failed", "error":str(e)})
+
+    order_id = await Order.objects.filter(driver_id=request.driver_id, status=Order.ONTHEWAY)\
+        .values_list("id", flat=True).alast()
+    # Points without a delivery only move the driver. The segments are written in one transaction
+    stored = await sync_to_async(store_points)(order_id, request.driver_id, points) if order_id else 0
+
+    # An upload sent again, or one sent late after a newer location, does not move the driver back
+    if stored or not order_id:
+        milliseconds, latitude, longitude = points[-1]
+        location = "%s, %s" % (latitude, longitude)
+        if await asave_location(request.driver_id, location, latitude, longitude, point_time(points[-1])):
+            hub.publish(driver_channel(request.driver_id), {"event": "location", "location": location})
+
+    return JsonResponse({"status":"success", "stored":stored})
+
+@atoken_required("driver")
+async def driver_get_profile(request):
+    driver = await eager_load(Driver.objects.all(), OrderDriverSerializer).aget(id=request.driver_id)
+    with serialization_timer():
+        driver = OrderDriverSerializer(driver).data
+    return JsonResponse({"driver":driver})
+
+@csrf_exempt
+@atoken_required("driver")
+async def driver_update_profile(request):
+    """
+    params:
+      1. access_token
+      2. car_model
+      3. plate_number
+
+    return:
+     {"status":"success"}
+    """
+    if request.method == "POST":
+        # Update driver's profile
+        await Driver.objects.filter(id=request.driver_id).aupdate(
+            car_model = request.POST["car_model"],
+            plate_number = request.POST["plate_number"]
+        )
+
+    return JsonResponse({"status": "success"})
@@ -0,0 +1,255 @@
+import json
+import time
+import uuid
+from collections import namedtuple
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern
+from django.utils import timezone
+from oauth2_provider.models import AccessToken
+from coreapp import urls
+from coreapp.locations import location_buffer
+from coreapp.models import Meal, Customer, Driver, Order
+from coreapp.payments import get_gateway
+
+
+# Per-endpoint benchmark (see the benchmark command).
+# Every route of coreapp/urls.py is requested through the test client against
+# the current database, eg. one filled by the seed_data command.
+# Each request runs in a transaction which is rolled back, so the orders
+# picked, completed or added by one request are there again for the next one
+# and two runs over the same data can be compared.
+
+# How to request a route. {name} in the path and data is filled from the
+# benchmark context, `user` is "restaurant" for the pages which need a signed in restaurant.
+Request = namedtuple("Request", ("method", "path", "data", "user"), defaults=(None, None))
+
+ROUTES = {
+    # Web View - Restaurant
+    "": Request("get", "/restaurant/", user="restaurant"),
+    "sign_in/": Request("get", "/restaurant/sign_in/"),
+    "sign_out/": Request("post", "/restaurant/sign_out/", user="restaurant"),
+    "sign_up/": Request("get", "/restaurant/sign_up/"),
+    "account/": Request("get", "/restaurant/account/", user="restaurant"),
+    "meal/": Request("get", "/restaurant/meal/", user="restaurant"),
+    "meal/add_meal/": Request("get", "/restaurant/meal/add_meal/", user="restaurant"),
+    "meal/edit_meal/<int:meal_id>": Request("get", "/restaurant/meal/edit_meal/{meal_id}", user="restaurant"),
+    "order/": Request("get", "/restaurant/order/", user="restaurant"),
+    "order/export/": Request("get", "/restaurant/order/export/", user="restaurant"),
+    "report/": Request("get", "/restaurant/report/", user="restaurant"),
+
+    # API for customer
+    "customer/restaurants/": Request("get", "/api/customer/restaurants/"),
+    "customer/meals/<int:restaurant_id>": Request("get", "/api/customer/meals/{restaurant_id}"),
+    "customer/payment_intent/": Request("post", "/api/customer/payment_intent/", {
+        "access_token": "{customer_token}", "total": "12", "order_details": "{order_details}",
+    }),
+    "customer/order/add/": Request("post", "/api/customer/order/add/", {
+        "access_token": "{customer_token}", "restaurant_id": "{restaurant_id}",
+        "address": "Benchmark Street", "order_details": "{order_details}",
+    }),
+    "customer/order/latest/": Request("get", "/api/customer/order/latest/", {"access_token": "{customer_token}"}),
+    "customer/order/latest_status/": Request("get", "/api/customer/order/latest_status/", {"access_token": "{customer_token}"}),
+    "customer/driver/location/": Request("get", "/api/customer/driver/location/", {"access_token": "{waiting_customer_token}"}),
+    "customer/driver/location/stream/": Request("get", "/api/customer/driver/location/stream/", {"access_token": "{waiting_customer_token}"}),
+    "order/trajectory/<int:order_id>/": Request("get", "/api/order/trajectory/{delivery_id}/", {"access_token": "{waiting_customer_token}"}),
+
+    # API for Restaurant
+    "restaurant/order/notification/<last_request_time>/": Request(
+        "get", "/api/restaurant/order/notification/{last_request_time}/", user="restaurant"
+    ),
+    "restaurant/order/stream/": Request("get", "/api/restaurant/order/stream/", user="restaurant"),
+
+    # API for Driver
+    "driver/order/ready/": Request("get", "/api/driver/order/ready/"),
+    "driver/order/ready/stream/": Request("get", "/api/driver/order/ready/stream/", {"access_token": "{free_driver_token}"}),
+    "driver/order/nearby/": Request("get", "/api/driver/order/nearby/", {"access_token": "{free_driver_token}"}),
+    "driver/order/pick/": Request("post", "/api/driver/order/pick/", {"access_token": "{free_driver_token}", "order_id": "{ready_order_id}"}),
+    "driver/order/latest/": Request("get", "/api/driver/order/latest/", {"access_token": "{busy_driver_token}"}),
+    "driver/order/complete/": Request("post", "/api/driver/order/complete/", {"access_token": "{busy_driver_token}", "order_id": "{delivery_id}"}),
+    "driver/order/revenue/": Request("get", "/api/driver/order/revenue/", {"access_token": "{busy_driver_token}", "period": "month"}),
+    "driver/location/update/": Request("post", "/api/driver/location/update/", {"access_token": "{free_driver_token}", "location": "37.77, -122.42"}),
+    "driver/location/batch/": Request("post", "/api/driver/location/batch/", {
+        "access_token": "{busy_driver_token}", "points": "{points}",
+    }),
+    "driver/profile/": Request("get", "/api/driver/profile/", {"access_token": "{free_driver_token}"}),
+    "driver/profile/update/": Request("post", "/api/driver/profile/update/", {
+        "access_token": "{free_driver_token}", "car_model": "Car", "plate_number": "BENCH-1",
+    }),
+
+    # Prometheus metrics, the test client's address is allowed in run_benchmark()
+    "metrics/": Request("get", "/api/metrics/"),
+}
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def percentile(timings, percent):
+    # Nearest-rank percentile of sorted timings
+    if not timings:
+        return None
+    index = max(0, int(round(percent / 100 * len(timings))) - 1)
+    return timings[min(index, len(timings) - 1)]
+
+
+def coreapp_routes():
+    # The routes of coreapp/urls.py, included apps (eg. social/) are not ours to measure
+    return [str(pattern.pattern) for pattern in urls.urlpatterns if isinstance(pattern, URLPattern)]
+
+
+def _token(user):
+    return AccessToken.objects.create(
+        user=user, token="benchmark-" + uuid.uuid4().hex, expires=timezone.now() + timedelta(hours=1)
+    )
+
+
+def create_context():
+    """
+    Picks the data the requests are about and gives every user an access token.
+      returns:
+        (context for the {name} placeholders, users for Request.user, access tokens to delete)
+    """
+    meal = Meal.objects.select_related("restaurant__user").first()
+    delivery = Order.objects.filter(status=Order.ONTHEWAY).select_related("driver__user", "customer__user").first()
+    ready_order = Order.objects.filter(status=Order.READY, driver=None).first()
+    # A customer and a driver who are free to order and to pick an order
+    customer = Customer.objects.exclude(order__status__in=[Order.COOKING, Order.READY, Order.ONTHEWAY])\
+        .select_related("user").first()
+    driver = Driver.objects.exclude(order__status=Order.ONTHEWAY).select_related("user").first()
+    if not (meal and delivery and ready_order and customer and driver):
+        raise BenchmarkError("The database needs a meal, a free customer and driver, a ready order "
+                             "and an order on the way, run seed_data first.")
+
+    restaurant = meal.restaurant
+    menu = Meal.objects.filter(restaurant=restaurant).values_list("id", flat=True)[:2]
+    tokens = [
+        _token(customer.user), _token(delivery.customer.user), _token(driver.user), _token(delivery.driver.user),
+    ]
+    context = {
+        "meal_id": meal.id,
+        "restaurant_id": restaurant.id,
+        "order_details": json.dumps([{"meal_id": meal_id, "quantity": 1} for meal_id in menu]),
+        "customer_token": tokens[0].token,
+        "waiting_customer_token": tokens[1].token,
+        "free_driver_token": tokens[2].token,
+        "busy_driver_token": tokens[3].token,
+        "ready_order_id": ready_order.id,
+        "delivery_id": delivery.id,
+        "last_request_time": (timezone.now() - timedelta(days=1)).isoformat(),
+        # A minute of GPS points, one per second
+        "points": json.dumps([
+            [timezone.now().timestamp() - 60 + i, 37.77 + i * 1e-4, -122.42 + i * 1e-4] for i in range(60)
+        ]),
+    }
+    return context, {"restaurant": restaurant.user}, tokens
+
+
+def measure(request, context, users, iterations, warmup):
+    """
+    Runs one route `warmup` + `iterations` times.
+      returns:
+        {"method", "path", "status", "p50_ms", "p95_ms", "p99_ms", "mean_ms", "queries", "bytes"}
+    """
+    path = request.path.format(**context)
+    data = {key: value.format(**context) for key, value in (request.data or {}).items()}
+
+    timings = []
+    queries = 0
+    for i in range(warmup + iterations):
+        with transaction.atomic():
+            # Errors are reported as the status
+            client = Client(raise_request_exception=False)
+            if request.user:
+                client.force_login(users[request.user])
+
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = getattr(client, request.method)(path, data)
+                if response.streaming:
+                    body = b"".join(response.streaming_content)
+                else:
+                    body = response.content
+                elapsed = time.perf_counter() - started
+
+            transaction.set_rollback(True)
+            # Buffered driver locations go with the rolled back rows
+            location_buffer.clear()
+
+        if i >= warmup:
+            timings.append(elapsed)
+            queries = max(queries, len(captured))
+
+    timings.sort()
+    return {
+        "method": request.method.upper(),
+        "path": path,
+        "status": response.status_code,
+        "p50_ms": round(percentile(timings, 50) * 1000, 3),
+        "p95_ms": round(percentile(timings, 95) * 1000, 3),
+        "p99_ms": round(percentile(timings, 99) * 1000, 3),
+        "mean_ms": round(sum(timings) / len(timings) * 1000, 3),
+        "queries": queries,
+        "bytes": len(body),
+    }
+
+
+def run_benchmark(iterations=50, warmup=5, routes=None):
+    """
+      params:
+        1. iterations ---> measured requests per route
+        2. warmup ---> requests per route before measuring (caches, connections)
+        3. routes (optional) ---> only these routes of coreapp/urls.py
+      returns:
+        {"database": .., "iterations": .., "routes": {route: result of measure()}, "skipped": [routes]}
+    """
+    selected = [route for route in coreapp_routes() if routes is None or route in routes]
+    results = {}
+    skipped = [route for route in selected if route not in ROUTES]
+
+    context, users, tokens = create_context()
+    try:
+        # Checkout must not reach Stripe. The test client's host and address are allowed like in the tests.
+        with override_settings(
+            PAYMENT_GATEWAY="fake", FAKE_PAYMENT_LATENCY=0,
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"],
+            METRICS_ALLOWED_IPS=[*settings.METRICS_ALLOWED_IPS, "127.0.0.1"],
+        ):
+            get_gateway.cache_clear()
+            for route in selected:
+                if route in ROUTES:
+                    results[route] = measure(ROUTES[route], context, users, iterations, warmup)
+    finally:
+        get_gateway.cache_clear()
+        for token in tokens:
+            token.delete()
+
+    return {
+        "database": connection.vendor,
+        "iterations": iterations,
+        "routes": results,
+        "skipped": skipped,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Lists the routes which got slower than the baseline by more than
+    `threshold` percent at p95, or which run more queries.
+      returns:
+        [(route, message)]
+    """
+    regressions = []
+    for route, result in results["routes"].items():
+        before = baseline.get("routes", {}).get(route)
+        if before is None:
+            continue
+        if result["queries"] > before["queries"]:
+            regressions.append((route, "queries %s -> %s" % (before["queries"], result["queries"])))
+        if before["p95_ms"] and result["p95_ms"] > before["p95_ms"] * (1 + threshold / 100):
+            regressions.append((route, "p95 %sms -> %sms" % (before["p95_ms"], result["p95_ms"])))
+    return regressions
@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+
+# name ---> the LRUCache created with that name, their stats are exported by coreapp.metrics
+caches = {}
+
+
+class LRUCache:
+    """
+    A small thread safe, in-process LRU cache.
+
+    Entries can expire: pass `ttl` (seconds) to expire every entry after a
+    fixed time, or `expires_at` (a unix timestamp) to set() for a single entry.
+    Hits and misses are counted, a cache created with a `name` is listed in
+    `caches` and its counts are exported at the metrics endpoint.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        if name:
+            caches[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            # Mark the key as the most recently used one
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at=None):
+        if self.ttl is not None:
+            ttl_expires_at = time.time() + self.ttl
+            expires_at = ttl_expires_at if expires_at is None else min(expires_at, ttl_expires_at)
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            # Drop the least recently used keys
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
@@ -0,0 +1,211 @@
+import time
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, Value, Exists, OuterRef, BigIntegerField
+from django.utils import timezone
+from coreapp.geo import EARTH_RADIUS_KM, ready_orders
+from coreapp.models import Order, Driver
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    # Without SciPy every order takes the nearest free driver, oldest order first
+    linear_sum_assignment = None
+
+
+# BATCH DISPATCH
+
+# With DISPATCH_MODE on, the drivers do not pick the orders themselves
+# (claim_order refuses), the dispatch_orders command assigns them every
+# DISPATCH_INTERVAL seconds instead:
+#   1. the READY orders without a driver and the idle drivers (no order on the
+#      way) are loaded with their coordinates, 2 queries
+#   2. the distances between them are computed at once with NumPy
+#   3. an assignment solver pairs them, minimising the total distance, and
+#      pairs further apart than DISPATCH_MAX_KM are dropped
+#   4. every pair is written in one transaction
+# A driver finds their order with driver/order/latest/, like after a pick.
+#
+# The exact solver (scipy.optimize.linear_sum_assignment) takes about
+# min(orders, drivers)^2 * max(orders, drivers) steps, over a second for
+# 3000 x 3000. Up to DISPATCH_BATCH_SIZE on the smaller side the problem is
+# solved at once, bigger ones are solved DISPATCH_BATCH_SIZE orders at a time,
+# oldest first, each order against its DISPATCH_CANDIDATES nearest free
+# drivers. See the dispatch_benchmark command.
+
+SOLVER = "scipy" if linear_sum_assignment is not None else "greedy"
+
+# Cost of a pair the solver must not use
+UNREACHABLE = 1e9
+
+
+def unit_vectors(coordinates):
+    """
+      params:
+        1. coordinates ---> array of (latitude, longitude) in degrees, shape (n, 2)
+      returns:
+        the points on the unit sphere, shape (n, 3)
+    """
+    latitude = np.radians(coordinates[:, 0])
+    longitude = np.radians(coordinates[:, 1])
+    cos_latitude = np.cos(latitude)
+    return np.column_stack((cos_latitude * np.cos(longitude), cos_latitude * np.sin(longitude), np.sin(latitude)))
+
+
+def distance_matrix(origins, destinations):
+    """
+    Great-circle distances in km between every origin and every destination,
+    shape (len(origins), len(destinations)).
+    `origins` and `destinations` are unit_vectors(). The dot products are one
+    matrix multiplication, the chord between two points gives the arc.
+    """
+    dot = origins @ destinations.T
+    chord = np.sqrt(np.clip(2 - 2 * dot, 0, 4))
+    return 2 * EARTH_RADIUS_KM * np.arcsin(chord / 2)
+
+
+def _solve(costs, max_km):
+    """
+      returns:
+        (rows, columns) of the pairs, each one within max_km
+    """
+    if linear_sum_assignment is not None:
+        rows, columns = linear_sum_assignment(np.where(costs <= max_km, costs, UNREACHABLE))
+    else:
+        # Drivers too far away are never taken, an order with none in reach
+        # does not use up the nearest driver of a later order
+        costs_in_reach = np.where(costs <= max_km, costs, np.inf)
+        rows, columns = [], []
+        free = np.ones(costs.shape[1], dtype=bool)
+        for row in range(costs.shape[0]):
+            if not free.any():
+                break
+            row_costs = np.where(free, costs_in_reach[row], np.inf)
+            column = row_costs.argmin()
+            if row_costs[column] == np.inf:
+                continue
+            rows.append(row)
+            columns.append(column)
+            free[column] = False
+        rows, columns = np.array(rows, dtype=int), np.array(columns, dtype=int)
+
+    within = costs[rows, columns] <= max_km
+    return rows[within], columns[within]
+
+
+def assign(orders, drivers, max_km, batch_size=None, candidates=None):
+    """
+      params:
+        1. orders ---> (latitude, longitude) of the orders, oldest first, shape (n, 2)
+        2. drivers ---> (latitude, longitude) of the drivers, shape (m, 2)
+        3. max_km ---> longest distance between the pickup and a driver
+      returns:
+        [(order index, driver index, distance in km)]
+    """
+    batch_size = batch_size or settings.DISPATCH_BATCH_SIZE
+    candidates = candidates or settings.DISPATCH_CANDIDATES
+    if not len(orders) or not len(drivers):
+        return []
+
+    order_vectors = unit_vectors(np.asarray(orders, dtype=float))
+    driver_vectors = unit_vectors(np.asarray(drivers, dtype=float))
+
+    # Small enough to be solved at once
+    if min(len(orders), len(drivers)) <= batch_size:
+        costs = distance_matrix(order_vectors, driver_vectors)
+        rows, columns = _solve(costs, max_km)
+        return list(zip(rows.tolist(), columns.tolist(), costs[rows, columns].tolist()))
+
+    pairs = []
+    free = np.ones(len(drivers), dtype=bool)
+    for start in range(0, len(orders), batch_size):
+        free_drivers = np.flatnonzero(free)
+        if not len(free_drivers):
+            break
+        costs = distance_matrix(order_vectors[start:start + batch_size], driver_vectors[free_drivers])
+
+        # Only the nearest drivers of each order of the batch are offered to the solver
+        nearest = min(candidates, len(free_drivers))
+        offered = np.unique(np.argpartition(costs, nearest - 1, axis=1)[:, :nearest])
+        costs = costs[:, offered]
+
+        rows, columns = _solve(costs, max_km)
+        chosen = free_drivers[offered[columns]]
+        free[chosen] = False
+        pairs += zip((rows + start).tolist(), chosen.tolist(), costs[rows, columns].tolist())
+    return pairs
+
+
+def _save_assignments(pairs, now):
+    """
+    Gives each order of `pairs`, [(order id, driver id)], to its driver, in
+    UPDATEs of DISPATCH_UPDATE_SIZE orders, like claim_order: only an order
+    which is still READY without a driver moves, and only to a driver without
+    an order on the way.
+      returns:
+        the pairs which were saved
+    """
+    saved = []
+    size = settings.DISPATCH_UPDATE_SIZE
+    for start in range(0, len(pairs), size):
+        chunk = pairs[start:start + size]
+        driver_of = Case(
+            *[When(id=order_id, then=Value(driver_id)) for order_id, driver_id in chunk],
+            output_field=BigIntegerField()
+        )
+        order_ids = [order_id for order_id, driver_id in chunk]
+        updated = Order.objects.filter(id__in=order_ids, status=Order.READY, driver=None)\
+            .alias(new_driver=driver_of)\
+            .filter(~Exists(Order.objects.filter(driver_id=OuterRef("new_driver"), status=Order.ONTHEWAY)))\
+            .update(driver_id=driver_of, status=Order.ONTHEWAY, picked_at=now)
+
+        if updated == len(chunk):
+            saved += chunk
+        else:
+            # Some orders or drivers were taken in the meantime, read back which moved
+            moved = set(Order.objects.filter(id__in=order_ids, status=Order.ONTHEWAY).values_list("id", "driver_id"))
+            saved += [pair for pair in chunk if pair in moved]
+    return saved
+
+
+def dispatch_orders(max_km=None):
+    """
+    Assigns the READY orders without a driver to the idle drivers, see the top of this file.
+      params:
+        1. max_km (optional) ---> DISPATCH_MAX_KM by default
+      returns:
+        {"orders", "drivers", "assigned": [(order id, driver id)], "solve_seconds", "solver"}
+    """
+    max_km = settings.DISPATCH_MAX_KM if max_km is None else max_km
+
+    # Oldest first, they go first when not every order can get a driver
+    orders = list(Order.objects.filter(
+        status=Order.READY, driver=None,
+        restaurant__latitude__isnull=False, restaurant__longitude__isnull=False
+    ).order_by("id").values_list("id", "restaurant__latitude", "restaurant__longitude")[:settings.DISPATCH_MAX_ORDERS])
+    drivers = list(Driver.objects.filter(
+        ~Exists(Order.objects.filter(driver=OuterRef("pk"), status=Order.ONTHEWAY)),
+        latitude__isnull=False, longitude__isnull=False,
+    ).values_list("id", "latitude", "longitude"))
+
+    started = time.perf_counter()
+    pairs = assign(
+        [(latitude, longitude) for order_id, latitude, longitude in orders],
+        [(latitude, longitude) for driver_id, latitude, longitude in drivers],
+        max_km
+    )
+    solve_seconds = time.perf_counter() - started
+
+    pairs = [(orders[order][0], drivers[driver][0]) for order, driver, distance in pairs]
+    with transaction.atomic():
+        assigned = _save_assignments(pairs, timezone.now())
+        transaction.on_commit(lambda: ready_orders.remove_orders([order_id for order_id, driver_id in assigned]))
+
+    return {
+        "orders": len(orders),
+        "drivers": len(drivers),
+        "assigned": assigned,
+        "solve_seconds": solve_seconds,
+        "solver": SOLVER,
+    }
@@ -0,0 +1,180 @@
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime, time
+from itertools import islice
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from coreapp.models import Order, OrderDetails
+from coreapp.reports import InvalidRange
+
+
+# ORDER EXPORT
+
+# The order history of a restaurant as CSV or NDJSON, streamed while it is
+# read. The orders come through one iterator(), a server-side cursor on
+# PostgreSQL, EXPORT_CHUNK_SIZE at a time, and the details of each chunk with
+# one more query, so the memory used stays the same for 1 000 or 1 000 000
+# orders. Rows are read as tuples, building model instances would take most
+# of the time of a big export.
+
+CSV_HEADER = [
+    "order_id", "created_at", "status", "customer", "driver", "address", "total",
+    "meal", "price", "quantity", "sub_total",
+]
+
+ORDER_FIELDS = (
+    "id", "created_at", "status", "address", "total",
+    "customer__user__first_name", "customer__user__last_name",
+    "driver__user__first_name", "driver__user__last_name",
+)
+
+STATUS_NAMES = dict(Order.STATUS_CHOICES)
+
+
+def get_export_range(params):
+    """
+      params:
+        1. start, end (optional) ---> YYYY-MM-DD, orders created in [start, end), either one can be left open
+      returns:
+        (start date or None, end date or None)
+    """
+    dates = []
+    for name in ("start", "end"):
+        try:
+            dates.append(datetime.strptime(params[name], "%Y-%m-%d").date() if params.get(name) else None)
+        except ValueError:
+            raise InvalidRange("start and end must be dates, eg. 2024-01-31.")
+    start, end = dates
+    if start and end and end <= start:
+        raise InvalidRange("end must be after start.")
+    return start, end
+
+
+def filter_created(orders, start, end, tz):
+    """
+      params:
+        1. start, end ---> dates of get_export_range(), None is left open
+        2. tz ---> the timezone the days start in, the restaurant's one
+      returns:
+        the orders created in [start, end)
+    """
+    if start:
+        orders = orders.filter(created_at__gte=timezone.make_aware(datetime.combine(start, time.min), tz))
+    if end:
+        orders = orders.filter(created_at__lt=timezone.make_aware(datetime.combine(end, time.min), tz))
+    return orders
+
+
+def _full_name(first_name, last_name):
+    # Like User.get_full_name(), None without a driver
+    if first_name is None:
+        return None
+    return ("%s %s" % (first_name, last_name)).strip()
+
+
+def export_orders(restaurant, statuses, start, end, tz):
+    """
+      returns:
+        a generator of the orders of the restaurant with one of the statuses created in [start, end),
+        oldest first, each one a dict of the fields of ORDER_FIELDS and its "order_details"
+    """
+    orders = filter_created(Order.objects.filter(restaurant=restaurant, status__in=statuses), start, end, tz)
+    rows = orders.order_by("id").values_list(*ORDER_FIELDS).iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+
+    while True:
+        chunk = list(islice(rows, settings.EXPORT_CHUNK_SIZE))
+        if not chunk:
+            return
+
+        # The details of the whole chunk with one query
+        details = {}
+        for order_id, *detail in OrderDetails.objects.filter(order_id__in=[row[0] for row in chunk])\
+                .order_by("order_id", "id")\
+                .values_list("order_id", "meal__name", "meal__price", "quantity", "sub_total"):
+            details.setdefault(order_id, []).append(detail)
+
+        for (order_id, created_at, status, address, total,
+             customer_first_name, customer_last_name, driver_first_name, driver_last_name) in chunk:
+            yield {
+                "id": order_id,
+                "created_at": timezone.localtime(created_at, tz),
+                "status": STATUS_NAMES.get(status, status),
+                "customer": _full_name(customer_first_name, customer_last_name),
+                "driver": _full_name(driver_first_name, driver_last_name),
+                "address": address,
+                "total": total,
+                "order_details": details.get(order_id, []),
+            }
+
+
+def _buffered(lines):
+    # Send EXPORT_BUFFER_SIZE characters at a time rather than a line at a time
+    buffer = []
+    size = 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= settings.EXPORT_BUFFER_SIZE:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+# A spreadsheet runs a cell starting with one of these as a formula
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _csv_cell(value):
+    # Names and addresses are typed by the customers, a leading ' makes them text
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _csv_lines(orders):
+    # csv.writer writes into a small buffer which is emptied after every order
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(CSV_HEADER)
+    for order in orders:
+        fields = [
+            order["id"], order["created_at"].isoformat(), order["status"],
+            order["customer"], order["driver"] or "", order["address"], order["total"],
+        ]
+        # One row per meal, an order without details still has its row
+        for detail in order["order_details"] or [("", "", "", "")]:
+            writer.writerow([_csv_cell(value) for value in fields + list(detail)])
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+
+
+def _ndjson_lines(orders):
+    for order in orders:
+        order["order_details"] = [
+            {"meal": meal, "price": price, "quantity": quantity, "sub_total": sub_total}
+            for meal, price, quantity, sub_total in order["order_details"]
+        ]
+        yield json.dumps(order, cls=DjangoJSONEncoder) + "\n"
+
+
+ExportFormat = namedtuple("ExportFormat", ("content_type", "extension", "lines"))
+
+# format ---> ExportFormat, lines turns the orders into lines of text
+EXPORT_FORMATS = {
+    "csv": ExportFormat("text/csv; charset=utf-8", "csv", _csv_lines),
+    "ndjson": ExportFormat("application/x-ndjson", "ndjson", _ndjson_lines),
+}
+
+
+def export_content(orders, export_format):
+    """
+      returns:
+        the export of the orders of export_orders(), a generator of text for a StreamingHttpResponse
+    """
+    return _buffered(EXPORT_FORMATS[export_format].lines(orders))
@@ -15,7 +15,7 @@ class UserForm(forms.ModelForm):
 class RestaurantForm(forms.ModelForm):
     class Meta:
         model = Restaurant
-        fields = ['name','phone', 'address','logo']
+        fields = ['name','phone', 'address', 'latitude', 'longitude', 'timezone', 'logo']
 
 
 class AccountForm(forms.ModelForm):
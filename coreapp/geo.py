@@ -0,0 +1,294 @@
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from coreapp.models import Order, Restaurant, Driver
+from coreapp.locations import location_buffer
+
+
+# LOCATIONS AND NEARBY READY ORDERS
+
+# Drivers send their location as "lat, long", it is kept as text in
+# Driver.location (the customer apps read it) and as coordinates in
+# Driver.latitude/longitude. Restaurants set their coordinates on the account page.
+#
+# ready_orders is an in-memory grid of the READY orders waiting for a driver,
+# placed at their restaurant. driver/order/nearby/ asks it for the nearest
+# orders around the driver, so a driver only gets the orders of the cells
+# around them instead of every ready order of every city.
+
+EARTH_RADIUS_KM = 6371.0088
+# Length of one degree of latitude (and of longitude at the equator)
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+class InvalidLocation(Exception):
+    pass
+
+
+def parse_location(location):
+    """
+      params:
+        1. location ---> "lat, long", eg. "37.77, -122.42"
+      returns:
+        (latitude, longitude)
+    """
+    try:
+        latitude, longitude = (float(part) for part in str(location).split(","))
+    except ValueError:
+        raise InvalidLocation("Location must look like lat, long, eg. 37.77, -122.42.")
+    # NaN fails these comparisons too
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise InvalidLocation("Location is out of range.")
+    return latitude, longitude
+
+
+def location_coordinates(location):
+    """
+    The coordinates of a location sent by a driver app.
+    Older apps may send something else than "lat, long", it is still kept as
+    the text the customers read, only without coordinates.
+      returns:
+        (latitude, longitude), or (None, None)
+    """
+    try:
+        return parse_location(location)
+    except InvalidLocation:
+        return None, None
+
+
+def distance_km(latitude1, longitude1, latitude2, longitude2):
+    # Haversine formula, the great-circle distance on a spherical earth
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(longitude2 - longitude1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1, math.sqrt(a)))
+
+
+def get_radius(request):
+    """
+    The `radius` param in km, NEARBY_RADIUS_KM by default and NEARBY_MAX_RADIUS_KM at most.
+    """
+    radius = settings.NEARBY_RADIUS_KM
+    try:
+        radius = float(request.GET.get("radius", radius))
+    except ValueError:
+        pass
+    if math.isnan(radius):
+        radius = settings.NEARBY_RADIUS_KM
+    return max(0, min(radius, settings.NEARBY_MAX_RADIUS_KM))
+
+
+class GridIndex:
+    """
+    Points in square cells of `cell_degrees`. A point has a key (eg. an order id)
+    and an optional group (eg. its restaurant id), so the points of a group can be moved together.
+    nearest() only reads the cells which overlap the search circle, its cost
+    depends on the points around the location and not on all the points.
+    Thread safe.
+    """
+    def __init__(self, cell_degrees):
+        self.cell_degrees = cell_degrees
+        self.columns = math.ceil(360 / cell_degrees)
+        self.lock = threading.Lock()
+        # (row, column) ---> {key: (latitude, longitude)}
+        self.cells = defaultdict(dict)
+        # key ---> (cell, group)
+        self.points = {}
+        # group ---> {keys}
+        self.groups = defaultdict(set)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cell(self, latitude, longitude):
+        # Columns wrap around at the antimeridian
+        return (
+            math.floor((latitude + 90) / self.cell_degrees),
+            math.floor((longitude + 180) / self.cell_degrees) % self.columns,
+        )
+
+    def _add(self, key, latitude, longitude, group):
+        self._remove(key)
+        cell = self._cell(latitude, longitude)
+        self.cells[cell][key] = (latitude, longitude)
+        self.points[key] = (cell, group)
+        if group is not None:
+            self.groups[group].add(key)
+
+    def _remove(self, key):
+        point = self.points.pop(key, None)
+        if point is None:
+            return False
+        cell, group = point
+        del self.cells[cell][key]
+        if not self.cells[cell]:
+            del self.cells[cell]
+        if group is not None:
+            self.groups[group].discard(key)
+            if not self.groups[group]:
+                del self.groups[group]
+        return True
+
+    def add(self, key, latitude, longitude, group=None):
+        with self.lock:
+            self._add(key, latitude, longitude, group)
+
+    def remove(self, key):
+        with self.lock:
+            return self._remove(key)
+
+    def move_group(self, group, latitude, longitude):
+        """
+        Moves every point of the group, or removes them when the latitude or longitude is None.
+        """
+        with self.lock:
+            for key in list(self.groups.get(group, ())):
+                self._remove(key)
+                if latitude is not None and longitude is not None:
+                    self._add(key, latitude, longitude, group)
+
+    def nearest(self, latitude, longitude, radius_km, k):
+        """
+          returns:
+            [(distance in km, key)] of the k nearest points within radius_km, nearest first
+        """
+        lat_span = radius_km / KM_PER_DEGREE
+        # A degree of longitude gets shorter away from the equator,
+        # take the widest part of the circle, the one nearest to a pole
+        cos = math.cos(math.radians(min(abs(latitude) + lat_span, 90)))
+        lng_span = radius_km / (KM_PER_DEGREE * cos) if cos > 1e-9 else 360
+
+        row, column = self._cell(latitude, longitude)
+        rows = math.ceil(lat_span / self.cell_degrees)
+        columns = min(math.ceil(lng_span / self.cell_degrees), self.columns // 2)
+        column_range = {c % self.columns for c in range(column - columns, column + columns + 1)}
+
+        candidates = []
+        with self.lock:
+            for r in range(row - rows, row + rows + 1):
+                for c in column_range:
+                    cell = self.cells.get((r, c))
+                    if cell:
+                        candidates.extend(cell.items())
+
+        # The distances are computed outside the lock
+        nearby = []
+        for key, (point_latitude, point_longitude) in candidates:
+            distance = distance_km(latitude, longitude, point_latitude, point_longitude)
+            if distance <= radius_km:
+                nearby.append((distance, key))
+        return heapq.nsmallest(k, nearby)
+
+
+class ReadyOrdersIndex:
+    """
+    The READY orders without a driver at the location of their restaurant.
+    Orders of restaurants without coordinates are left out.
+
+    Every process keeps its own index. It is updated when this process moves
+    an order (see coreapp.orders and coreapp.signals) and loaded again from the
+    database every READY_ORDERS_INDEX_TTL seconds, which picks up the orders
+    moved by the other workers. The orders it returns are read again from the
+    database, so an order claimed elsewhere in the meantime is never handed out.
+    """
+    def __init__(self):
+        self.grid = None
+        self.loaded_at = 0
+        # One load at a time
+        self.lock = threading.Lock()
+
+    def _expired(self):
+        return self.grid is None or time.monotonic() - self.loaded_at > settings.READY_ORDERS_INDEX_TTL
+
+    def get(self):
+        if self._expired():
+            with self.lock:
+                if self._expired():
+                    self.load()
+        return self.grid
+
+    def load(self):
+        grid = GridIndex(settings.GEO_CELL_DEGREES)
+        # Uses the order_unassigned_idx index
+        orders = Order.objects.filter(
+            status=Order.READY, driver=None,
+            restaurant__latitude__isnull=False, restaurant__longitude__isnull=False
+        ).values_list("id", "restaurant_id", "restaurant__latitude", "restaurant__longitude")
+        for order_id, restaurant_id, latitude, longitude in orders.iterator(chunk_size=2000):
+            grid.add(order_id, latitude, longitude, restaurant_id)
+        self.grid = grid
+        self.loaded_at = time.monotonic()
+
+    def clear(self):
+        self.grid = None
+
+    def add_orders(self, restaurant_id, order_ids):
+        # Before the first load there is nothing to update, the load reads them
+        grid = self.grid
+        if grid is None:
+            return
+        location = Restaurant.objects.filter(id=restaurant_id).values_list("latitude", "longitude").first()
+        if location is None or None in location:
+            return
+        for order_id in order_ids:
+            grid.add(order_id, location[0], location[1], restaurant_id)
+
+    def remove_orders(self, order_ids):
+        grid = self.grid
+        if grid is not None:
+            for order_id in order_ids:
+                grid.remove(order_id)
+
+    def move_restaurant(self, restaurant_id, latitude, longitude):
+        """
+        Called when the coordinates of a restaurant change.
+        """
+        grid = self.grid
+        if grid is None:
+            return
+        grid.move_group(restaurant_id, latitude, longitude)
+        if latitude is None or longitude is None:
+            return
+        # A restaurant which had no coordinates has no orders in the grid yet
+        order_ids = Order.objects.filter(restaurant_id=restaurant_id, status=Order.READY, driver=None)\
+            .values_list("id", flat=True)
+        for order_id in order_ids:
+            grid.add(order_id, latitude, longitude, restaurant_id)
+
+    def nearest(self, latitude, longitude, radius_km, k):
+        return self.get().nearest(latitude, longitude, radius_km, k)
+
+
+ready_orders = ReadyOrdersIndex()
+
+
+def nearby_ready_orders(driver_id, radius_km, k):
+    """
+      returns:
+        [(distance in km, order id)] of the ready orders around the last
+        location of the driver, nearest first, or None when the location is unknown
+    """
+    # A position received by this process is newer than the database
+    position = location_buffer.get(driver_id)
+    if position:
+        location = (position.latitude, position.longitude)
+    else:
+        location = Driver.objects.filter(id=driver_id).values_list("latitude", "longitude").first()
+    if location is None or None in location:
+        return None
+    return ready_orders.nearest(location[0], location[1], radius_km, k)
+
+
+def sort_nearby(nearby, orders):
+    """
+    Puts the orders, {id: Order} read back from the database, in the order of
+    nearby_ready_orders() and forgets the ids which are not ready anymore.
+      returns:
+        [(distance in km, Order)]
+    """
+    ready_orders.remove_orders([order_id for distance, order_id in nearby if order_id not in orders])
+    return [(distance, orders[order_id]) for distance, order_id in nearby if order_id in orders]
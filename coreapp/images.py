@@ -0,0 +1,81 @@
+from cloudinary import CloudinaryResource
+from django.conf import settings
+from coreapp.cache import LRUCache
+
+
+# CLOUDINARY IMAGE URLS
+
+# Building a Cloudinary url (and signing it) costs more than a dictionary
+# lookup, so urls are memoized by (resource type, upload type, public_id,
+# version, format, variant).
+# An uploaded image gets a new version, so a changed image never hits the url
+# of the old one. The old urls are dropped by invalidate_image() (see coreapp.signals).
+
+image_url_cache = LRUCache(maxsize=settings.IMAGE_URL_CACHE_SIZE, name="image_url")
+
+
+def _resource(image, field):
+    """
+    A CloudinaryField may still hold a string when the model was saved through
+    the ORM, its own field parses it, eg. Restaurant.logo.field.
+    """
+    if isinstance(image, CloudinaryResource):
+        return image
+    return field.to_python(image)
+
+
+def _key(image, variant):
+    return (image.resource_type, image.type, image.public_id, image.version, image.format, variant)
+
+
+def image_url(image, field, variant=None):
+    """
+      params:
+        1. image ---> the value of a CloudinaryField
+        2. field ---> that CloudinaryField, eg. Meal.image.field
+        3. variant ---> a key of CLOUDINARY_IMAGE_VARIANTS, or None for the original image
+      return:
+        the url of the image
+    """
+    if not image:
+        return None
+
+    image = _resource(image, field)
+    key = _key(image, variant)
+    url = image_url_cache.get(key)
+    if url is None:
+        if variant is None:
+            url = image.url
+        else:
+            # eg. https://res.cloudinary.com/<cloud>/image/upload/c_fill,h_200,w_200/v1/<public_id>.jpg
+            url = image.build_url(**settings.CLOUDINARY_IMAGE_VARIANTS[variant])
+        image_url_cache.set(key, url)
+    return url
+
+
+def image_variants(image, field):
+    """
+    returns:
+      {"thumbnail": url, "full": url, ...} for every CLOUDINARY_IMAGE_VARIANTS
+    """
+    if not image:
+        return None
+    return {variant: image_url(image, field, variant) for variant in settings.CLOUDINARY_IMAGE_VARIANTS}
+
+
+def invalidate_image(image, field):
+    if not image:
+        return
+    image = _resource(image, field)
+    for variant in [None, *settings.CLOUDINARY_IMAGE_VARIANTS]:
+        image_url_cache.delete(_key(image, variant))
+
+
+def absolute_url(request, url):
+    """
+    Cloudinary urls are already absolute, only relative ones go through build_absolute_uri().
+    Without a request the url is returned as it is.
+    """
+    if request is None or url is None or url.startswith(("http://", "https://")):
+        return url
+    return request.build_absolute_uri(url)
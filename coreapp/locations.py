@@ -0,0 +1,228 @@
+import atexit
+import logging
+import threading
+from collections import namedtuple
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+from coreapp.models import Driver
+
+logger = logging.getLogger(__name__)
+
+
+# WRITE-BEHIND DRIVER LOCATIONS
+
+# A driver app sends its location every few seconds. Instead of one UPDATE per
+# request, driver/location/update/ keeps the latest position of each driver
+# in this process, and a background thread writes the positions received
+# since the last write every LOCATION_FLUSH_INTERVAL seconds, with one
+# bulk_update of the location columns. Two positions of the same driver
+# in between are one row written.
+#
+# The customer APIs read a position from here only while it is not in the
+# database yet, so within this process they see a new position straight away,
+# and once it is written they read the database, where another worker may
+# have written a newer one. Another worker sees a position in the database at
+# most LOCATION_FLUSH_INTERVAL seconds later.
+# Every position is stamped with the time it was received (Driver.location_at),
+# a worker writing late never replaces a newer position written by another.
+# A position from the past, eg. the last point of an offline batch, carries the
+# time of the point and is written straight away, so it is known at once
+# whether a newer one is already saved.
+# The positions still waiting are written when the process exits, a killed
+# process loses them, the next position of the driver replaces them anyway.
+#
+# LOCATION_FLUSH_INTERVAL = 0 writes every position in the request instead.
+
+Position = namedtuple("Position", ("location", "latitude", "longitude", "received_at"))
+
+LOCATION_FIELDS = {
+    "location": "location",
+    "latitude": "latitude",
+    "longitude": "longitude",
+    "location_at": "received_at",
+}
+
+
+def _newer(position):
+    # The rows which hold an older position than this one, or none
+    return Q(location_at__isnull=True) | Q(location_at__lt=position.received_at)
+
+
+def _write(positions):
+    """
+    Writes {driver id: Position} with one UPDATE, each row only if its position is newer.
+        UPDATE driver SET location = CASE WHEN id=1 AND (location_at IS NULL OR location_at < ?) THEN ?
+                                          ... ELSE location END, ...
+        WHERE id IN (...)
+    """
+    columns = {}
+    for column, attribute in LOCATION_FIELDS.items():
+        field = Driver._meta.get_field(column)
+        columns[column] = Case(
+            *[
+                When(Q(id=driver_id) & _newer(position), then=Value(getattr(position, attribute), output_field=field))
+                for driver_id, position in positions.items()
+            ],
+            default=F(column),
+            output_field=field,
+        )
+    Driver.objects.filter(id__in=positions).update(**columns)
+
+
+class LocationBuffer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # driver id ---> Position not written to the database yet
+        self.pending = {}
+        # driver id ---> Position being written by flush()
+        self.writing = {}
+        # Set to write before the interval is over
+        self.wake = threading.Event()
+        self.thread = None
+
+    def put(self, driver_id, position):
+        """
+          returns:
+            False when a newer Position of the driver is waiting, this one is dropped
+        """
+        with self.lock:
+            buffered = self.pending.get(driver_id) or self.writing.get(driver_id)
+            if buffered and buffered.received_at >= position.received_at:
+                return False
+            self.pending[driver_id] = position
+            full = len(self.pending) >= settings.LOCATION_FLUSH_SIZE
+            if self.thread is None:
+                self._start()
+        if full:
+            self.wake.set()
+        return True
+
+    def get(self, driver_id):
+        """
+          returns:
+            the latest Position of the driver received by this process which
+            is not in the database yet, or None
+        """
+        with self.lock:
+            return self.pending.get(driver_id) or self.writing.get(driver_id)
+
+    def flush(self):
+        """
+        Writes the pending positions, LOCATION_FLUSH_SIZE drivers per UPDATE.
+          returns:
+            the number of drivers written
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.writing = pending
+        if not pending:
+            return 0
+
+        driver_ids = list(pending)
+        try:
+            for start in range(0, len(driver_ids), settings.LOCATION_FLUSH_SIZE):
+                _write({driver_id: pending[driver_id] for driver_id in driver_ids[start:start + settings.LOCATION_FLUSH_SIZE]})
+        except Exception:
+            # Try again next time, unless a newer position has come in
+            with self.lock:
+                for driver_id, position in pending.items():
+                    self.pending.setdefault(driver_id, position)
+            raise
+        finally:
+            with self.lock:
+                self.writing = {}
+        return len(pending)
+
+    def discard_older(self, driver_id, position):
+        # `position` was written to the database, an older one waiting here must not hide it
+        with self.lock:
+            for positions in (self.pending, self.writing):
+                if driver_id in positions and positions[driver_id].received_at < position.received_at:
+                    del positions[driver_id]
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+            self.writing = {}
+
+    def _start(self):
+        self.thread = threading.Thread(target=self._run, name="location-flush", daemon=True)
+        self.thread.start()
+        atexit.register(self._flush_at_exit)
+
+    def _run(self):
+        while True:
+            self.wake.wait(settings.LOCATION_FLUSH_INTERVAL)
+            self.wake.clear()
+            # This thread keeps its own connection, drop it when it is too old or broken
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not write the driver locations")
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Could not write the driver locations at exit")
+
+
+location_buffer = LocationBuffer()
+
+
+def _update_now(driver_id, position):
+    return Driver.objects.filter(_newer(position), id=driver_id), {
+        column: getattr(position, attribute) for column, attribute in LOCATION_FIELDS.items()
+    }
+
+
+def _buffered_is_newer(driver_id, position):
+    buffered = location_buffer.get(driver_id)
+    return buffered is not None and buffered.received_at >= position.received_at
+
+
+def save_location(driver_id, location, latitude, longitude, received_at=None):
+    """
+      params:
+        5. received_at (optional) ---> when the driver was there, now by default
+      returns:
+        True if it is the newest position of the driver, False if a newer one
+        is already known and nothing was saved
+    """
+    position = Position(location, latitude, longitude, received_at or timezone.now())
+    if settings.LOCATION_FLUSH_INTERVAL and received_at is None:
+        return location_buffer.put(driver_id, position)
+
+    if _buffered_is_newer(driver_id, position):
+        return False
+    driver, values = _update_now(driver_id, position)
+    if not driver.update(**values):
+        return False
+    location_buffer.discard_older(driver_id, position)
+    return True
+
+
+async def asave_location(driver_id, location, latitude, longitude, received_at=None):
+    # Buffering does not touch the database, there is nothing to await
+    position = Position(location, latitude, longitude, received_at or timezone.now())
+    if settings.LOCATION_FLUSH_INTERVAL and received_at is None:
+        return location_buffer.put(driver_id, position)
+
+    if _buffered_is_newer(driver_id, position):
+        return False
+    driver, values = _update_now(driver_id, position)
+    if not await driver.aupdate(**values):
+        return False
+    location_buffer.discard_older(driver_id, position)
+    return True
+
+
+def current_location(driver):
+    """
+    The latest location of a Driver loaded from the database, "lat, long".
+    """
+    position = location_buffer.get(driver.id)
+    return position.location if position else driver.location
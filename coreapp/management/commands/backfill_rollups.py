@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from coreapp.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the report rollups (daily revenue, top meals, top drivers) from the delivered orders."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Rows per INSERT.")
+
+    def handle(self, *args, **options):
+        counts = rebuild_rollups(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(
+            "Rebuilt %(days)s daily, %(meals)s meal and %(drivers)s driver rollups." % counts
+        ))
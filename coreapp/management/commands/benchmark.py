@@ -0,0 +1,48 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from coreapp.benchmark import run_benchmark, compare, BenchmarkError
+
+
+class Command(BaseCommand):
+    help = (
+        "Requests every route of coreapp/urls.py through the test client and reports "
+        "latency percentiles, query count and response size per route. Run seed_data first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=50, help="Measured requests per route.")
+        parser.add_argument("--warmup", type=int, default=5, help="Requests per route before measuring.")
+        parser.add_argument("--route", action="append", help='Only this route, eg. "driver/order/ready/", can be repeated.')
+        parser.add_argument("--output", help="Write the results as JSON to this file.")
+        parser.add_argument("--baseline", help="JSON results of an earlier run to compare with.")
+        parser.add_argument("--threshold", type=float, default=20, help="Percent of p95 growth reported as a regression.")
+        parser.add_argument("--fail-on-regression", action="store_true", help="Exit with an error when a route regressed.")
+
+    def handle(self, *args, **options):
+        try:
+            results = run_benchmark(options["iterations"], options["warmup"], options["route"])
+        except BenchmarkError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write("%-52s %6s %6s %9s %9s %9s %7s %9s" % (
+            "route", "method", "status", "p50 ms", "p95 ms", "p99 ms", "queries", "bytes"
+        ))
+        for route, result in results["routes"].items():
+            self.stdout.write("%-52s %6s %6s %9s %9s %9s %7s %9s" % (
+                route or "/", result["method"], result["status"], result["p50_ms"], result["p95_ms"],
+                result["p99_ms"], result["queries"], result["bytes"]
+            ))
+        for route in results["skipped"]:
+            self.stdout.write(self.style.WARNING("No benchmark request for %r, add it to coreapp.benchmark.ROUTES." % route))
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                regressions = compare(results, json.load(f), options["threshold"])
+            for route, message in regressions:
+                self.stdout.write(self.style.ERROR("Regression %s: %s" % (route or "/", message)))
+            if regressions and options["fail_on_regression"]:
+                raise CommandError("%s regressions." % len(regressions))
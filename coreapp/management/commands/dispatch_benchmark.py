@@ -0,0 +1,62 @@
+import json
+import time
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from coreapp.benchmark import percentile
+from coreapp.dispatch import assign, SOLVER
+from coreapp.seed import CENTER, SPREAD
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the dispatch solver (see coreapp.dispatch) on random orders and drivers "
+        "around the seed_data city, without the database, eg.\n"
+        "  manage.py dispatch_benchmark --orders 3000 --drivers 3000"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--orders", type=int, action="append", help="Ready orders, can be repeated. 1000, 3000 and 5000 by default.")
+        parser.add_argument("--drivers", type=int, help="Idle drivers, as many as the orders by default.")
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per size.")
+        parser.add_argument("--max-km", type=float, help="DISPATCH_MAX_KM by default.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options["seed"])
+        max_km = options["max_km"] or settings.DISPATCH_MAX_KM
+
+        def positions(count):
+            return np.column_stack((
+                CENTER[0] + rng.uniform(-SPREAD, SPREAD, count),
+                CENTER[1] + rng.uniform(-SPREAD, SPREAD, count),
+            ))
+
+        self.stdout.write("solver: %s" % SOLVER)
+        self.stdout.write("%8s %8s %10s %10s %9s %11s" % ("orders", "drivers", "p50 ms", "max ms", "assigned", "mean km"))
+        results = []
+        for orders in options["orders"] or [1000, 3000, 5000]:
+            drivers = options["drivers"] or orders
+            timings = []
+            for i in range(options["repeat"]):
+                order_positions, driver_positions = positions(orders), positions(drivers)
+                started = time.perf_counter()
+                pairs = assign(order_positions, driver_positions, max_km)
+                timings.append(time.perf_counter() - started)
+
+            timings.sort()
+            result = {
+                "orders": orders,
+                "drivers": drivers,
+                "p50_ms": round(percentile(timings, 50) * 1000, 1),
+                "max_ms": round(timings[-1] * 1000, 1),
+                "assigned": len(pairs),
+                "mean_km": round(sum(distance for order, driver, distance in pairs) / len(pairs), 3) if pairs else None,
+            }
+            results.append(result)
+            self.stdout.write("%(orders)8s %(drivers)8s %(p50_ms)10s %(max_ms)10s %(assigned)9s %(mean_km)11s" % result)
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump({"solver": SOLVER, "max_km": max_km, "results": results}, f, indent=2)
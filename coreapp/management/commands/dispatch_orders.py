@@ -0,0 +1,37 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from coreapp.dispatch import dispatch_orders
+
+
+class Command(BaseCommand):
+    help = (
+        "Assigns the ready orders to the idle drivers (see coreapp.dispatch), once or "
+        "every --interval seconds. Run one of them, with DISPATCH_MODE = True."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval", type=float, default=None,
+            help="Seconds between two dispatches, DISPATCH_INTERVAL by default. 0 dispatches once."
+        )
+        parser.add_argument("--max-km", type=float, help="Longest distance to a driver, DISPATCH_MAX_KM by default.")
+
+    def handle(self, *args, **options):
+        if not settings.DISPATCH_MODE:
+            raise CommandError("DISPATCH_MODE is off, the drivers pick the orders themselves.")
+
+        interval = settings.DISPATCH_INTERVAL if options["interval"] is None else options["interval"]
+        try:
+            while True:
+                started = time.monotonic()
+                result = dispatch_orders(options["max_km"])
+                self.stdout.write("%s: %s of %s orders assigned to %s idle drivers, solved in %.1f ms (%s)" % (
+                    time.strftime("%H:%M:%S"), len(result["assigned"]), result["orders"], result["drivers"],
+                    result["solve_seconds"] * 1000, result["solver"]
+                ))
+                if not interval:
+                    break
+                time.sleep(max(0, interval - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+from http.client import HTTPConnection, HTTPSConnection
+from urllib.parse import urlsplit
+from django.core.management.base import BaseCommand, CommandError
+from coreapp.benchmark import percentile
+
+
+# Paths requested when no --path is given, the read APIs of the mobile apps.
+# {token} is replaced by --access-token. A path starting with "POST " is
+# posted, its query string is sent as the form body, eg. checkout against
+# PAYMENT_GATEWAY = 'fake':
+#   --path "POST /api/customer/payment_intent/?access_token={token}&total=12"
+DEFAULT_PATHS = [
+    "/api/customer/restaurants/",
+    "/api/customer/order/latest/?access_token={token}",
+    "/api/customer/order/latest_status/?access_token={token}",
+    "/api/driver/order/ready/",
+]
+
+
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+def parse_path(path):
+    """
+      returns:
+        (method, path, body)
+    """
+    if path.startswith("POST "):
+        path, sep, body = path[len("POST "):].partition("?")
+        return "POST", path, body.encode()
+    return "GET", path, None
+
+
+def run_load(base_url, paths, concurrency, duration):
+    """
+    Requests `paths` in turn from `concurrency` threads for `duration` seconds.
+    Each thread keeps one connection open, like a client behind a load balancer.
+      returns:
+        {"requests", "errors", "rps", "p50_ms", "p99_ms"}
+    """
+    url = urlsplit(base_url)
+    connection_class = HTTPSConnection if url.scheme == "https" else HTTPConnection
+    prefix = url.path.rstrip("/")
+
+    timings = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(offset):
+        connection = connection_class(url.netloc, timeout=30)
+        own_timings = []
+        own_errors = 0
+        i = offset
+        while time.monotonic() < deadline:
+            method, path, body = paths[i % len(paths)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                connection.request(method, prefix + path, body=body, headers=FORM_HEADERS if body else {})
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 400:
+                    own_errors += 1
+            except OSError:
+                own_errors += 1
+                connection.close()
+                connection = connection_class(url.netloc, timeout=30)
+                continue
+            own_timings.append(time.perf_counter() - started)
+        connection.close()
+
+        with lock:
+            timings.extend(own_timings)
+            errors[0] += own_errors
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    timings.sort()
+    return {
+        "requests": len(timings),
+        "errors": errors[0],
+        "rps": round(len(timings) / elapsed, 1),
+        "p50_ms": round(percentile(timings, 50) * 1000, 2) if timings else None,
+        "p99_ms": round(percentile(timings, 99) * 1000, 2) if timings else None,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends concurrent requests to running deployments and compares requests "
+        "per second and p99 latency, eg. gunicorn (WSGI) against uvicorn (ASGI, ASYNC_APIS = True):\n"
+        "  manage.py loadtest --target wsgi=http://127.0.0.1:8000 --target asgi=http://127.0.0.1:8001"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--target", action="append", required=True,
+            help="name=base url of a running server, can be repeated."
+        )
+        parser.add_argument("--path", action="append", help='Path to request, "POST /path/?body" to post, can be repeated.')
+        parser.add_argument("--access-token", default="", help="Replaces {token} in the paths.")
+        parser.add_argument("--concurrency", type=int, default=32, help="Concurrent clients.")
+        parser.add_argument("--duration", type=float, default=10, help="Seconds per target.")
+        parser.add_argument("--output", help="Write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        targets = []
+        for target in options["target"]:
+            name, sep, base_url = target.partition("=")
+            if not sep or not base_url.startswith(("http://", "https://")):
+                raise CommandError("--target must look like wsgi=http://127.0.0.1:8000")
+            targets.append((name, base_url))
+
+        paths = [
+            parse_path(path.replace("{token}", options["access_token"]))
+            for path in options["path"] or DEFAULT_PATHS
+        ]
+
+        results = {}
+        for name, base_url in targets:
+            self.stdout.write("Loading %s (%s) for %ss..." % (name, base_url, options["duration"]))
+            results[name] = run_load(base_url, paths, options["concurrency"], options["duration"])
+
+        self.stdout.write("%-10s %10s %8s %10s %10s %10s" % ("target", "requests", "errors", "rps", "p50 ms", "p99 ms"))
+        for name, result in results.items():
+            self.stdout.write("%-10s %10s %8s %10s %10s %10s" % (
+                name, result["requests"], result["errors"], result["rps"], result["p50_ms"], result["p99_ms"]
+            ))
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump({
+                    "paths": [" ".join((method, path)) for method, path, body in paths],
+                    "concurrency": options["concurrency"],
+                    "duration": options["duration"],
+                    "results": results,
+                }, f, indent=2)
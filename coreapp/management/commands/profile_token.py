@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from coreapp.profiling import make_profile_token
+
+
+class Command(BaseCommand):
+    help = "Prints a token which turns on profiling for one request to a path, send it in the X-Profile header."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Path of the request to profile, eg. /api/driver/order/ready/")
+
+    def handle(self, *args, **options):
+        self.stdout.write(make_profile_token(options["path"]))
+        self.stderr.write("Valid once for %s seconds, eg.\n  curl -H 'X-Profile: <token>' http://127.0.0.1:8000%s"
+                          % (settings.PROFILE_TOKEN_MAX_AGE, options["path"]))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from coreapp.seed import seed_data, SeedError, SEED_PASSWORD
+
+
+class Command(BaseCommand):
+    help = "Fills the database with restaurants, meals, customers, drivers and orders in every status."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--restaurants", type=int, default=20)
+        parser.add_argument("--meals", type=int, default=10, help="Meals per restaurant.")
+        parser.add_argument("--customers", type=int, default=500)
+        parser.add_argument("--drivers", type=int, default=50)
+        parser.add_argument("--orders", type=int, default=10000)
+        parser.add_argument("--days", type=int, default=90, help="Delivered orders are spread over this many days.")
+        parser.add_argument("--seed", type=int, default=0, help="The same seed creates the same data.")
+        parser.add_argument("--prefix", default="seed", help="Prefix of the usernames.")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Rows per INSERT.")
+
+    def handle(self, *args, **options):
+        try:
+            counts = seed_data(
+                restaurants=options["restaurants"],
+                meals=options["meals"],
+                customers=options["customers"],
+                drivers=options["drivers"],
+                orders=options["orders"],
+                days=options["days"],
+                seed=options["seed"],
+                prefix=options["prefix"],
+                batch_size=options["batch_size"],
+            )
+        except SeedError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            "Created %(restaurants)s restaurants, %(meals)s meals, %(customers)s customers, "
+            "%(drivers)s drivers, %(orders)s orders and %(order_details)s order details." % counts
+        ))
+        self.stdout.write("Sign in as %s-restaurant-0 with the password %r." % (options["prefix"], SEED_PASSWORD))
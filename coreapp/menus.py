@@ -0,0 +1,103 @@
+import hashlib
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from coreapp.models import Restaurant, Meal
+from coreapp.serializers import MealSerializer
+
+
+# MENU SNAPSHOTS
+
+# The JSON body of customer_get_meals is rendered once per menu change and
+# kept in the cache, so reading a menu is one cache lookup and no ORM work.
+# Two kinds of keys are stored per restaurant:
+#   - "menu-version:<id>" ---> the menu_version of the restaurant, set by
+#     set_menu_version() whenever a meal changes (see coreapp.signals)
+#   - "menu:<id>:<site>" ---> (menu_version, etag, body bytes), one per site
+#     because the image urls are absolute
+# Both are read with one get_many(). A snapshot which is not of the current
+# menu version is never served, it is built again from the database, so a
+# snapshot built while a meal was being edited can not hide the edit, and
+# two edits at the same time can not lose one another.
+
+def _version_key(restaurant_id):
+    return "menu-version:%s" % restaurant_id
+
+def _body_key(restaurant_id, site):
+    return "menu:%s:%s" % (restaurant_id, hashlib.sha1(site.encode()).hexdigest()[:16])
+
+def _site(request):
+    return request.build_absolute_uri("/")
+
+
+def _current(values, restaurant_id, body_key):
+    # The snapshot if it is of the current menu version, or None
+    snapshot = values.get(body_key)
+    if snapshot is None or snapshot[0] != values.get(_version_key(restaurant_id)):
+        return None
+    menu_version, etag, body = snapshot
+    return etag, body
+
+
+def build_menu_snapshot(request, restaurant_id):
+    """
+    Serializes the whole menu of a restaurant.
+    returns:
+      (etag, body) or None if the restaurant does not exist
+    """
+    menu_version = Restaurant.objects.filter(id=restaurant_id).values_list("menu_version", flat=True).first()
+    if menu_version is None:
+        return None
+
+    site = _site(request)
+    meals = MealSerializer(
+        Meal.objects.filter(restaurant_id=restaurant_id).order_by("-id"),
+        many=True,
+        context={"request": request}
+    ).data
+    body = json.dumps({"meals": meals}, cls=DjangoJSONEncoder).encode()
+    etag = hashlib.sha1(("%s|%s|%s" % (restaurant_id, menu_version, site)).encode()).hexdigest()
+
+    # add() leaves a newer version set by a meal edited in the meantime,
+    # this snapshot is then stale and built again on the next read
+    cache.add(_version_key(restaurant_id), menu_version, settings.MENU_SNAPSHOT_TIMEOUT)
+    cache.set(_body_key(restaurant_id, site), (menu_version, etag, body), settings.MENU_SNAPSHOT_TIMEOUT)
+    return etag, body
+
+
+def get_menu_snapshot(request, restaurant_id):
+    """
+    returns:
+      (etag, body) or None if the restaurant does not exist
+    """
+    body_key = _body_key(restaurant_id, _site(request))
+    snapshot = _current(cache.get_many([_version_key(restaurant_id), body_key]), restaurant_id, body_key)
+    if snapshot is None:
+        snapshot = build_menu_snapshot(request, restaurant_id)
+    return snapshot
+
+
+async def aget_menu_snapshot(request, restaurant_id):
+    """
+    get_menu_snapshot() for async views.
+    Only a menu which is not cached leaves the event loop to be built.
+    """
+    body_key = _body_key(restaurant_id, _site(request))
+    snapshot = _current(await cache.aget_many([_version_key(restaurant_id), body_key]), restaurant_id, body_key)
+    if snapshot is None:
+        snapshot = await sync_to_async(build_menu_snapshot)(request, restaurant_id)
+    return snapshot
+
+
+def set_menu_version(restaurant_id, menu_version):
+    """
+    Makes the cached snapshots of the restaurant older than menu_version stale.
+    """
+    cache.set(_version_key(restaurant_id), menu_version, settings.MENU_SNAPSHOT_TIMEOUT)
+
+
+def drop_menu_snapshot(restaurant_id):
+    # Without a version every snapshot of the restaurant is stale
+    cache.delete(_version_key(restaurant_id))
@@ -0,0 +1,287 @@
+import hmac
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from coreapp.cache import caches
+
+
+# REQUEST METRICS
+
+# MetricsMiddleware measures a sample of the requests (METRICS_SAMPLE_RATE)
+# and adds them to histograms per view, which metrics_view exposes in the
+# Prometheus text format. Every process keeps its own histograms, so scrape
+# every worker, eg. one per gunicorn/uvicorn worker port.
+#
+# Per measured request:
+#   - db_queries, db_seconds ---> counted by record_query(), a database
+#     execute wrapper installed on every connection (see coreapp.signals)
+#   - view_seconds ---> the time spent inside the middleware, it is the last
+#     one in MIDDLEWARE so that is the view
+#   - serialization_seconds ---> the blocks timed with serialization_timer()
+#   - response_bytes
+# The hits, misses and size of the in-process caches of coreapp.cache are
+# exported with them.
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# name ---> (help text, buckets)
+METRICS = {
+    "db_queries": ("Database queries per request.", QUERY_BUCKETS),
+    "db_seconds": ("Time spent in database queries per request.", DURATION_BUCKETS),
+    "view_seconds": ("Time spent in the view per request.", DURATION_BUCKETS),
+    "serialization_seconds": ("Time spent serializing the response data per request.", DURATION_BUCKETS),
+    "response_bytes": ("Size of the response body.", BYTES_BUCKETS),
+}
+
+METRIC_PREFIX = "foodtasker_request_"
+
+# stats() key ---> (metric name, type, help text)
+CACHE_METRICS = {
+    "hits": ("foodtasker_cache_hits_total", "counter", "Lookups which found a fresh entry."),
+    "misses": ("foodtasker_cache_misses_total", "counter", "Lookups which found nothing or an expired entry."),
+    "size": ("foodtasker_cache_entries", "gauge", "Entries held."),
+}
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket. A bucket counts the values less than
+    or equal to its bound, the last one (+Inf) counts the rest.
+    Not thread safe on its own, Registry holds a lock.
+    """
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield bound, total
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (metric name, view name) ---> Histogram
+        self.histograms = {}
+
+    def observe(self, view, values):
+        """
+        Adds the values of one request, {metric name: value}, under one lock.
+        """
+        with self.lock:
+            for name, value in values.items():
+                histogram = self.histograms.get((name, view))
+                if histogram is None:
+                    histogram = self.histograms[(name, view)] = Histogram(METRICS[name][1])
+                histogram.observe(value)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self):
+        """
+        The histograms in the Prometheus text exposition format.
+        """
+        with self.lock:
+            snapshot = {
+                key: (list(histogram.cumulative()), histogram.sum, histogram.count)
+                for key, histogram in self.histograms.items()
+            }
+
+        lines = []
+        for name, (help_text, buckets) in METRICS.items():
+            metric = METRIC_PREFIX + name
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s histogram" % metric)
+            for (metric_name, view), (cumulative, total, count) in sorted(snapshot.items()):
+                if metric_name != name:
+                    continue
+                label = 'view="%s"' % _escape(view)
+                for bound, value in cumulative:
+                    lines.append('%s_bucket{%s,le="%s"} %s' % (metric, label, bound, value))
+                lines.append("%s_sum{%s} %s" % (metric, label, round(total, 6)))
+                lines.append("%s_count{%s} %s" % (metric, label, count))
+        return "\n".join(lines) + "\n"
+
+
+def render_caches():
+    """
+    The stats of the named LRUCaches in the Prometheus text exposition format.
+    """
+    stats = {name: cache.stats() for name, cache in sorted(caches.items())}
+    lines = []
+    for key, (metric, metric_type, help_text) in CACHE_METRICS.items():
+        lines.append("# HELP %s %s" % (metric, help_text))
+        lines.append("# TYPE %s %s" % (metric, metric_type))
+        for name, values in stats.items():
+            lines.append('%s{cache="%s"} %s' % (metric, _escape(name), values[key]))
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_time", "serialization_time")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0
+        self.serialization_time = 0
+
+
+# The stats of the request being measured. A context variable follows the
+# request into the threads of sync_to_async(), so the queries of async views count too.
+_current = ContextVar("request_stats", default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper, see connection.execute_wrappers.
+    Outside a measured request it only reads a context variable.
+    """
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - started
+
+
+def install_query_recorder(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def serialization_timer():
+    """
+    Adds the time of the block to the serialization time of the measured request.
+    eg.
+        with serialization_timer():
+            orders = OrderSerializer(page, many=True).data
+    """
+    stats = _current.get()
+    if stats is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.serialization_time += time.perf_counter() - started
+
+
+class MetricsMiddleware:
+    """
+    Measures METRICS_SAMPLE_RATE of the requests, see the top of this file.
+    With METRICS_SERVER_TIMING the measurements are also sent in a
+    Server-Timing header, browsers show it in their network panel.
+    Works with sync and async views.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        if random.random() >= settings.METRICS_SAMPLE_RATE:
+            return self.get_response(request)
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        if random.random() >= settings.METRICS_SAMPLE_RATE:
+            return await self.get_response(request)
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, stats, time.perf_counter() - started)
+
+    def finish(self, request, response, stats, view_time):
+        resolver_match = getattr(request, "resolver_match", None)
+        view = resolver_match.view_name if resolver_match else "unresolved"
+
+        values = {
+            "db_queries": stats.queries,
+            "db_seconds": stats.db_time,
+            "view_seconds": view_time,
+            "serialization_seconds": stats.serialization_time,
+        }
+        # The size of a stream is not known until it has been sent
+        if not response.streaming:
+            values["response_bytes"] = len(response.content)
+        registry.observe(view, values)
+
+        if settings.METRICS_SERVER_TIMING:
+            response["Server-Timing"] = 'db;dur=%.2f;desc="%s queries", view;dur=%.2f, serialization;dur=%.2f' % (
+                stats.db_time * 1000, stats.queries, view_time * 1000, stats.serialization_time * 1000
+            )
+        return response
+
+
+def has_metrics_token(request):
+    # "Authorization: Bearer <METRICS_TOKEN>", no token set lets nobody in this way
+    if not settings.METRICS_TOKEN:
+        return False
+    expected = "Bearer " + settings.METRICS_TOKEN
+    return hmac.compare_digest(request.META.get("HTTP_AUTHORIZATION", ""), expected)
+
+
+def metrics_view(request):
+    # Scraped by Prometheus with METRICS_TOKEN (or from METRICS_ALLOWED_IPS), staff can look too
+    allowed = (
+        has_metrics_token(request)
+        or request.user.is_staff
+        or request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS
+    )
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render() + render_caches(), content_type="text/plain; version=0.0.4; charset=utf-8")
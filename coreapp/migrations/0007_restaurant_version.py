@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:56
+
+import coreapp.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coreapp', '0006_orderdetails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restaurant',
+            name='menu_version',
+            field=models.BigIntegerField(default=coreapp.models.new_version, editable=False),
+        ),
+        migrations.AddField(
+            model_name='restaurant',
+            name='version',
+            field=models.BigIntegerField(default=coreapp.models.new_version, editable=False),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coreapp', '0007_restaurant_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RestaurantDriverStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('deliveries', models.IntegerField(default=0)),
+                ('driver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='coreapp.driver')),
+                ('restaurant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='driver_stats', to='coreapp.restaurant')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RestaurantDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('revenue', models.IntegerField(default=0)),
+                ('orders', models.IntegerField(default=0)),
+                ('restaurant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='coreapp.restaurant')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RestaurantMealStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(default=0)),
+                ('meal', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='coreapp.meal')),
+                ('restaurant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='meal_stats', to='coreapp.restaurant')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['restaurant', '-quantity'], name='meal_stats_top_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='restaurantmealstats',
+            constraint=models.UniqueConstraint(fields=('restaurant', 'meal'), name='unique_restaurant_meal_stats'),
+        ),
+        migrations.AddIndex(
+            model_name='restaurantdriverstats',
+            index=models.Index(fields=['restaurant', '-deliveries'], name='driver_stats_top_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='restaurantdriverstats',
+            constraint=models.UniqueConstraint(fields=('restaurant', 'driver'), name='unique_restaurant_driver_stats'),
+        ),
+        migrations.AddConstraint(
+            model_name='restaurantdailystats',
+            constraint=models.UniqueConstraint(fields=('restaurant', 'date'), name='unique_restaurant_daily_stats'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:17
+
+import django.core.validators
+from django.db import migrations, models
+
+
+def parse_driver_locations(apps, schema_editor):
+    # The locations sent so far, "lat, long", into the new columns
+    Driver = apps.get_model('coreapp', 'Driver')
+    drivers = []
+    for driver in Driver.objects.exclude(location='').only('id', 'location'):
+        try:
+            latitude, longitude = (float(part) for part in driver.location.split(','))
+        except ValueError:
+            continue
+        if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+            driver.latitude, driver.longitude = latitude, longitude
+            drivers.append(driver)
+    Driver.objects.bulk_update(drivers, ['latitude', 'longitude'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coreapp', '0009_order_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driver',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)]),
+        ),
+        migrations.AddField(
+            model_name='driver',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)]),
+        ),
+        migrations.AddField(
+            model_name='restaurant',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-90), django.core.validators.MaxValueValidator(90)]),
+        ),
+        migrations.AddField(
+            model_name='restaurant',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(-180), django.core.validators.MaxValueValidator(180)]),
+        ),
+        migrations.RunPython(parse_driver_locations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coreapp', '0010_location_coordinates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrajectorySegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField()),
+                ('points', models.IntegerField()),
+                ('coordinates', models.BinaryField()),
+                ('deltas', models.BinaryField()),
+                ('driver', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='coreapp.driver')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trajectory', to='coreapp.order')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['order', 'started_at'], name='trajectory_order_idx')],
+            },
+        ),
+    ]
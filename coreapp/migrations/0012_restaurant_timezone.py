@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:01
+
+import coreapp.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coreapp', '0011_trajectory_segments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='restaurant',
+            name='timezone',
+            field=models.CharField(default=coreapp.models.default_timezone, max_length=63, validators=[coreapp.models.validate_timezone]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coreapp', '0012_restaurant_timezone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driver',
+            name='location_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
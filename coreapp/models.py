@@ -1,7 +1,36 @@
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from django.db import models
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator, MaxValueValidator
 from cloudinary.models import CloudinaryField
 from django.utils import timezone
+import time
+
+
+def new_version():
+    """
+    A new version stamp: the current time in microseconds.
+    """
+    return time.time_ns() // 1000
+
+
+def latitude_field():
+    return models.FloatField(null=True, blank=True, validators=[MinValueValidator(-90), MaxValueValidator(90)])
+
+def longitude_field():
+    return models.FloatField(null=True, blank=True, validators=[MinValueValidator(-180), MaxValueValidator(180)])
+
+
+def default_timezone():
+    return settings.TIME_ZONE
+
+def validate_timezone(value):
+    try:
+        ZoneInfo(value)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValidationError("%(value)s is not a timezone, eg. Asia/Kolkata.", params={"value": value})
 
 # Create your models here.
 class Restaurant(models.Model):
@@ -10,6 +39,17 @@ class Restaurant(models.Model):
     phone = models.CharField(max_length=255)
     address = models.CharField(max_length=255)
     logo = CloudinaryField('image')
+    # Where the drivers pick the orders up, see coreapp.geo
+    latitude = latitude_field()
+    longitude = longitude_field()
+    # IANA name, eg. "Asia/Kolkata". The days of the report rollups are the restaurant's local days,
+    # run `python manage.py backfill_rollups` after changing it.
+    timezone = models.CharField(max_length=63, default=default_timezone, validators=[validate_timezone])
+    # Version stamps used as ETags by the customer APIs.
+    # version changes when the restaurant changes, menu_version when one of its meals changes.
+    # They are set in coreapp.signals
+    version = models.BigIntegerField(default=new_version, editable=False)
+    menu_version = models.BigIntegerField(default=new_version, editable=False)
 
     def __str__(self) -> str:
         return self.name
@@ -40,6 +80,11 @@ class Driver(models.Model):
     car_model = models.CharField(max_length=255, blank=True)
     plate_number = models.CharField(max_length=255, blank=True)
     location = models.CharField(max_length=255, blank=True)
+    # The last location parsed into coordinates, set together with `location`
+    latitude = latitude_field()
+    longitude = longitude_field()
+    # When the driver app sent that location, an older one is never written over it
+    location_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return self.user.first_name
@@ -66,6 +111,23 @@ class Order(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     picked_at = models.DateTimeField(blank=True,null=True)
 
+    class Meta:
+        # One index per filter of coreapp/apis.py and coreapp/views.py.
+        # OrderDetails(order) and OrderDetails(meal) are covered by the foreign key indexes.
+        # coreapp.tests.QueryPlanTest checks that no endpoint scans the whole table.
+        indexes = [
+            # Latest order / outstanding order of a customer
+            models.Index(fields=['customer', 'status'], name='order_customer_status_idx'),
+            # Current order of a driver, and its revenue over a created_at range
+            models.Index(fields=['driver', 'status', 'created_at'], name='order_driver_status_idx'),
+            # Ready orders waiting for a driver, newest first
+            models.Index(fields=['status', '-id'], name='order_unassigned_idx', condition=models.Q(driver__isnull=True)),
+            # New order notifications of a restaurant
+            models.Index(fields=['restaurant', 'created_at'], name='order_restaurant_created_idx'),
+            # Order board of a restaurant, by status
+            models.Index(fields=['restaurant', 'status'], name='order_restaurant_status_idx'),
+        ]
+
     def __str__(self):
         return str(self.id)
 
@@ -76,4 +138,83 @@ class OrderDetails(models.Model):
     sub_total = models.IntegerField()
 
     def __str__(self):
-        return str(self.id)
\ No newline at end of file
+        return str(self.id)
+
+# DELIVERY TRAJECTORIES
+
+# The route of a delivery, uploaded in batches by the driver app (see coreapp.trajectories).
+# A segment holds up to TRAJECTORY_SEGMENT_POINTS points in two arrays instead of a row per point:
+#   coordinates ---> float32 latitude, longitude pairs, 8 bytes per point
+#   deltas ---> uint32 milliseconds since the previous point (the first one since started_at), 4 bytes per point
+
+class TrajectorySegment(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='trajectory')
+    driver = models.ForeignKey(Driver, on_delete=models.SET_NULL, null=True, blank=True)
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    points = models.IntegerField()
+    coordinates = models.BinaryField()
+    deltas = models.BinaryField()
+
+    class Meta:
+        indexes = [
+            # The segments of a delivery in order
+            models.Index(fields=['order', 'started_at'], name='trajectory_order_idx'),
+        ]
+
+    def __str__(self):
+        return "%s %s" % (self.order_id, self.started_at)
+
+# REPORT ROLLUPS
+
+# Totals of the DELIVERED orders of a restaurant, kept up to date by
+# coreapp.rollups when an order is delivered. restaurant_report reads only these
+# tables. `python manage.py backfill_rollups` rebuilds them from the orders.
+
+class RestaurantDailyStats(models.Model):
+    restaurant = models.ForeignKey(Restaurant, on_delete=models.CASCADE, related_name='daily_stats')
+    date = models.DateField()
+    revenue = models.IntegerField(default=0)
+    orders = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['restaurant', 'date'], name='unique_restaurant_daily_stats'),
+        ]
+
+    def __str__(self):
+        return "%s %s" % (self.restaurant_id, self.date)
+
+class RestaurantMealStats(models.Model):
+    restaurant = models.ForeignKey(Restaurant, on_delete=models.CASCADE, related_name='meal_stats')
+    meal = models.ForeignKey(Meal, on_delete=models.CASCADE, related_name='stats')
+    quantity = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['restaurant', 'meal'], name='unique_restaurant_meal_stats'),
+        ]
+        indexes = [
+            # Top meals of a restaurant
+            models.Index(fields=['restaurant', '-quantity'], name='meal_stats_top_idx'),
+        ]
+
+    def __str__(self):
+        return "%s %s" % (self.restaurant_id, self.meal_id)
+
+class RestaurantDriverStats(models.Model):
+    restaurant = models.ForeignKey(Restaurant, on_delete=models.CASCADE, related_name='driver_stats')
+    driver = models.ForeignKey(Driver, on_delete=models.CASCADE, related_name='stats')
+    deliveries = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['restaurant', 'driver'], name='unique_restaurant_driver_stats'),
+        ]
+        indexes = [
+            # Top drivers of a restaurant
+            models.Index(fields=['restaurant', '-deliveries'], name='driver_stats_top_idx'),
+        ]
+
+    def __str__(self):
+        return "%s %s" % (self.restaurant_id, self.driver_id)
@@ -0,0 +1,296 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F
+from django.utils import timezone
+from coreapp.models import Meal, Order, OrderDetails, Customer
+from coreapp.geo import ready_orders
+from coreapp.pubsub import hub, restaurant_channel, ready_orders_channel
+from coreapp.reports import get_timezone
+from coreapp.rollups import record_delivery
+
+
+# Order lifecycle services.
+# The views in apis.py only parse the request and shape the JSON response,
+# the database work for an order happens here.
+
+class OrderError(Exception):
+    """
+    Raised when an order can not be placed or moved to another status.
+    The message is safe to return to the mobile apps as the "error" field.
+    """
+    pass
+
+
+def place_order(customer_id, restaurant_id, address, order_details):
+    """
+      params:
+        1. customer_id
+        2. restaurant_id
+        3. address
+        4. order_details(list) example:
+            [{"meal_id":1, "quantity":2},{"meal_id":2, "quantity": 3}]
+      returns:
+        the new Order
+
+    Runs a fixed number of queries no matter how big the cart is:
+    one to load every meal of the cart, one to lock the customer, one to check
+    the outstanding order, and one INSERT each for the Order and all of its OrderDetails.
+    """
+    # Check order's address
+    if not address:
+        raise OrderError("Address is required.")
+
+    if not order_details:
+        raise OrderError("Order details are required.")
+
+    try:
+        restaurant_id = int(restaurant_id)
+    except (TypeError, ValueError):
+        raise OrderError("Restaurant is invalid.")
+
+    try:
+        lines = [(int(item["meal_id"]), int(item["quantity"])) for item in order_details]
+    except (KeyError, TypeError, ValueError):
+        raise OrderError("Order details are invalid.")
+
+    if any(quantity <= 0 for meal_id, quantity in lines):
+        raise OrderError("Quantity must be greater than zero.")
+
+    # Load every meal of the cart in one query.
+    # in_bulk() returns a dictionary mapping each id to its Meal.
+    meals = Meal.objects.filter(restaurant_id=restaurant_id).only("id", "name", "price")\
+        .in_bulk({meal_id for meal_id, quantity in lines})
+
+    # Check if meals in only one restaurant
+    if len(meals) != len({meal_id for meal_id, quantity in lines}):
+        raise OrderError("Meals must be in only one restaurant")
+
+    # Calculate order total in memory
+    details = [
+        OrderDetails(
+            meal_id = meal_id,
+            quantity = quantity,
+            sub_total = meals[meal_id].price * quantity
+        )
+        for meal_id, quantity in lines
+    ]
+    order_total = sum(detail.sub_total for detail in details)
+
+    # CREATE ORDER
+    # The Order and its OrderDetails are written together or not at all.
+    with transaction.atomic():
+        # Lock the customer row, so two requests of the same customer place
+        # their orders one after the other and the second one sees the first
+        Customer.objects.select_for_update().filter(id=customer_id).values_list("id").first()
+
+        # Check whether customer has any outstanding order
+        if Order.objects.filter(customer_id=customer_id).exclude(status=Order.DELIVERED).exists():
+            raise OrderError("Your last order must be completed.")
+
+        # Step 1 - Create an Order
+        order = Order.objects.create(
+            customer_id = customer_id,
+            restaurant_id = restaurant_id,
+            total = order_total,
+            status = Order.COOKING,
+            address = address
+        )
+        # Step 2 - Create Order Details with a single INSERT
+        for detail in details:
+            detail.order = order
+        OrderDetails.objects.bulk_create(details)
+
+        # Tell the restaurant dashboards once the order is committed
+        transaction.on_commit(lambda: publish_new_order(order, meals, details))
+
+    return order
+
+
+def publish_new_order(order, meals, details):
+    """
+    Publishes a summary of a new order to the dashboards of its restaurant
+    (see coreapp.streams.restaurant_stream_orders).
+    """
+    channel = restaurant_channel(order.restaurant_id)
+    # Nothing to build when no dashboard is listening in this process
+    if not hub.has_subscribers(channel):
+        return
+
+    customer = Customer.objects.select_related("user").get(id=order.customer_id)
+    hub.publish(channel, {
+        "event": "order",
+        "order": {
+            "id": order.id,
+            "customer": str(customer),
+            "total": order.total,
+            "status": order.get_status_display(),
+            "address": order.address,
+            "created_at": order.created_at,
+            "order_details": [
+                {
+                    "meal": meals[detail.meal_id].name,
+                    "price": meals[detail.meal_id].price,
+                    "quantity": detail.quantity,
+                    "sub_total": detail.sub_total,
+                }
+                for detail in details
+            ],
+        },
+    })
+
+
+def mark_orders_ready(restaurant_id, order_ids):
+    """
+    Moves orders of a restaurant from COOKING to READY.
+      params:
+        1. restaurant_id ---> only the orders of this restaurant are moved
+        2. order_ids ---> eg. the checked orders of the order board
+      returns:
+        (ids of the orders which are now READY, {order id: why it was not moved})
+
+    All the orders are moved by one UPDATE guarded by the restaurant and the
+    COOKING status, so an order of another restaurant, or one which is
+    already ready, is never touched. A fixed number of queries runs for any
+    number of orders.
+    """
+    ids = set()
+    skipped = {}
+    for order_id in order_ids:
+        try:
+            ids.add(int(order_id))
+        except (TypeError, ValueError):
+            skipped[order_id] = "is invalid"
+
+    cooking = Order.objects.filter(restaurant_id=restaurant_id, id__in=ids, status=Order.COOKING)
+    with transaction.atomic():
+        # Lock the rows, so the ids read are exactly the rows updated
+        ready_ids = set(cooking.select_for_update().values_list("id", flat=True))
+        if ready_ids:
+            cooking.filter(id__in=ready_ids).update(status=Order.READY)
+            transaction.on_commit(lambda: publish_ready_orders(restaurant_id, ready_ids))
+            transaction.on_commit(lambda: ready_orders.add_orders(restaurant_id, ready_ids))
+
+    # Tell why the others were not moved, only failures pay for this query
+    others = Order.objects.filter(restaurant_id=restaurant_id, id__in=ids - ready_ids).only("id", "status")
+    statuses = {order.id: order.get_status_display() for order in others}
+    for order_id in ids - ready_ids:
+        skipped[order_id] = "is already %s" % statuses[order_id] if order_id in statuses else "was not found"
+
+    return ready_ids, skipped
+
+
+def publish_ready_orders(restaurant_id, order_ids):
+    """
+    Tells the drivers listening in this process (see
+    coreapp.streams.driver_stream_ready_orders) that orders can be picked up.
+    """
+    hub.publish(ready_orders_channel(), {
+        "event": "ready",
+        "restaurant_id": restaurant_id,
+        "order_ids": sorted(order_ids),
+    })
+
+
+def _claim_query(order_id, driver_id):
+    """
+      returns:
+        (the driver's orders on the way, the claimable order)
+    """
+    # The orders are given out by coreapp.dispatch
+    if settings.DISPATCH_MODE:
+        raise OrderError("Orders are assigned by the dispatcher.")
+
+    try:
+        order_id = int(order_id)
+    except (TypeError, ValueError):
+        raise OrderError("Order is invalid.")
+
+    outstanding = Order.objects.filter(driver_id=driver_id, status=Order.ONTHEWAY)
+    claimable = Order.objects.filter(
+        ~Exists(outstanding),
+        id = order_id,
+        driver = None,
+        status = Order.READY
+    )
+    return outstanding, claimable
+
+
+def _claim_failed(has_outstanding):
+    if has_outstanding:
+        raise OrderError("Your outstanding order is not delivered yet.")
+    raise OrderError("This order has been picked up by another")
+
+
+def claim_order(order_id, driver_id):
+    """
+    Gives a READY order to a driver who has no order on the way.
+
+    The claim is one UPDATE:
+        UPDATE order SET driver=?, status=ONTHEWAY, picked_at=?
+        WHERE id=? AND driver IS NULL AND status=READY
+          AND NOT EXISTS (order on the way of the driver)
+    The database runs it atomically, so when drivers race for the same order
+    exactly one of them updates the row. No lock is taken and a successful claim
+    costs one round trip.
+    """
+    outstanding, claimable = _claim_query(order_id, driver_id)
+    claimed = claimable.update(
+        driver_id = driver_id,
+        status = Order.ONTHEWAY,
+        picked_at = timezone.now()
+    )
+
+    if not claimed:
+        # Find out why, only failed claims pay for this query
+        _claim_failed(outstanding.exists())
+
+    # The order is not ready anymore for the nearby orders
+    transaction.on_commit(lambda: ready_orders.remove_orders([int(order_id)]))
+
+
+async def aclaim_order(order_id, driver_id):
+    """
+    claim_order() for async views, the same single UPDATE.
+    """
+    outstanding, claimable = _claim_query(order_id, driver_id)
+    claimed = await claimable.aupdate(
+        driver_id = driver_id,
+        status = Order.ONTHEWAY,
+        picked_at = timezone.now()
+    )
+
+    if not claimed:
+        _claim_failed(await outstanding.aexists())
+
+    # aupdate() commits on its own
+    ready_orders.remove_orders([int(order_id)])
+
+
+def deliver_order(order_id, driver_id):
+    """
+    Moves an order of the driver from ONTHEWAY to DELIVERED and adds it to
+    the report rollups, in one transaction.
+    It is the only way an order becomes DELIVERED (see coreapp.rollups).
+      returns:
+        the delivered Order
+    """
+    try:
+        order_id = int(order_id)
+    except (TypeError, ValueError):
+        raise OrderError("Order is invalid.")
+
+    with transaction.atomic():
+        # Only one request can move the order, so it is counted once in the rollups
+        delivered = Order.objects.filter(
+            id = order_id,
+            driver_id = driver_id,
+            status = Order.ONTHEWAY
+        ).update(status = Order.DELIVERED)
+
+        if not delivered:
+            raise OrderError("This order is not on the way with you.")
+
+        order = Order.objects.annotate(restaurant_timezone=F("restaurant__timezone")).get(id=order_id)
+        record_delivery(order, get_timezone(order.restaurant_timezone))
+
+    return order
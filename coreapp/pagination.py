@@ -0,0 +1,79 @@
+import base64
+import json
+from django.conf import settings
+
+
+# KEYSET PAGINATION
+
+# Pages are taken with "WHERE id < <last id of the previous page> ORDER BY id DESC LIMIT <size>"
+# instead of OFFSET, so a deep page costs the same as the first one.
+# The position is handed to the client as an opaque `next` cursor.
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(json.dumps({"id": last_id}).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        # Put back the "=" padding removed by encode_cursor()
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return int(data["id"])
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor("Invalid cursor.")
+
+
+def get_page_size(request, default=None):
+    """
+    The `page_size` param, limited to API_MAX_PAGE_SIZE.
+    """
+    page_size = default or settings.API_PAGE_SIZE
+    try:
+        page_size = int(request.GET.get("page_size", page_size))
+    except ValueError:
+        pass
+    return max(1, min(page_size, settings.API_MAX_PAGE_SIZE))
+
+
+def _page_query(request, queryset, page_size):
+    page_size = get_page_size(request, page_size)
+
+    cursor = request.GET.get("cursor")
+    if cursor:
+        queryset = queryset.filter(id__lt=decode_cursor(cursor))
+
+    # Fetch one extra row to know whether there is a next page
+    return queryset.order_by("-id")[:page_size + 1], page_size
+
+
+def _split_page(objects, page_size):
+    if len(objects) > page_size:
+        objects = objects[:page_size]
+        return objects, encode_cursor(objects[-1].id)
+
+    return objects, None
+
+
+def keyset_paginate(request, queryset, page_size=None):
+    """
+      params (GET):
+        1. cursor (optional) ---> the `next` value of the previous page
+        2. page_size (optional)
+      returns:
+        (list of objects, next cursor or None)
+
+    `queryset` must not be ordered, it is ordered by "-id" here.
+    """
+    query, page_size = _page_query(request, queryset, page_size)
+    return _split_page(list(query), page_size)
+
+
+async def akeyset_paginate(request, queryset, page_size=None):
+    """
+    keyset_paginate() for async views.
+    """
+    query, page_size = _page_query(request, queryset, page_size)
+    return _split_page([obj async for obj in query], page_size)
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import json
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from asgiref.sync import sync_to_async
+from django.conf import settings
+import stripe
+from requests import Session
+from requests.adapters import HTTPAdapter
+from coreapp.cache import LRUCache
+from coreapp.models import Order
+
+
+# Payment gateways.
+# The APIs ask get_gateway() for the gateway named by PAYMENT_GATEWAY in
+# settings.py, so checkout can run against Stripe or, offline, against FakeGateway.
+
+# What the mobile app needs to confirm a payment
+PaymentIntent = namedtuple("PaymentIntent", ("id", "client_secret"))
+
+
+class PaymentError(Exception):
+    """
+    Raised when a payment intent can not be created.
+    The message is safe to return to the mobile apps as the "error" field.
+    """
+    pass
+
+
+class Gateway(ABC):
+    @abstractmethod
+    def create_intent(self, amount, currency, description, idempotency_key):
+        """
+          params:
+            1. amount ---> in cents
+            2. currency
+            3. description
+            4. idempotency_key ---> the same key returns the same intent
+          returns:
+            PaymentIntent
+        """
+
+    async def acreate_intent(self, amount, currency, description, idempotency_key):
+        # The call waits in a thread of its own instead of the event loop,
+        # thread_sensitive=False keeps it from queueing behind other sync code.
+        return await sync_to_async(self.create_intent, thread_sensitive=False)(
+            amount, currency, description, idempotency_key
+        )
+
+
+class StripeGateway(Gateway):
+    """
+    Stripe through one shared HTTP session.
+    At most `pool_size` requests talk to Stripe at the same time, the others
+    wait for a free connection instead of opening new ones. `timeout` is
+    (connect, read) in seconds.
+    """
+    def __init__(self, api_key, timeout=(3, 10), max_network_retries=2, pool_size=10):
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        session.mount("https://", adapter)
+
+        self.client = stripe.StripeClient(
+            api_key,
+            http_client=stripe.RequestsClient(timeout=timeout, session=session),
+            # Retries are safe, they send the same idempotency key
+            max_network_retries=max_network_retries,
+        )
+
+    def create_intent(self, amount, currency, description, idempotency_key):
+        try:
+            intent = self.client.v1.payment_intents.create(
+                params={"amount": amount, "currency": currency, "description": description},
+                options={"idempotency_key": idempotency_key},
+            )
+        except stripe.StripeError as e:
+            raise PaymentError(e.user_message or str(e))
+        return PaymentIntent(intent.id, intent.client_secret)
+
+
+class FakeGateway(Gateway):
+    """
+    An in-process gateway for development and load tests.
+    Every call waits `latency` seconds, like a round trip to Stripe would.
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.intents = LRUCache(maxsize=10000)
+
+    def _intent(self, idempotency_key):
+        intent = self.intents.get(idempotency_key)
+        if intent is None:
+            intent_id = "pi_fake_" + hashlib.sha1(idempotency_key.encode()).hexdigest()[:24]
+            intent = PaymentIntent(intent_id, intent_id + "_secret_fake")
+            self.intents.set(idempotency_key, intent)
+        return intent
+
+    def create_intent(self, amount, currency, description, idempotency_key):
+        time.sleep(self.latency)
+        return self._intent(idempotency_key)
+
+    async def acreate_intent(self, amount, currency, description, idempotency_key):
+        await asyncio.sleep(self.latency)
+        return self._intent(idempotency_key)
+
+
+@lru_cache(maxsize=None)
+def get_gateway():
+    """
+    The gateway of PAYMENT_GATEWAY, created once per process so its connections are reused.
+    """
+    if settings.PAYMENT_GATEWAY == "stripe":
+        return StripeGateway(
+            settings.STRIPE_API_KEY,
+            timeout=settings.STRIPE_TIMEOUT,
+            max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+            pool_size=settings.STRIPE_POOL_SIZE,
+        )
+    if settings.PAYMENT_GATEWAY == "fake":
+        return FakeGateway(latency=settings.FAKE_PAYMENT_LATENCY)
+    raise ValueError("Unknown PAYMENT_GATEWAY %r" % settings.PAYMENT_GATEWAY)
+
+
+# CHECKOUT
+
+def _amount(total):
+    # total ---> the order total in dollars, eg. "12" or "12.50"
+    try:
+        amount = int(Decimal(total) * 100)
+    except (TypeError, ValueError, OverflowError, InvalidOperation):
+        raise PaymentError("Total is invalid.")
+    if amount <= 0:
+        raise PaymentError("Total must be greater than zero.")
+    return amount
+
+
+def _idempotency_key(user_id, last_order_id, amount, cart):
+    """
+    The same customer paying for the same cart gets the same key, so a retried
+    request (a double tap, a lost response) returns the intent created the
+    first time instead of charging twice. The customer's last order is part of
+    the key, so the same cart ordered again later is a new payment.
+    """
+    stamp = json.dumps([user_id, last_order_id, amount, cart], sort_keys=True)
+    return "checkout-" + hashlib.sha256(stamp.encode()).hexdigest()
+
+
+def _customer_orders(identity):
+    return Order.objects.filter(customer_id=identity.customer_id).values_list("id", flat=True)
+
+
+def create_checkout_intent(identity, total, cart=None):
+    """
+      params:
+        1. identity ---> TokenIdentity of the customer
+        2. total
+        3. cart (optional) ---> the order_details the customer is paying for
+      returns:
+        PaymentIntent
+    """
+    amount = _amount(total)
+    last_order_id = _customer_orders(identity).last() if identity.customer_id else None
+    key = _idempotency_key(identity.user_id, last_order_id, amount, cart)
+    return get_gateway().create_intent(amount, "usd", "FoodTasker Order", key)
+
+
+async def acreate_checkout_intent(identity, total, cart=None):
+    """
+    create_checkout_intent() for async views.
+    """
+    amount = _amount(total)
+    last_order_id = await _customer_orders(identity).alast() if identity.customer_id else None
+    key = _idempotency_key(identity.user_id, last_order_id, amount, cart)
+    return await get_gateway().acreate_intent(amount, "usd", "FoodTasker Order", key)
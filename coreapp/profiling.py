@@ -0,0 +1,162 @@
+import cProfile
+import hashlib
+import io
+import os
+import pstats
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+
+
+# ON-DEMAND PROFILING
+
+# One request is run under cProfile when it asks for it:
+#   - with an X-Profile header holding a token of make_profile_token()
+#     (see the profile_token command). A token profiles one request to the
+#     path it was made for, within PROFILE_TOKEN_MAX_AGE seconds, a replayed
+#     token is ignored, or
+#   - with ?profile=1 from a signed in staff user.
+# PROFILING_ENABLED is False by default, turn it on where profiles are wanted.
+# The profile is written to PROFILE_DIR (the newest PROFILE_KEEP files are kept),
+# open it with `python -m pstats <file>` or snakeviz, and the response is
+# replaced by the functions with the most cumulative time.
+# Other requests only pay for two dictionary lookups, and nothing at all when
+# PROFILING_ENABLED is False.
+
+PROFILE_HEADER = "HTTP_X_PROFILE"
+TOKEN_SALT = "coreapp.profiling"
+
+
+def make_profile_token(path):
+    """
+      params:
+        1. path ---> the path of the request to profile, eg. /api/driver/order/ready/
+      returns:
+        a token for one request to the path
+    """
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign(path)
+
+
+def _valid_token(token, path):
+    try:
+        token_path = signing.TimestampSigner(salt=TOKEN_SALT).unsign(token, max_age=settings.PROFILE_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    if token_path != path:
+        return False
+    # Only the first request with the token is profiled, the default cache
+    # remembers the used tokens until they expire anyway
+    used_key = "profile-token:%s" % hashlib.sha1(token.encode()).hexdigest()
+    return cache.add(used_key, True, settings.PROFILE_TOKEN_MAX_AGE)
+
+
+def profile_requested(request):
+    token = request.META.get(PROFILE_HEADER)
+    if token is not None:
+        return _valid_token(token, request.path)
+    # request.user is only loaded for the requests which ask
+    if request.GET.get("profile") == "1":
+        return request.user.is_staff
+    return False
+
+
+def _write_profile(profiler, request):
+    """
+    Saves the profile and deletes the oldest ones beyond PROFILE_KEEP.
+      returns:
+        the file path
+    """
+    directory = settings.PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+
+    resolver_match = getattr(request, "resolver_match", None)
+    view = resolver_match.view_name if resolver_match else "unresolved"
+    path = os.path.join(directory, "%s-%s.prof" % (time.strftime("%Y%m%d-%H%M%S"), view.replace(":", "-")))
+    # Two profiles in the same second get their own file
+    if os.path.exists(path):
+        path = path[:-len(".prof")] + "-%s.prof" % time.perf_counter_ns()
+    profiler.dump_stats(path)
+
+    profiles = sorted(
+        (os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".prof")),
+        key=os.path.getmtime,
+    )
+    for old_path in profiles[:-settings.PROFILE_KEEP]:
+        try:
+            os.remove(old_path)
+        except FileNotFoundError:
+            pass
+    return path
+
+
+def _summary(profiler, request, response, elapsed, path):
+    stream = io.StringIO()
+    stream.write("%s %s ---> %s in %.1f ms\n" % (request.method, request.get_full_path(), response.status_code, elapsed * 1000))
+    stream.write("Profile: %s\n" % path)
+    if response.streaming:
+        stream.write("The response is streamed, only the time until the first byte is profiled.\n")
+    stream.write("\n")
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(settings.PROFILE_TOP)
+
+    summary = HttpResponse(stream.getvalue(), content_type="text/plain; charset=utf-8")
+    summary["X-Profile-File"] = os.path.basename(path)
+    return summary
+
+
+class ProfilingMiddleware:
+    """
+    See the top of this file. It goes after AuthenticationMiddleware, which ?profile=1 needs.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            # Django leaves the middleware out of the chain
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not profile_requested(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        return self.finish(profiler, request, response, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        # request.user may be loaded, that has to happen outside the event loop
+        if PROFILE_HEADER in request.META or "profile" in request.GET:
+            requested = await sync_to_async(profile_requested)(request)
+        else:
+            requested = False
+        if not requested:
+            return await self.get_response(request)
+
+        # cProfile follows the event loop thread, coroutines of other requests
+        # running at the same time show up in the profile too
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profiler.disable()
+        return self.finish(profiler, request, response, time.perf_counter() - started)
+
+    def finish(self, profiler, request, response, elapsed):
+        path = _write_profile(profiler, request)
+        return _summary(profiler, request, response, elapsed, path)
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+from collections import defaultdict
+
+
+# IN-PROCESS PUB/SUB
+
+# The streaming APIs (see coreapp.streams) subscribe to a channel, eg. "driver:<id>",
+# and the regular APIs publish to it when something happens.
+# publish() may be called from any thread, the messages are handed to the
+# event loop of each subscriber.
+# Only subscribers of the same process receive a message, so a client whose
+# stream is served by another worker keeps using the polling APIs.
+
+class Subscription:
+    def __init__(self, channel, maxsize):
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def put(self, message):
+        # A slow client only needs the latest messages, drop the oldest one
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class Hub:
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        """
+        Must be called from the event loop which reads the subscription.
+        """
+        subscription = Subscription(channel, self.maxsize)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def has_subscribers(self, channel):
+        with self._lock:
+            return channel in self._subscriptions
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, message)
+            except RuntimeError:
+                # The event loop of the subscriber is closed
+                self.unsubscribe(subscription)
+        return len(subscriptions)
+
+
+hub = Hub()
+
+
+def driver_channel(driver_id):
+    return "driver:%s" % driver_id
+
+
+def restaurant_channel(restaurant_id):
+    return "restaurant:%s" % restaurant_id
+
+
+def ready_orders_channel():
+    # Every driver listens to the orders which become ready
+    return "orders:ready"
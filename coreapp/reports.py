@@ -0,0 +1,102 @@
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from django.conf import settings
+from django.db.models import Sum, Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+
+# Date ranges and daily aggregates used by the revenue reports.
+# A range is half-open: [start, end), both are dates in the given timezone.
+
+class InvalidRange(Exception):
+    pass
+
+
+def get_timezone(name=None):
+    """
+    The timezone named by an IANA name, eg. "Asia/Kolkata", or TIME_ZONE of settings.py.
+    """
+    try:
+        return ZoneInfo(name or settings.TIME_ZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise InvalidRange("Unknown timezone.")
+
+
+def get_date_range(params, tz):
+    """
+      params:
+        1. period (optional) ---> "week" (default) or "month", the current one
+        2. start, end (optional) ---> YYYY-MM-DD, a custom range, `end` excluded
+      returns:
+        (start date, end date)
+    """
+    today = timezone.localtime(timezone.now(), tz).date()
+
+    if params.get("start") or params.get("end"):
+        try:
+            start = datetime.strptime(params["start"], "%Y-%m-%d").date()
+            end = datetime.strptime(params["end"], "%Y-%m-%d").date()
+        except (KeyError, ValueError):
+            raise InvalidRange("start and end must be dates, eg. 2024-01-31.")
+        if end <= start:
+            raise InvalidRange("end must be after start.")
+        if (end - start).days > settings.REPORT_MAX_DAYS:
+            raise InvalidRange("The range can not be longer than %s days." % settings.REPORT_MAX_DAYS)
+        return start, end
+
+    period = params.get("period", "week")
+    if period == "week":
+        # weekday() method to get the day of the week as a number, where Monday is 0 and Sunday is 6.
+        start = today - timedelta(days=today.weekday())
+        return start, start + timedelta(days=7)
+    if period == "month":
+        start = today.replace(day=1)
+        return start, (start + timedelta(days=32)).replace(day=1)
+    raise InvalidRange("period must be week or month.")
+
+
+def is_current_week(params):
+    """
+    True when get_date_range() returns the current week, the range the
+    driver app shows by weekday. A custom range is never one, even a Monday to Monday.
+    """
+    return not (params.get("start") or params.get("end")) and params.get("period", "week") == "week"
+
+
+def _daily_rows(queryset, start, end, tz):
+    return queryset.filter(
+        # A range on created_at can use an index, created_at__day can not
+        created_at__gte=timezone.make_aware(datetime.combine(start, time.min), tz),
+        created_at__lt=timezone.make_aware(datetime.combine(end, time.min), tz),
+    ).annotate(
+        day=TruncDate("created_at", tzinfo=tz)
+    ).values("day").annotate(
+        total=Sum("total"),
+        orders=Count("id"),
+    ).order_by()
+
+
+def _fill_days(rows, start, end):
+    totals = {start + timedelta(days=i): {"total": 0, "orders": 0} for i in range((end - start).days)}
+    for row in rows:
+        totals[row["day"]] = {"total": row["total"] or 0, "orders": row["orders"]}
+    return totals
+
+
+def daily_totals(queryset, start, end, tz):
+    """
+    Sums the `total` of the orders of `queryset` per local day of `created_at`,
+    with one grouped query over the created_at range.
+      returns:
+        {date: {"total": .., "orders": ..}} for every day in [start, end)
+    """
+    return _fill_days(_daily_rows(queryset, start, end, tz), start, end)
+
+
+async def adaily_totals(queryset, start, end, tz):
+    """
+    daily_totals() for async views.
+    """
+    rows = [row async for row in _daily_rows(queryset, start, end, tz)]
+    return _fill_days(rows, start, end)
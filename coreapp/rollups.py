@@ -0,0 +1,111 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum, Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from coreapp.models import Restaurant, Order, OrderDetails, RestaurantDailyStats, RestaurantMealStats, RestaurantDriverStats
+from coreapp.reports import get_timezone
+
+
+# Incremental maintenance of the report rollups (see RestaurantDailyStats in coreapp.models).
+# An order is added when coreapp.orders.deliver_order() delivers it, the only
+# way an order becomes DELIVERED. Orders delivered any other way (a script, the
+# database shell) are missing from the rollups until `manage.py backfill_rollups`.
+# The day of an order is the local day of its created_at in the restaurant's timezone.
+
+def _increment(model, keys, **amounts):
+    """
+    Adds `amounts` to the row of `model` matching `keys`, creating it if needed.
+    Safe when two deliveries create the same row at the same time.
+    """
+    increments = {field: F(field) + amount for field, amount in amounts.items()}
+    if model.objects.filter(**keys).update(**increments):
+        return
+    try:
+        # A savepoint, so a lost race does not break the outer transaction
+        with transaction.atomic():
+            model.objects.create(**keys, **amounts)
+    except IntegrityError:
+        model.objects.filter(**keys).update(**increments)
+
+
+def record_delivery(order, tz):
+    """
+    Adds a newly DELIVERED order to the rollups of its restaurant.
+    Must be called exactly once per order, in the transaction which delivers it.
+      params:
+        1. order
+        2. tz ---> the timezone of the order's restaurant
+    """
+    _increment(
+        RestaurantDailyStats,
+        {"restaurant_id": order.restaurant_id, "date": timezone.localdate(order.created_at, tz)},
+        revenue=order.total,
+        orders=1,
+    )
+
+    meal_quantities = OrderDetails.objects.filter(order_id=order.id)\
+        .values_list("meal_id").annotate(Sum("quantity")).order_by()
+    for meal_id, quantity in meal_quantities:
+        _increment(
+            RestaurantMealStats,
+            {"restaurant_id": order.restaurant_id, "meal_id": meal_id},
+            quantity=quantity,
+        )
+
+    if order.driver_id:
+        _increment(
+            RestaurantDriverStats,
+            {"restaurant_id": order.restaurant_id, "driver_id": order.driver_id},
+            deliveries=1,
+        )
+
+
+@transaction.atomic
+def rebuild_rollups(batch_size=1000):
+    """
+    Recomputes every rollup from the DELIVERED orders, with three grouped
+    queries, the daily one once per restaurant timezone.
+    """
+    RestaurantDailyStats.objects.all().delete()
+    RestaurantMealStats.objects.all().delete()
+    RestaurantDriverStats.objects.all().delete()
+
+    delivered = Order.objects.filter(status=Order.DELIVERED)
+
+    for name in Restaurant.objects.values_list("timezone", flat=True).distinct().order_by():
+        daily = delivered.filter(restaurant__timezone=name)\
+            .annotate(date=TruncDate("created_at", tzinfo=get_timezone(name)))\
+            .values_list("restaurant_id", "date").annotate(Sum("total"), Count("id")).order_by()
+        RestaurantDailyStats.objects.bulk_create(
+            (
+                RestaurantDailyStats(restaurant_id=restaurant_id, date=date, revenue=revenue, orders=orders)
+                for restaurant_id, date, revenue, orders in daily.iterator()
+            ),
+            batch_size=batch_size,
+        )
+
+    meals = OrderDetails.objects.filter(order__status=Order.DELIVERED)\
+        .values_list("order__restaurant_id", "meal_id").annotate(Sum("quantity")).order_by()
+    RestaurantMealStats.objects.bulk_create(
+        (
+            RestaurantMealStats(restaurant_id=restaurant_id, meal_id=meal_id, quantity=quantity)
+            for restaurant_id, meal_id, quantity in meals.iterator()
+        ),
+        batch_size=batch_size,
+    )
+
+    drivers = delivered.filter(driver__isnull=False)\
+        .values_list("restaurant_id", "driver_id").annotate(Count("id")).order_by()
+    RestaurantDriverStats.objects.bulk_create(
+        (
+            RestaurantDriverStats(restaurant_id=restaurant_id, driver_id=driver_id, deliveries=deliveries)
+            for restaurant_id, driver_id, deliveries in drivers.iterator()
+        ),
+        batch_size=batch_size,
+    )
+
+    return {
+        "days": RestaurantDailyStats.objects.count(),
+        "meals": RestaurantMealStats.objects.count(),
+        "drivers": RestaurantDriverStats.objects.count(),
+    }
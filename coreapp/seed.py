@@ -0,0 +1,196 @@
+import random
+from datetime import timedelta
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from coreapp.models import Restaurant, Meal, Customer, Driver, Order, OrderDetails
+from coreapp.rollups import rebuild_rollups
+
+
+# Synthetic data for development and benchmarks (see the seed_data command).
+# Everything is written with bulk_create, so model signals do not run and the
+# report rollups are rebuilt at the end.
+
+# Share of the orders which are not delivered yet, for each outstanding status
+OUTSTANDING_SHARE = 0.05
+
+# Every seeded user can sign in with this password
+SEED_PASSWORD = "password"
+
+# Restaurants and drivers are placed up to SPREAD degrees around CENTER
+CENTER = (37.77, -122.42)
+SPREAD = 0.1
+
+
+def _position(rng):
+    return CENTER[0] + rng.uniform(-SPREAD, SPREAD), CENTER[1] + rng.uniform(-SPREAD, SPREAD)
+
+
+class SeedError(Exception):
+    pass
+
+
+def _create_users(prefix, kind, count, password, batch_size):
+    """
+    returns:
+      the new users, in creation order
+    """
+    usernames = ["%s-%s-%s" % (prefix, kind, i) for i in range(count)]
+    User.objects.bulk_create([
+        User(username=username, first_name=kind.title(), last_name=str(i), password=password)
+        for i, username in enumerate(usernames)
+    ], batch_size=batch_size)
+    # Load them back, not every database returns the ids of a bulk insert
+    users = User.objects.in_bulk(usernames, field_name="username")
+    return [users[username] for username in usernames]
+
+
+def _create(model, objects, batch_size):
+    model.objects.bulk_create(objects, batch_size=batch_size)
+    if objects and objects[0].pk is None:
+        # Same as above, the rows were inserted in order
+        ids = model.objects.order_by("-id").values_list("id", flat=True)[:len(objects)]
+        for obj, pk in zip(objects, reversed(ids)):
+            obj.pk = pk
+    return objects
+
+
+def seed_data(restaurants=20, meals=10, customers=500, drivers=50, orders=10000,
+              days=90, seed=0, prefix="seed", batch_size=1000):
+    """
+      params:
+        1. restaurants
+        2. meals ---> per restaurant
+        3. customers
+        4. drivers
+        5. orders ---> some of them in every Order.STATUS_CHOICES state, the rest delivered
+        6. days ---> delivered orders are spread over the last `days` days
+        7. seed ---> the same seed creates the same data
+        8. prefix ---> of the usernames, eg. "seed-restaurant-0"
+      returns:
+        {"restaurants": .., "meals": .., "customers": .., "drivers": .., "orders": .., "order_details": ..}
+    """
+    if min(restaurants, meals, customers, drivers) < 1:
+        raise SeedError("At least one restaurant, meal, customer and driver is needed.")
+    if User.objects.filter(username__startswith=prefix + "-").exists():
+        raise SeedError("Users named %s-... exist already, use another prefix." % prefix)
+
+    rng = random.Random(seed)
+    now = timezone.now()
+    # Hashing is slow on purpose, hash once for every user
+    password = make_password(SEED_PASSWORD)
+
+    with transaction.atomic():
+        restaurant_list = []
+        for i, user in enumerate(_create_users(prefix, "restaurant", restaurants, password, batch_size)):
+            latitude, longitude = _position(rng)
+            restaurant_list.append(Restaurant(
+                user=user,
+                name="Restaurant %s" % i,
+                phone="555-%04d" % i,
+                address="%s Main Street" % (i + 1),
+                logo="image/upload/v1/seed/logo.jpg",
+                latitude=latitude,
+                longitude=longitude,
+            ))
+        _create(Restaurant, restaurant_list, batch_size)
+
+        menus = {}
+        meal_list = []
+        for restaurant in restaurant_list:
+            menus[restaurant.id] = [
+                Meal(
+                    restaurant=restaurant,
+                    name="Meal %s" % i,
+                    short_description="A seeded meal",
+                    image="image/upload/v1/seed/meal.jpg",
+                    price=rng.randint(1, 30),
+                )
+                for i in range(meals)
+            ]
+            meal_list += menus[restaurant.id]
+        _create(Meal, meal_list, batch_size)
+
+        customer_list = _create(Customer, [
+            Customer(user=user, avatar="avatar", phone="555-1%04d" % i, address="%s Side Street" % (i + 1))
+            for i, user in enumerate(_create_users(prefix, "customer", customers, password, batch_size))
+        ], batch_size)
+
+        driver_list = []
+        for i, user in enumerate(_create_users(prefix, "driver", drivers, password, batch_size)):
+            latitude, longitude = _position(rng)
+            driver_list.append(Driver(
+                user=user, avatar="avatar", car_model="Car", plate_number="SEED-%s" % i,
+                location="%.6f, %.6f" % (latitude, longitude), latitude=latitude, longitude=longitude,
+            ))
+        _create(Driver, driver_list, batch_size)
+
+        # A customer has one outstanding order at most and a driver one order
+        # on the way at most, like the APIs allow. Half of the drivers stay free.
+        outstanding = min(max(1, int(orders * OUTSTANDING_SHARE)), customers // 3 or 1)
+        on_the_way = min(outstanding, drivers // 2 or 1)
+        waiting_customers = iter(rng.sample(customer_list, min(customers, outstanding * 3)))
+        statuses = [
+            (Order.COOKING, outstanding),
+            (Order.READY, outstanding),
+            (Order.ONTHEWAY, on_the_way),
+        ]
+        free_drivers = iter(rng.sample(driver_list, on_the_way))
+
+        order_list = []
+        for status, count in statuses:
+            for i in range(count):
+                customer = next(waiting_customers, None)
+                if customer is None or len(order_list) >= orders:
+                    break
+                created_at = now - timedelta(minutes=rng.randint(1, 60))
+                order_list.append(Order(
+                    customer=customer,
+                    restaurant=rng.choice(restaurant_list),
+                    driver=next(free_drivers) if status == Order.ONTHEWAY else None,
+                    address=customer.address,
+                    total=0,
+                    status=status,
+                    created_at=created_at,
+                    picked_at=created_at + timedelta(minutes=10) if status == Order.ONTHEWAY else None,
+                ))
+
+        for i in range(orders - len(order_list)):
+            customer = rng.choice(customer_list)
+            created_at = now - timedelta(days=days) * rng.random()
+            order_list.append(Order(
+                customer=customer,
+                restaurant=rng.choice(restaurant_list),
+                driver=rng.choice(driver_list),
+                address=customer.address,
+                total=0,
+                status=Order.DELIVERED,
+                created_at=created_at,
+                picked_at=created_at + timedelta(minutes=rng.randint(10, 30)),
+            ))
+
+        # Ids grow with created_at, like real orders
+        order_list.sort(key=lambda order: order.created_at)
+
+        # 1 to 4 meals of the order's restaurant, the total is their sum
+        details = []
+        for order in order_list:
+            for meal in rng.sample(menus[order.restaurant.id], min(meals, rng.randint(1, 4))):
+                quantity = rng.randint(1, 3)
+                details.append(OrderDetails(order=order, meal=meal, quantity=quantity, sub_total=meal.price * quantity))
+                order.total += meal.price * quantity
+
+        _create(Order, order_list, batch_size)
+        _create(OrderDetails, details, batch_size)
+
+        rebuild_rollups(batch_size=batch_size)
+
+    return {
+        "restaurants": len(restaurant_list),
+        "meals": len(meal_list),
+        "customers": len(customer_list),
+        "drivers": len(driver_list),
+        "orders": len(order_list),
+        "order_details": len(details),
+    }
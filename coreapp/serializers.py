@@ -1,5 +1,9 @@
+from functools import lru_cache
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
 from rest_framework import serializers
 from coreapp.models import Restaurant, Meal, Order, Customer, Restaurant, Driver, OrderDetails
+from coreapp.images import image_url, image_variants, absolute_url
 
 
 # Serializers define the API representation.
@@ -8,29 +12,36 @@ from coreapp.models import Restaurant, Meal, Order, Customer, Restaurant, Driver
 class RestaurantSerializer(serializers.ModelSerializer):
     # SerializerMethodField gets its data by calling get_<field_name>.
     logo = serializers.SerializerMethodField()
+    # Smaller sizes of the logo, see CLOUDINARY_IMAGE_VARIANTS in settings.py
+    logo_variants = serializers.SerializerMethodField()
 
     def get_logo(self, restaurant):
         request = self.context.get('request')
-        logo_url = restaurant.logo.url
-        return request.build_absolute_uri(logo_url)
+        return absolute_url(request, image_url(restaurant.logo, Restaurant.logo.field))
+
+    def get_logo_variants(self, restaurant):
+        return image_variants(restaurant.logo, Restaurant.logo.field)
 
     class Meta:
         model = Restaurant
-        fields = ("id","name","phone", "address", "logo")
+        fields = ("id","name","phone", "address", "logo", "logo_variants")
 
 
 class MealSerializer(serializers.ModelSerializer):
     # SerializerMethodField gets its data by calling get_<field_name>.
     image = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
 
     def get_image(self, meal):
         request = self.context.get('request')
-        image_url = meal.image.url
-        return request.build_absolute_uri(image_url)
+        return absolute_url(request, image_url(meal.image, Meal.image.field))
+
+    def get_image_variants(self, meal):
+        return image_variants(meal.image, Meal.image.field)
 
     class Meta:
         model = Meal
-        fields = ("id","name","short_description", "image", "price")
+        fields = ("id","name","short_description", "image", "image_variants", "price")
 
 # ORDER SERIALIZER
 
@@ -89,3 +100,67 @@ class OrderStatusSerializer(serializers.ModelSerializer):
         model = Order
         # The `fields` option must be a list or tuple or "__all__"
         fields = ("id","status")
+
+
+# EAGER LOADING
+
+# A serializer declares the relations it reads through its fields:
+#   - a nested serializer, eg. customer = OrderCustomerSerializer() ---> select_related("customer")
+#   - a nested serializer with many=True, eg. order_details ---> prefetch_related("order_details")
+#   - a dotted source, eg. source="user.get_full_name" ---> select_related("user")
+# eager_load() turns those declarations into one queryset, so serializing
+# N objects takes the same small number of queries as serializing one.
+
+def eager_load(queryset, serializer_class):
+    """
+    Returns the queryset with every relation read by serializer_class preloaded.
+    eg. eager_load(Order.objects.filter(status=Order.READY), OrderSerializer)
+    """
+    select, prefetch = _loading_plan(serializer_class)
+    return queryset.select_related(*select).prefetch_related(*[
+        # Each prefetched relation is loaded with its own relations preloaded
+        Prefetch(lookup, queryset=eager_load(child_class.Meta.model.objects.all(), child_class))
+        for lookup, child_class in prefetch
+    ])
+
+
+@lru_cache(maxsize=None)
+def _loading_plan(serializer_class):
+    """
+    returns:
+      (select_related lookups, [(prefetch_related lookup, child serializer class)])
+    """
+    model = serializer_class.Meta.model
+    select = []
+    prefetch = []
+
+    for field in serializer_class().fields.values():
+        if field.source == "*":
+            continue
+
+        if isinstance(field, serializers.ListSerializer):
+            prefetch.append((field.source, type(field.child)))
+
+        elif isinstance(field, serializers.BaseSerializer):
+            select.append(field.source)
+            child_select, child_prefetch = _loading_plan(type(field))
+            select += [field.source + "__" + lookup for lookup in child_select]
+            prefetch += [(field.source + "__" + lookup, child_class) for lookup, child_class in child_prefetch]
+
+        else:
+            # Follow the forward relations of a dotted source.
+            # The last part is the attribute or method which is read.
+            path = []
+            current_model = model
+            for attr in field.source.split(".")[:-1]:
+                try:
+                    model_field = current_model._meta.get_field(attr)
+                except FieldDoesNotExist:
+                    break
+                if not (model_field.many_to_one or model_field.one_to_one):
+                    break
+                path.append(attr)
+                select.append("__".join(path))
+                current_model = model_field.related_model
+
+    return tuple(dict.fromkeys(select)), tuple(prefetch)
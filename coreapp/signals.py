@@ -0,0 +1,150 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_init, pre_save, post_save, post_delete
+from django.dispatch import receiver
+from oauth2_provider.models import AccessToken
+from coreapp.models import Restaurant, Meal, new_version
+from coreapp.tokens import invalidate_token
+from coreapp.menus import set_menu_version, drop_menu_snapshot
+from coreapp.images import invalidate_image
+from coreapp.metrics import install_query_recorder
+from coreapp.geo import ready_orders
+
+
+# Signal receivers of coreapp. They are connected in CoreappConfig.ready().
+
+# ACCESS TOKEN
+
+# The revoke-token endpoint of rest_framework_social_oauth2 (and
+# invalidate-sessions) delete the AccessToken rows, a refreshed token is saved.
+@receiver(post_delete, sender=AccessToken)
+@receiver(post_save, sender=AccessToken)
+def access_token_changed(sender, instance, **kwargs):
+    invalidate_token(instance.token)
+
+
+# DATABASE CONNECTIONS
+
+# Count the queries of the requests measured by coreapp.metrics
+@receiver(connection_created)
+def connection_opened(sender, connection, **kwargs):
+    install_query_recorder(connection)
+
+
+# VERSION STAMPS
+
+# Every save goes through here, whether it comes from the dashboard forms,
+# the admin or the ORM. QuerySet.update() does not send signals, so code
+# which updates restaurants or meals in bulk must change the stamps itself.
+
+# The old logo, image and restaurant of an edited row are the values it was
+# loaded with (see _remember), so a save does not read the row again.
+
+@receiver(pre_save, sender=Restaurant)
+def restaurant_changed(sender, instance, update_fields=None, **kwargs):
+    # Both stamps are renewed here, otherwise a stale menu_version loaded with
+    # the instance could be written back. A save(update_fields=...) without
+    # them writes them in restaurant_saved.
+    instance.version = new_version()
+    instance.menu_version = new_version()
+
+    # Forget the cached urls of a replaced logo
+    if instance.pk and (update_fields is None or "logo" in update_fields):
+        old_logo = _old_values(instance, ("logo",)).get("logo")
+        if _image_changed(Restaurant.logo.field, old_logo, instance.logo):
+            invalidate_image(old_logo, Restaurant.logo.field)
+
+
+@receiver(pre_save, sender=Meal)
+def meal_moving(sender, instance, update_fields=None, **kwargs):
+    # Remember the old restaurant of an edited meal, its menu changes too.
+    instance._old_restaurant_id = None
+    if instance.pk:
+        old_meal = _old_values(instance, [
+            name for name, field in (("restaurant_id", "restaurant"), ("image", "image"))
+            if update_fields is None or {name, field} & set(update_fields)
+        ])
+        instance._old_restaurant_id = old_meal.get("restaurant_id")
+        # Forget the cached urls of a replaced image
+        if "image" in old_meal and _image_changed(Meal.image.field, old_meal["image"], instance.image):
+            invalidate_image(old_meal["image"], Meal.image.field)
+
+
+@receiver(post_save, sender=Meal)
+@receiver(post_delete, sender=Meal)
+def meal_changed(sender, instance, **kwargs):
+    _remember(sender, instance)
+    menu_version = new_version()
+    restaurant_ids = {instance.restaurant_id, getattr(instance, "_old_restaurant_id", None)} - {None}
+    Restaurant.objects.filter(pk__in=restaurant_ids).update(menu_version=menu_version)
+
+    # The cached menu snapshots are built again on their next read
+    for restaurant_id in restaurant_ids:
+        set_menu_version(restaurant_id, menu_version)
+
+
+@receiver(post_save, sender=Restaurant)
+def restaurant_saved(sender, instance, created, update_fields=None, **kwargs):
+    loaded = getattr(instance, "_loaded_values", {})
+    _remember(sender, instance)
+    # The stamps renewed by restaurant_changed, in the row before the cache
+    if update_fields is not None and not {"version", "menu_version"} <= set(update_fields):
+        Restaurant.objects.filter(pk=instance.pk).update(version=instance.version, menu_version=instance.menu_version)
+    set_menu_version(instance.id, instance.menu_version)
+
+    # The ready orders are picked up at the restaurant's coordinates
+    if created or not (update_fields is None or {"latitude", "longitude"} & set(update_fields)):
+        return
+    coordinates = (instance.latitude, instance.longitude)
+    if ("latitude" in loaded and "longitude" in loaded) and (loaded["latitude"], loaded["longitude"]) == coordinates:
+        return
+    ready_orders.move_restaurant(instance.id, *coordinates)
+
+
+@receiver(post_delete, sender=Restaurant)
+def restaurant_deleted(sender, instance, **kwargs):
+    drop_menu_snapshot(instance.id)
+    invalidate_image(instance.logo, Restaurant.logo.field)
+
+
+@receiver(post_delete, sender=Meal)
+def meal_deleted(sender, instance, **kwargs):
+    invalidate_image(instance.image, Meal.image.field)
+
+
+# LOADED VALUES
+
+# field names ---> remembered when an instance is loaded or saved
+REMEMBERED_FIELDS = {
+    Restaurant: ("logo", "latitude", "longitude"),
+    Meal: ("restaurant_id", "image"),
+}
+
+
+@receiver(post_init, sender=Restaurant)
+@receiver(post_init, sender=Meal)
+def _remember(sender, instance, **kwargs):
+    # Deferred fields are not in __dict__, reading them would run a query
+    instance._loaded_values = {
+        name: instance.__dict__[name] for name in REMEMBERED_FIELDS[sender] if name in instance.__dict__
+    }
+
+
+def _old_values(instance, names):
+    """
+    The values of the fields `names` when the instance was loaded or last saved.
+    Only the fields which were deferred are read from the database.
+    """
+    loaded = getattr(instance, "_loaded_values", {})
+    old = {name: loaded[name] for name in names if name in loaded}
+    missing = [name for name in names if name not in old]
+    if missing:
+        old.update(type(instance).objects.filter(pk=instance.pk).values(*missing).first() or {})
+    return old
+
+
+def _image_changed(field, old_image, new_image):
+    # CloudinaryResource, str or a new UploadedFile are compared by their database value
+    try:
+        return field.get_prep_value(old_image) != field.get_prep_value(new_image)
+    except (TypeError, AttributeError):
+        return True
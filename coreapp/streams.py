@@ -0,0 +1,167 @@
+import asyncio
+import json
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from coreapp.models import Order, Driver, Restaurant
+from coreapp.locations import current_location, location_buffer
+from coreapp.pubsub import hub, driver_channel, restaurant_channel, ready_orders_channel
+from coreapp.tokens import aresolve_token
+
+
+# Streaming APIs (Server-Sent Events)
+
+# They need an ASGI server, eg. `uvicorn foodtasker.asgi:application`.
+# Served by WSGI they answer once, like the polling API they replace.
+
+def sse_event(event, data):
+    """
+    One Server-Sent Event, eg.
+        event: location
+        data: {"location": "1.2, 3.4"}
+    """
+    return "event: %s\ndata: %s\n\n" % (event, json.dumps(data, cls=DjangoJSONEncoder))
+
+
+async def stream_channel(channel, first_events, last_event):
+    """
+    Yields `first_events`, then every message published to `channel` until
+    `last_event` or STREAM_MAX_DURATION. A comment is sent every
+    STREAM_HEARTBEAT seconds to keep the connection open.
+    `first_events` is an async callable, it runs after subscribing so no message is missed.
+    """
+    subscription = hub.subscribe(channel)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.STREAM_MAX_DURATION
+    try:
+        for event, data in await first_events():
+            yield sse_event(event, data)
+
+        while loop.time() < deadline:
+            try:
+                message = await asyncio.wait_for(subscription.get(), timeout=settings.STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+
+            yield sse_event(message["event"], message)
+            if message["event"] == last_event:
+                break
+    finally:
+        hub.unsubscribe(subscription)
+
+
+def event_stream_response(events):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Ask nginx not to buffer the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+# =========
+# CUSTOMER
+# =========
+
+async def customer_stream_driver_location(request):
+    """
+      params:
+        1. access_token
+      return:
+        text/event-stream of
+          event: location ---> {"event": "location", "location": "lat, long"}
+          event: delivered ---> {"event": "delivered", "order_id": 1}, the stream ends
+        or {"location": ...} when there is no order on the way, or without ASGI.
+    """
+    identity = await aresolve_token(request.GET.get("access_token"))
+    if identity is None or identity.customer_id is None:
+        return JsonResponse({"status": "failed", "error": "Invalid access token."}, status=401)
+
+    current_order = await Order.objects.filter(
+        customer_id=identity.customer_id,
+        status=Order.ONTHEWAY
+    ).select_related("driver").alast()
+
+    if current_order is None or not isinstance(request, ASGIRequest):
+        # Same answer as customer_get_driver_location
+        return JsonResponse({"location": current_location(current_order.driver) if current_order else None})
+
+    async def first_location():
+        position = location_buffer.get(current_order.driver_id)
+        if position:
+            location = position.location
+        else:
+            location = await Driver.objects.filter(id=current_order.driver_id)\
+                .values_list("location", flat=True).afirst()
+        return [("location", {"event": "location", "location": location})]
+
+    return event_stream_response(
+        stream_channel(driver_channel(current_order.driver_id), first_location, "delivered")
+    )
+
+
+# ============
+# RESTAURANT
+# ============
+
+async def restaurant_stream_orders(request):
+    """
+    Dashboard of the signed in restaurant.
+      return:
+        text/event-stream of
+          event: order ---> {"event": "order", "order": {"id": 1, "customer": ..., "order_details": [...], ...}}
+        sent as soon as a new order is committed.
+    """
+    # request.user loads the session and the user from the database
+    def signed_in_user_id():
+        return request.user.id if request.user.is_authenticated else None
+
+    user_id = await sync_to_async(signed_in_user_id)()
+    if user_id is None:
+        return JsonResponse({"status": "failed", "error": "Sign in required."}, status=401)
+
+    restaurant_id = await Restaurant.objects.filter(user_id=user_id).values_list("id", flat=True).afirst()
+    if restaurant_id is None:
+        return JsonResponse({"status": "failed", "error": "Restaurant not found."}, status=404)
+
+    if not isinstance(request, ASGIRequest):
+        # The dashboard falls back to polling restaurant/order/notification/
+        return JsonResponse({"status": "failed", "error": "Streaming needs an ASGI server."}, status=501)
+
+    async def no_events():
+        return []
+
+    return event_stream_response(
+        stream_channel(restaurant_channel(restaurant_id), no_events, None)
+    )
+
+
+# ========
+# DRIVER
+# =========
+
+async def driver_stream_ready_orders(request):
+    """
+      params:
+        1. access_token
+      return:
+        text/event-stream of
+          event: ready ---> {"event": "ready", "restaurant_id": 1, "order_ids": [1, 2]}
+        sent when a restaurant marks orders ready, load them with driver/order/ready/.
+    """
+    identity = await aresolve_token(request.GET.get("access_token"))
+    if identity is None or identity.driver_id is None:
+        return JsonResponse({"status": "failed", "error": "Invalid access token."}, status=401)
+
+    if not isinstance(request, ASGIRequest):
+        # The app keeps polling driver/order/ready/
+        return JsonResponse({"status": "failed", "error": "Streaming needs an ASGI server."}, status=501)
+
+    async def no_events():
+        return []
+
+    return event_stream_response(
+        stream_channel(ready_orders_channel(), no_events, None)
+    )
@@ -1,3 +1,1525 @@
-from django.test import TestCase
+import asyncio
+import base64
+import csv
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from unittest import mock
+from zoneinfo import ZoneInfo
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections, OperationalError
+from django.test import AsyncClient, Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, resolve
+from django.utils import timezone
+from oauth2_provider.models import AccessToken
+import stripe
+from coreapp.models import Restaurant, Meal, Customer, Driver, Order, OrderDetails, TrajectorySegment, \
+    RestaurantDailyStats, RestaurantMealStats, RestaurantDriverStats
+from coreapp.orders import place_order, claim_order, deliver_order, mark_orders_ready, OrderError
+from coreapp.benchmark import run_benchmark, coreapp_routes
+from coreapp.geo import ready_orders
+from coreapp.dispatch import assign, dispatch_orders, linear_sum_assignment
+from coreapp.locations import location_buffer
+from coreapp.tokens import token_cache, resolve_token
+from coreapp import async_apis, menus, urls as coreapp_urls
+from coreapp.images import image_url, image_url_cache
+from coreapp.metrics import Histogram, METRICS, record_query, registry
+from coreapp.profiling import make_profile_token
+from coreapp.payments import Gateway, FakeGateway, StripeGateway, get_gateway
+from coreapp.reports import daily_totals
+from coreapp.rollups import rebuild_rollups
+from coreapp.pubsub import Hub, hub as pubsub_hub, driver_channel, restaurant_channel
+from coreapp.seed import seed_data
+from coreapp.streams import sse_event
+from coreapp.serializers import OrderSerializer, eager_load
 
 # Create your tests here.
+
+class FoodTaskerData:
+    """
+    A restaurant with meals, a customer and a driver, each with an access token.
+    """
+    @classmethod
+    def create_test_data(cls):
+        restaurant_user = User.objects.create_user("restaurant", password="password")
+        cls.restaurant = Restaurant.objects.create(
+            user=restaurant_user, name="Restaurant", phone="1", address="Address", logo="image/upload/v1/logo.jpg"
+        )
+        cls.meals = [
+            Meal.objects.create(
+                restaurant=cls.restaurant, name="Meal %s" % i, short_description="Meal",
+                image="image/upload/v1/meal.jpg", price=i + 1
+            )
+            for i in range(3)
+        ]
+
+        customer_user = User.objects.create_user("customer", first_name="Customer")
+        cls.customer = Customer.objects.create(user=customer_user, avatar="avatar")
+        cls.driver = cls.create_driver("driver")
+
+        expires = timezone.now() + timedelta(hours=1)
+        AccessToken.objects.create(user=customer_user, token="customer-token", expires=expires)
+        AccessToken.objects.create(user=cls.driver.user, token="driver-token", expires=expires)
+
+    @classmethod
+    def create_driver(cls, username):
+        driver_user = User.objects.create_user(username, first_name=username)
+        return Driver.objects.create(user=driver_user, avatar="avatar")
+
+    def create_order(self, status, driver=None):
+        order = Order.objects.create(
+            customer=self.customer, restaurant=self.restaurant, driver=driver,
+            address="Address", total=3, status=status
+        )
+        OrderDetails.objects.bulk_create([
+            OrderDetails(order=order, meal=meal, quantity=1, sub_total=meal.price) for meal in self.meals
+        ])
+        return order
+
+
+# Locations are written in the request, the write-behind thread would write outside the test's transaction
+@override_settings(LOCATION_FLUSH_INTERVAL=0)
+class FoodTaskerTestCase(FoodTaskerData, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_test_data()
+
+
+class QueryPlanTest(FoodTaskerTestCase):
+    """
+    Runs the endpoints, asks the database for the plan of every query they
+    made on the order tables and fails if one of them scans a whole table.
+    """
+    CHECKED_TABLES = ("coreapp_order", "coreapp_orderdetails")
+    # (url, plan step) of the full scans which are meant to be, none so far
+    ALLOWED_SCANS = set()
+
+    def full_scans(self, sql):
+        if connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+                plan = [row[-1] for row in cursor.fetchall()]
+            # Only "SEARCH coreapp_order USING INDEX ..." reads part of a table.
+            # "SCAN coreapp_order USING INDEX ..." reads the whole index, it is a full scan too.
+            return [
+                step for step in plan
+                if re.match(r"SCAN (TABLE )?(%s)\b" % "|".join(self.CHECKED_TABLES), step)
+            ]
+
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                # The test tables are tiny, make the planner show whether an index can be used
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute("EXPLAIN " + sql)
+                plan = [row[0] for row in cursor.fetchall()]
+            return [
+                step for step in plan
+                if re.search(r"Seq Scan on (%s)\b" % "|".join(self.CHECKED_TABLES), step)
+            ]
+
+        self.skipTest("No query plan check for %s" % connection.vendor)
+
+    def assertNoFullScans(self, method, url, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data or {})
+        self.assertLess(response.status_code, 400, url)
+
+        for query in queries.captured_queries:
+            sql = query["sql"]
+            if not sql.startswith(("SELECT", "UPDATE", "DELETE")):
+                continue
+            if not any('"%s"' % table in sql for table in self.CHECKED_TABLES):
+                continue
+            scans = [step for step in self.full_scans(sql) if (url, step) not in self.ALLOWED_SCANS]
+            self.assertEqual(scans, [], "%s %s\n%s" % (method.upper(), url, sql))
+
+    def test_index_scan_is_a_full_scan(self):
+        # Reads every entry of an index, as slow as reading the table
+        sql = 'SELECT "restaurant_id", "created_at" FROM "coreapp_order"'
+        self.assertNotEqual(self.full_scans(sql), [])
+        sql = 'SELECT "id" FROM "coreapp_order" WHERE "restaurant_id" = 1 AND "status" = 1'
+        self.assertEqual(self.full_scans(sql), [])
+
+    def test_customer_apis(self):
+        self.create_order(Order.ONTHEWAY, driver=self.driver)
+        token = {"access_token": "customer-token"}
+
+        self.assertNoFullScans("get", "/api/customer/order/latest/", token)
+        self.assertNoFullScans("get", "/api/customer/order/latest_status/", token)
+        self.assertNoFullScans("get", "/api/customer/driver/location/", token)
+        self.assertNoFullScans("post", "/api/customer/order/add/", {
+            **token,
+            "restaurant_id": self.restaurant.id,
+            "address": "Address",
+            "order_details": json.dumps([{"meal_id": meal.id, "quantity": 1} for meal in self.meals]),
+        })
+
+    def test_driver_apis(self):
+        for i in range(3):
+            self.create_order(Order.READY)
+        token = {"access_token": "driver-token"}
+
+        self.assertNoFullScans("get", "/api/driver/order/ready/", {"page_size": 2})
+        next_cursor = self.client.get("/api/driver/order/ready/", {"page_size": 2}).json()["next"]
+        self.assertNoFullScans("get", "/api/driver/order/ready/", {"cursor": next_cursor})
+
+        order = Order.objects.filter(status=Order.READY).first()
+        self.assertNoFullScans("post", "/api/driver/order/pick/", {**token, "order_id": order.id})
+        self.assertNoFullScans("get", "/api/driver/order/latest/", token)
+        self.assertNoFullScans("post", "/api/driver/order/complete/", {**token, "order_id": order.id})
+        self.assertNoFullScans("get", "/api/driver/order/revenue/", token)
+
+    def test_restaurant_pages(self):
+        self.create_order(Order.COOKING)
+        self.create_order(Order.DELIVERED, driver=self.driver)
+        self.client.force_login(self.restaurant.user)
+
+        self.assertNoFullScans("get", "/api/restaurant/order/notification/%s/" % (timezone.now() - timedelta(minutes=1)).isoformat())
+        self.assertNoFullScans("get", "/restaurant/order/")
+        self.assertNoFullScans("get", "/restaurant/report/")
+
+
+class TokenCacheTest(FoodTaskerTestCase):
+    def setUp(self):
+        token_cache.clear()
+
+    def test_cached_resolution(self):
+        with self.assertNumQueries(1):
+            identity = resolve_token("customer-token")
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_token("customer-token"), identity)
+        self.assertEqual(identity.customer_id, self.customer.id)
+        self.assertIsNone(identity.driver_id)
+
+        self.client.force_login(User.objects.create(username="staff", is_staff=True))
+        response = self.client.get("/api/metrics/")
+        self.assertRegex(response.content.decode(), r'foodtasker_cache_hits_total\{cache="token"\} [1-9]')
+
+    def test_revocation(self):
+        self.assertIsNotNone(resolve_token("customer-token"))
+        AccessToken.objects.get(token="customer-token").delete()
+        self.assertIsNone(resolve_token("customer-token"))
+
+        response = self.client.get("/api/customer/order/latest/", {"access_token": "customer-token"})
+        self.assertEqual(response.status_code, 401)
+
+    def test_expiry(self):
+        # The cached entry does not outlive the token
+        AccessToken.objects.create(user=self.customer.user, token="short-token", expires=timezone.now() + timedelta(seconds=0.2))
+        self.assertIsNotNone(resolve_token("short-token"))
+        time.sleep(0.3)
+        self.assertIsNone(resolve_token("short-token"))
+
+
+class PlaceOrderTest(FoodTaskerTestCase):
+    def place(self, meals):
+        return place_order(self.customer.id, self.restaurant.id, "Address", [
+            {"meal_id": meal.id, "quantity": 2} for meal in meals
+        ])
+
+    def test_constant_queries(self):
+        def queries(meals):
+            with CaptureQueriesContext(connection) as captured:
+                order = self.place(meals)
+            self.assertEqual(order.total, sum(meal.price * 2 for meal in meals))
+            self.assertEqual(order.order_details.count(), len(meals))
+            Order.objects.filter(id=order.id).update(status=Order.DELIVERED)
+            return len(captured)
+
+        self.assertEqual(queries(self.meals[:1]), queries(self.meals))
+
+    def test_one_outstanding_order(self):
+        self.place(self.meals)
+        with self.assertRaisesMessage(OrderError, "Your last order must be completed."):
+            self.place(self.meals)
+        self.assertEqual(Order.objects.count(), 1)
+
+
+class PlaceOrderStressTest(FoodTaskerData, TransactionTestCase):
+    """
+    The same customer sends their cart many times at the same moment,
+    only one order may be placed.
+    """
+    REQUESTS = 8
+
+    def setUp(self):
+        self.create_test_data()
+
+    def test_exactly_one_order(self):
+        barrier = threading.Barrier(self.REQUESTS)
+        placed = []
+
+        def place():
+            try:
+                barrier.wait()
+                # SQLite answers "locked" instead of waiting for a concurrent write
+                for attempt in range(100):
+                    try:
+                        placed.append(place_order(self.customer.id, self.restaurant.id, "Address", [
+                            {"meal_id": self.meals[0].id, "quantity": 1}
+                        ]))
+                        return
+                    except OperationalError:
+                        continue
+                raise AssertionError("The database stayed locked")
+            except OrderError:
+                pass
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=place) for i in range(self.REQUESTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(placed), 1)
+        self.assertEqual(Order.objects.filter(customer=self.customer).count(), 1)
+
+
+class PaginationTest(FoodTaskerTestCase):
+    def pages(self, url, key, **params):
+        ids = []
+        cursor = None
+        while True:
+            response = self.client.get(url, {**params, **({"cursor": cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            ids.append([item["id"] for item in data[key]])
+            cursor = data["next"]
+            if cursor is None:
+                return ids
+
+    def test_stable_order_across_pages(self):
+        orders = [self.create_order(Order.READY) for i in range(5)]
+        first = self.client.get("/api/driver/order/ready/", {"page_size": 2}).json()
+        # A new order comes in while the driver reads the next pages, it is not repeated nor skipped
+        self.create_order(Order.READY)
+
+        ids = [[item["id"] for item in first["orders"]]]
+        ids += self.pages("/api/driver/order/ready/", "orders", page_size=2, cursor=first["next"])
+        self.assertEqual(ids, [[orders[4].id, orders[3].id], [orders[2].id, orders[1].id], [orders[0].id]])
+
+    def test_last_page_has_no_next(self):
+        for i in range(2):
+            Restaurant.objects.create(user=User.objects.create_user("page-%s" % i), name="R", phone="1", address="A", logo="logo")
+        ids = self.pages("/api/customer/restaurants/", "restaurants", page_size=3)
+        self.assertEqual([len(page) for page in ids], [3])
+        self.assertEqual(self.pages("/api/customer/restaurants/", "restaurants", page_size=1), [[i] for i in sorted(Restaurant.objects.values_list("id", flat=True), reverse=True)])
+
+    def test_invalid_cursor(self):
+        for cursor in ("!!!", "e30", base64.urlsafe_b64encode(b"[1]").decode(), base64.urlsafe_b64encode(b'{"id": "x"}').decode()):
+            for url in ("/api/driver/order/ready/", "/api/customer/restaurants/"):
+                response = self.client.get(url, {"cursor": cursor})
+                self.assertEqual(response.status_code, 400, cursor)
+                self.assertEqual(response.json(), {"status": "failed", "error": "Invalid cursor."})
+
+    @override_settings(API_MAX_PAGE_SIZE=3)
+    def test_page_size_cap(self):
+        for i in range(5):
+            self.create_order(Order.READY)
+        for page_size, expected in (("100", 3), ("2", 2), ("0", 1), ("x", 3)):
+            response = self.client.get("/api/driver/order/ready/", {"page_size": page_size})
+            self.assertEqual(len(response.json()["orders"]), expected, page_size)
+
+
+class ConditionalGetTest(FoodTaskerTestCase):
+    def setUp(self):
+        # Menu snapshots of earlier tests
+        cache.clear()
+
+    def get(self, url, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        return self.client.get(url, **headers)
+
+    def test_restaurants(self):
+        response = self.get("/api/customer/restaurants/")
+        etag = response["ETag"]
+        self.assertEqual(response.status_code, 200)
+
+        # One query for the page, which also gives the ETag
+        with self.assertNumQueries(1):
+            response = self.get("/api/customer/restaurants/", etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        # A meal is not part of the list
+        self.meals[0].save()
+        self.assertEqual(self.get("/api/customer/restaurants/", etag).status_code, 304)
+
+        self.restaurant.name = "Renamed"
+        self.restaurant.save()
+        response = self.get("/api/customer/restaurants/", etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()["restaurants"][0]["name"], "Renamed")
+
+    def test_meals(self):
+        url = "/api/customer/meals/%s" % self.restaurant.id
+        etag = self.get(url)["ETag"]
+        self.assertEqual(self.get(url, etag).status_code, 304)
+
+        self.meals[0].price = 10
+        self.meals[0].save()
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_save_with_update_fields(self):
+        list_etag = self.get("/api/customer/restaurants/")["ETag"]
+        url = "/api/customer/meals/%s" % self.restaurant.id
+        menu_etag = self.get(url)["ETag"]
+
+        restaurant = Restaurant.objects.get(id=self.restaurant.id)
+        restaurant.name = "Renamed"
+        restaurant.save(update_fields=["name"])
+        # The stamps put in the cache are the ones of the row
+        self.assertEqual(
+            Restaurant.objects.filter(id=restaurant.id).values_list("version", "menu_version").get(),
+            (restaurant.version, restaurant.menu_version)
+        )
+
+        response = self.get("/api/customer/restaurants/", list_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], list_etag)
+        self.assertNotEqual(self.get(url, menu_etag)["ETag"], menu_etag)
+        # The new snapshot is current, it is not built again
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get(url).status_code, 200)
+
+
+class MenuSnapshotTest(FoodTaskerTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def menu(self, restaurant=None):
+        response = self.client.get("/api/customer/meals/%s" % (restaurant or self.restaurant).id)
+        return {meal["id"]: meal for meal in response.json()["meals"]}
+
+    def test_edits_show_up(self):
+        self.assertEqual(set(self.menu()), {meal.id for meal in self.meals})
+
+        self.meals[0].price = 42
+        self.meals[0].save()
+        self.assertEqual(self.menu()[self.meals[0].id]["price"], 42)
+
+        self.meals[1].delete()
+        self.assertNotIn(self.meals[1].id, self.menu())
+
+        other = Restaurant.objects.create(user=User.objects.create_user("menu-other"), name="Other", phone="2", address="A", logo="logo")
+        self.assertEqual(self.menu(other), {})
+        self.meals[2].restaurant = other
+        self.meals[2].save()
+        self.assertEqual(set(self.menu()), {self.meals[0].id})
+        self.assertEqual(set(self.menu(other)), {self.meals[2].id})
+
+    def test_snapshot_built_before_an_edit(self):
+        self.menu()
+        body_key = menus._body_key(self.restaurant.id, "http://testserver/")
+        stale = cache.get(body_key)
+
+        self.meals[0].price = 42
+        self.meals[0].save()
+        # A snapshot of the old menu, built by a slower request, is stored after the edit
+        cache.set(body_key, stale)
+        self.assertEqual(self.menu()[self.meals[0].id]["price"], 42)
+
+    def test_absolute_image_urls(self):
+        # eg. a storage which gives relative urls
+        with mock.patch("coreapp.serializers.image_url", return_value="/media/meal.jpg"):
+            menu = self.menu()
+        self.assertEqual(menu[self.meals[1].id]["image"], "http://testserver/media/meal.jpg")
+
+
+class ImageUrlTest(FoodTaskerTestCase):
+    def setUp(self):
+        image_url_cache.clear()
+
+    def test_variants(self):
+        restaurant = self.client.get("/api/customer/restaurants/").json()["restaurants"][0]
+        self.assertEqual(set(restaurant["logo_variants"]), set(settings.CLOUDINARY_IMAGE_VARIANTS))
+        self.assertIn("/image/upload/c_fill,f_auto,h_200,q_auto,w_200/v1/logo.jpg", restaurant["logo_variants"]["thumbnail"])
+        self.assertIn("/image/upload/c_limit,f_auto,q_auto,w_1080/v1/logo.jpg", restaurant["logo_variants"]["full"])
+        self.assertTrue(restaurant["logo"].endswith("/image/upload/v1/logo.jpg"))
+
+    def test_memoized_and_dropped_with_the_image(self):
+        field = Meal.image.field
+        meal = Meal.objects.get(id=self.meals[0].id)
+        url = image_url(meal.image, field)
+        with mock.patch("cloudinary.CloudinaryResource.build_url") as build_url:
+            self.assertEqual(image_url(meal.image, field), url)
+            self.assertEqual(image_url("image/upload/v1/meal.jpg", field), url)
+        build_url.assert_not_called()
+
+        # A new image drops the urls of the old one, without reading the row again
+        old_key = ("image", "upload", "meal", "1", "jpg", None)
+        self.assertIsNotNone(image_url_cache.get(old_key))
+        meal.image = "image/upload/v2/new.jpg"
+        with CaptureQueriesContext(connection) as captured:
+            meal.save()
+        self.assertFalse([query for query in captured if query["sql"].startswith("SELECT")])
+        self.assertIsNone(image_url_cache.get(old_key))
+
+    def test_restaurant_save_does_not_read_the_row(self):
+        restaurant = Restaurant.objects.get(id=self.restaurant.id)
+        with self.assertNumQueries(1):
+            restaurant.save()
+        # Nor a version bump
+        with self.assertNumQueries(1):
+            restaurant.save(update_fields=["version", "menu_version"])
+        # A logo which was not loaded is read to drop its urls
+        image_url(Restaurant.objects.get(id=self.restaurant.id).logo, Restaurant.logo.field)
+        restaurant = Restaurant.objects.defer("logo").get(id=self.restaurant.id)
+        restaurant.logo = "image/upload/v2/new-logo.jpg"
+        with self.assertNumQueries(2):
+            restaurant.save()
+        self.assertIsNone(image_url_cache.get(("image", "upload", "logo", "1", "jpg", None)))
+
+
+class HubTest(TestCase):
+    def test_publish_subscribe(self):
+        hub = Hub(maxsize=2)
+
+        async def listen():
+            subscription = hub.subscribe("channel")
+            self.assertTrue(hub.has_subscribers("channel"))
+            # Published from another thread, handed to this event loop
+            thread = threading.Thread(target=lambda: [hub.publish("channel", {"n": n}) for n in range(3)])
+            thread.start()
+            thread.join()
+            self.assertEqual(hub.publish("other", {"n": 0}), 0)
+
+            await asyncio.sleep(0)
+            # The queue holds 2 messages, the oldest one was dropped
+            messages = [await subscription.get(), await subscription.get()]
+            hub.unsubscribe(subscription)
+            return messages
+
+        self.assertEqual(asyncio.run(listen()), [{"n": 1}, {"n": 2}])
+        self.assertFalse(hub.has_subscribers("channel"))
+
+    def test_closed_event_loop(self):
+        hub = Hub()
+
+        async def subscribe():
+            return hub.subscribe("channel")
+
+        asyncio.run(subscribe())
+        self.assertEqual(hub.publish("channel", {}), 1)
+        self.assertFalse(hub.has_subscribers("channel"))
+
+    def test_sse_event(self):
+        self.assertEqual(sse_event("location", {"location": "1.5, 2"}), 'event: location\ndata: {"location": "1.5, 2"}\n\n')
+
+
+class DriverLocationStreamTest(FoodTaskerTestCase):
+    def test_json_without_asgi(self):
+        Driver.objects.filter(id=self.driver.id).update(location="1.5, 2")
+        self.create_order(Order.ONTHEWAY, driver=self.driver)
+        response = self.client.get("/api/customer/driver/location/stream/", {"access_token": "customer-token"})
+        self.assertEqual(response.json(), {"location": "1.5, 2"})
+
+        # No order on the way
+        Order.objects.update(status=Order.DELIVERED)
+        response = self.client.get("/api/customer/driver/location/stream/", {"access_token": "customer-token"})
+        self.assertEqual(response.json(), {"location": None})
+
+    async def test_driver_location_stream(self):
+        await Driver.objects.filter(id=self.driver.id).aupdate(location="1.5, 2")
+        order = await Order.objects.acreate(
+            customer=self.customer, restaurant=self.restaurant, driver=self.driver, address="Address", total=3, status=Order.ONTHEWAY
+        )
+
+        response = await self.async_client.get("/api/customer/driver/location/stream/", {"access_token": "customer-token"})
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = response.streaming_content.__aiter__()
+        self.assertEqual(await events.__anext__(), b'event: location\ndata: {"event": "location", "location": "1.5, 2"}\n\n')
+
+        pubsub_hub.publish(driver_channel(self.driver.id), {"event": "location", "location": "1.6, 2"})
+        pubsub_hub.publish(driver_channel(self.driver.id), {"event": "delivered", "order_id": order.id})
+        self.assertIn(b'"location": "1.6, 2"', await events.__anext__())
+        self.assertTrue((await events.__anext__()).startswith(b"event: delivered"))
+        # The stream ends with the delivery
+        with self.assertRaises(StopAsyncIteration):
+            await events.__anext__()
+        self.assertFalse(pubsub_hub.has_subscribers(driver_channel(self.driver.id)))
+
+
+class RestaurantOrderStreamTest(FoodTaskerTestCase):
+    def test_new_order_published_on_commit(self):
+        self.client.force_login(self.restaurant.user)
+        loop = asyncio.new_event_loop()
+        try:
+            async def subscribe():
+                return pubsub_hub.subscribe(restaurant_channel(self.restaurant.id))
+            subscription = loop.run_until_complete(subscribe())
+
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                order = place_order(self.customer.id, self.restaurant.id, "Address", [{"meal_id": self.meals[0].id, "quantity": 2}])
+            # Nothing is sent before the commit
+            self.assertTrue(subscription.queue.empty())
+            for callback in callbacks:
+                callback()
+
+            message = loop.run_until_complete(asyncio.wait_for(subscription.get(), 1))
+            pubsub_hub.unsubscribe(subscription)
+        finally:
+            loop.close()
+
+        self.assertEqual(message["event"], "order")
+        self.assertEqual(message["order"]["id"], order.id)
+        self.assertEqual(message["order"]["order_details"], [
+            {"meal": self.meals[0].name, "price": self.meals[0].price, "quantity": 2, "sub_total": self.meals[0].price * 2}
+        ])
+
+    def test_json_without_asgi(self):
+        self.client.force_login(self.restaurant.user)
+        self.assertEqual(self.client.get("/api/restaurant/order/stream/").status_code, 501)
+        self.assertEqual(self.client.get("/api/driver/order/ready/stream/", {"access_token": "driver-token"}).status_code, 501)
+
+    async def test_order_stream(self):
+        self.assertEqual((await self.async_client.get("/api/restaurant/order/stream/")).status_code, 401)
+        await sync_to_async(self.async_client.force_login)(self.restaurant.user)
+
+        response = await self.async_client.get("/api/restaurant/order/stream/")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        # The stream subscribes when it starts
+        first_event = asyncio.ensure_future(response.streaming_content.__aiter__().__anext__())
+        await asyncio.sleep(0)
+
+        def place():
+            with self.captureOnCommitCallbacks(execute=True):
+                return place_order(self.customer.id, self.restaurant.id, "Address", [{"meal_id": self.meals[0].id, "quantity": 1}])
+
+        order = await sync_to_async(place)()
+        event = await asyncio.wait_for(first_event, 1)
+        self.assertTrue(event.startswith(b"event: order\ndata: "))
+        self.assertEqual(json.loads(event.split(b"data: ", 1)[1])["order"]["id"], order.id)
+
+
+class DriverRevenueTest(FoodTaskerTestCase):
+    def deliver_at(self, created_at, total):
+        order = self.create_order(Order.DELIVERED, self.driver)
+        Order.objects.filter(id=order.id).update(created_at=created_at, total=total)
+
+    def revenue(self, **params):
+        return self.client.get("/api/driver/order/revenue/", {"access_token": "driver-token", **params}).json()
+
+    def test_local_midnight(self):
+        # 18:29 and 18:31 UTC are 23:59 and 00:01 in Kolkata (UTC+5:30)
+        self.deliver_at(datetime(2024, 1, 1, 18, 29, tzinfo=dt_timezone.utc), 10)
+        self.deliver_at(datetime(2024, 1, 1, 18, 31, tzinfo=dt_timezone.utc), 20)
+
+        params = {"start": "2024-01-01", "end": "2024-01-03"}
+        self.assertEqual(self.revenue(tz="Asia/Kolkata", **params)["days"], {"2024-01-01": 10, "2024-01-02": 20})
+        self.assertEqual(self.revenue(tz="UTC", **params)["days"], {"2024-01-01": 30, "2024-01-02": 0})
+
+    def test_range_limits(self):
+        # end is excluded
+        self.deliver_at(datetime(2024, 1, 3, 12, tzinfo=dt_timezone.utc), 10)
+        self.assertEqual(self.revenue(start="2024-01-01", end="2024-01-03", tz="UTC")["days"], {"2024-01-01": 0, "2024-01-02": 0})
+
+        for params in (
+            {"start": "2024-01-03", "end": "2024-01-03"},
+            {"start": "2024-01-01"},
+            {"start": "2024-01-01", "end": "tomorrow"},
+            {"start": "2023-01-01", "end": "2024-01-03"},
+            {"period": "year"},
+            {"tz": "Mars/Olympus"},
+        ):
+            self.assertEqual(self.revenue(**params)["status"], "failed", params)
+
+    def test_key_formats(self):
+        week = self.revenue()
+        self.assertEqual(list(week["revenue"]), ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"])
+        self.assertEqual(len(week["days"]), 7)
+
+        # A custom range from a Monday to the next one is still keyed by date
+        monday = self.revenue(start="2024-01-01", end="2024-01-08")
+        self.assertNotIn("revenue", monday)
+        self.assertEqual(list(monday["days"])[0], "2024-01-01")
+        self.assertNotIn("revenue", self.revenue(period="month"))
+
+
+class RollupsTest(FoodTaskerTestCase):
+    def setUp(self):
+        Restaurant.objects.filter(id=self.restaurant.id).update(timezone="Asia/Kolkata")
+
+    def deliver_at(self, created_at):
+        order = self.create_order(Order.ONTHEWAY, self.driver)
+        Order.objects.filter(id=order.id).update(created_at=created_at)
+        deliver_order(order.id, self.driver.id)
+
+    def rollups(self):
+        return (
+            sorted(RestaurantDailyStats.objects.values_list("restaurant_id", "date", "revenue", "orders")),
+            sorted(RestaurantMealStats.objects.values_list("restaurant_id", "meal_id", "quantity")),
+            sorted(RestaurantDriverStats.objects.values_list("restaurant_id", "driver_id", "deliveries")),
+        )
+
+    def test_rebuild_matches_deliveries(self):
+        # 18:29 and 18:31 UTC are 23:59 and 00:01 in Kolkata (UTC+5:30)
+        for day in range(1, 4):
+            self.deliver_at(datetime(2024, 1, day, 18, 29, tzinfo=dt_timezone.utc))
+            self.deliver_at(datetime(2024, 1, day, 18, 31, tzinfo=dt_timezone.utc))
+        # Not delivered, so in no rollup
+        self.create_order(Order.ONTHEWAY, self.driver)
+
+        delivered = self.rollups()
+        self.assertEqual([(date.isoformat(), orders) for _, date, _, orders in delivered[0]], [
+            ("2024-01-01", 1), ("2024-01-02", 2), ("2024-01-03", 2), ("2024-01-04", 1),
+        ])
+        self.assertEqual([quantity for _, _, quantity in delivered[1]], [6, 6, 6])
+        self.assertEqual(delivered[2], [(self.restaurant.id, self.driver.id, 6)])
+
+        rebuild_rollups()
+        self.assertEqual(self.rollups(), delivered)
+
+        # The days of the report queries
+        totals = daily_totals(
+            Order.objects.filter(restaurant=self.restaurant, status=Order.DELIVERED),
+            date(2024, 1, 1), date(2024, 1, 5), ZoneInfo("Asia/Kolkata")
+        )
+        self.assertEqual(
+            [(day, total["total"], total["orders"]) for day, total in totals.items()],
+            [(day, revenue, orders) for _, day, revenue, orders in delivered[0]]
+        )
+
+    def test_backfill_is_idempotent(self):
+        for day in range(1, 3):
+            self.deliver_at(datetime(2024, 1, day, 12, tzinfo=dt_timezone.utc))
+        delivered = self.rollups()
+
+        for i in range(2):
+            call_command("backfill_rollups", stdout=io.StringIO())
+            self.assertEqual(self.rollups(), delivered)
+
+    def test_admin_never_delivers(self):
+        admin_user = User.objects.create_superuser("admin", password="password")
+        self.client.force_login(admin_user)
+        order = self.create_order(Order.ONTHEWAY, self.driver)
+
+        change = self.client.get("/admin/coreapp/order/%s/change/" % order.id)
+        self.assertNotContains(change, 'name="status"')
+        add = self.client.get("/admin/coreapp/order/add/")
+        self.assertContains(add, 'name="status"')
+        self.assertNotContains(add, '<option value="%s"' % Order.DELIVERED)
+
+
+# The urls of foodtasker.urls with ASYNC_APIS = True, coreapp.urls picks the
+# views of async_apis.py or apis.py only once, when it is imported
+urlpatterns = [
+    path("api/", include([
+        path(str(pattern.pattern), getattr(async_apis, pattern.callback.__name__))
+        if getattr(pattern, "callback", None) and pattern.callback.__module__ == "coreapp.apis" else pattern
+        for pattern in coreapp_urls.urlpatterns
+    ])),
+]
+
+
+class AsyncApisTest(FoodTaskerTestCase):
+    """
+    Runs the views of async_apis.py with an AsyncClient and checks that they
+    answer like the ones of apis.py.
+    """
+    def setUp(self):
+        cache.clear()
+        # Both make sure the views are csrf exempt
+        self.sync_client = Client(enforce_csrf_checks=True)
+        self.async_csrf_client = AsyncClient(enforce_csrf_checks=True)
+
+    def async_request(self, method, url, data=None, **kwargs):
+        with override_settings(ROOT_URLCONF=__name__):
+            self.assertTrue(asyncio.iscoroutinefunction(resolve(url.split("?")[0]).func), url)
+            async def request():
+                return await getattr(self.async_csrf_client, method)(url, data or {}, **kwargs)
+            return async_to_sync(request)()
+
+    def assertSameResponse(self, method, url, data=None, **kwargs):
+        sync_response = getattr(self.sync_client, method)(url, data or {}, **kwargs)
+        async_response = self.async_request(method, url, data, **kwargs)
+        self.assertEqual(async_response.status_code, sync_response.status_code, url)
+        self.assertEqual(async_response.content, sync_response.content, url)
+        self.assertEqual(async_response.get("ETag"), sync_response.get("ETag"), url)
+        return async_response
+
+    def test_customer_apis(self):
+        # akeyset_paginate and the conditional GET
+        restaurants = self.assertSameResponse("get", "/api/customer/restaurants/")
+        self.assertEqual(len(restaurants.json()["restaurants"]), 1)
+        not_modified = self.assertSameResponse(
+            "get", "/api/customer/restaurants/", headers={"If-None-Match": restaurants["ETag"]}
+        )
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(self.assertSameResponse("get", "/api/customer/restaurants/", {"cursor": "!!!"}).status_code, 400)
+
+        # aget_menu_snapshot, built by the sync view then read by the async one and the other way round
+        for i in range(2):
+            meals = self.assertSameResponse("get", "/api/customer/meals/%s" % self.restaurant.id)
+            cache.clear()
+        self.assertEqual(len(meals.json()["meals"]), 3)
+
+        # atoken_required
+        for params in ({}, {"access_token": "driver-token"}, {"access_token": "customer-token"}):
+            self.assertSameResponse("get", "/api/customer/order/latest/", params)
+            self.assertSameResponse("get", "/api/customer/order/latest_status/", params)
+
+    def test_customer_add_order(self):
+        order = {
+            "access_token": "customer-token",
+            "restaurant_id": self.restaurant.id,
+            "address": "Address",
+            "order_details": json.dumps([{"meal_id": self.meals[0].id, "quantity": 2}]),
+        }
+        # csrf_exempt, the errors answer like the sync view
+        self.assertSameResponse("post", "/api/customer/order/add/", {**order, "address": ""})
+        self.assertSameResponse("post", "/api/customer/order/add/", {**order, "order_details": "["})
+
+        self.assertEqual(self.async_request("post", "/api/customer/order/add/", order).json(), {"status": "success"})
+        self.assertEqual(Order.objects.get(customer=self.customer).total, self.meals[0].price * 2)
+        self.assertSameResponse("post", "/api/customer/order/add/", order)
+        self.assertSameResponse("get", "/api/customer/order/latest/", {"access_token": "customer-token"})
+
+    def test_driver_apis(self):
+        self.create_order(Order.READY)
+        delivered = self.create_order(Order.DELIVERED, self.driver)
+        Order.objects.filter(id=delivered.id).update(created_at=datetime(2024, 1, 2, 12, tzinfo=dt_timezone.utc))
+
+        token = {"access_token": "driver-token"}
+        self.assertSameResponse("get", "/api/driver/order/ready/")
+        self.assertSameResponse("get", "/api/driver/order/latest/", token)
+        self.assertSameResponse("get", "/api/driver/profile/", token)
+        # adaily_totals
+        self.assertSameResponse("get", "/api/driver/order/revenue/", token)
+        revenue = self.assertSameResponse("get", "/api/driver/order/revenue/", {**token, "start": "2024-01-01", "end": "2024-01-04"})
+        self.assertEqual(revenue.json()["days"]["2024-01-02"], 3)
+        self.assertSameResponse("get", "/api/driver/order/revenue/", {**token, "period": "year"})
+
+        # require_post, the sync views fail on a GET
+        pick = self.async_request("get", "/api/driver/order/pick/", token)
+        self.assertEqual(pick.status_code, 405)
+        self.assertEqual(pick.json(), {"status": "failed", "error": "POST is required."})
+
+
+@override_settings(PAYMENT_GATEWAY="fake", FAKE_PAYMENT_LATENCY=0)
+class PaymentIntentTest(FoodTaskerTestCase):
+    def setUp(self):
+        # get_gateway() keeps the gateway of the settings it first saw
+        get_gateway.cache_clear()
+        self.addCleanup(get_gateway.cache_clear)
+
+    def pay(self, total="12.50", cart=None):
+        data = {"access_token": "customer-token", "total": total}
+        if cart is not None:
+            data["order_details"] = json.dumps(cart)
+        return self.client.post("/api/customer/payment_intent/", data).json()
+
+    def test_idempotency_key(self):
+        cart = [{"meal_id": self.meals[0].id, "quantity": 2}]
+        secret = self.pay(cart=cart)["client_secret"]
+        # A retried request gets the same intent
+        self.assertEqual(self.pay(cart=cart)["client_secret"], secret)
+        # Another cart or total is another payment
+        self.assertNotEqual(self.pay(cart=[{"meal_id": self.meals[0].id, "quantity": 3}])["client_secret"], secret)
+        self.assertNotEqual(self.pay(total="13", cart=cart)["client_secret"], secret)
+
+        # The same cart ordered again after the first order is a new payment
+        self.create_order(Order.DELIVERED)
+        self.assertNotEqual(self.pay(cart=cart)["client_secret"], secret)
+
+    def test_fake_gateway(self):
+        gateway = FakeGateway()
+        intent = gateway.create_intent(1250, "usd", "FoodTasker Order", "key")
+        self.assertTrue(intent.id.startswith("pi_fake_"))
+        self.assertEqual(gateway.create_intent(1250, "usd", "FoodTasker Order", "key"), intent)
+        self.assertEqual(async_to_sync(gateway.acreate_intent)(1250, "usd", "FoodTasker Order", "key"), intent)
+        self.assertNotEqual(gateway.create_intent(1250, "usd", "FoodTasker Order", "other key"), intent)
+
+        # A gateway must create intents
+        with self.assertRaises(TypeError):
+            Gateway()
+
+    def test_payment_errors(self):
+        self.assertEqual(self.pay(total="abc"), {"status": "failed", "error": "Total is invalid."})
+        self.assertEqual(self.pay(total="0"), {"status": "failed", "error": "Total must be greater than zero."})
+
+        # An error of Stripe is returned as the "error" field
+        gateway = StripeGateway("sk_test")
+        with mock.patch("coreapp.payments.get_gateway", return_value=gateway), \
+                mock.patch.object(gateway.client.v1.payment_intents, "create",
+                                  side_effect=stripe.StripeError("Your card was declined.")):
+            self.assertEqual(self.pay(), {"status": "failed", "error": "Your card was declined."})
+
+
+@override_settings(METRICS_TOKEN="metrics-token")
+class MetricsTest(FoodTaskerTestCase):
+    VIEW = 'view="coreapp.apis.customer_get_restaurants"'
+
+    def setUp(self):
+        registry.clear()
+        token_cache.clear()
+
+    def scrape(self, **kwargs):
+        kwargs.setdefault("HTTP_AUTHORIZATION", "Bearer metrics-token")
+        response = self.client.get("/api/metrics/", **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_histogram(self):
+        histogram = Histogram((1, 5))
+        for value in (0, 1, 3, 7):
+            histogram.observe(value)
+        # A bucket counts the values less than or equal to its bound
+        self.assertEqual(list(histogram.cumulative()), [(1, 2), (5, 3), ("+Inf", 4)])
+        self.assertEqual((histogram.sum, histogram.count), (11, 4))
+
+        registry.observe('a "view"', {"db_queries": 2})
+        text = registry.render()
+        self.assertIn("# TYPE foodtasker_request_db_queries histogram\n", text)
+        self.assertIn('foodtasker_request_db_queries_bucket{view="a \\"view\\"",le="1"} 0\n', text)
+        self.assertIn('foodtasker_request_db_queries_bucket{view="a \\"view\\"",le="2"} 1\n', text)
+        self.assertIn('foodtasker_request_db_queries_bucket{view="a \\"view\\"",le="+Inf"} 1\n', text)
+        self.assertIn('foodtasker_request_db_queries_count{view="a \\"view\\""} 1\n', text)
+
+    def test_scrape_after_a_request(self):
+        # Every connection counts its queries
+        self.assertIn(record_query, connection.execute_wrappers)
+
+        # One query for the page of restaurants
+        with self.assertNumQueries(1):
+            self.client.get("/api/customer/restaurants/")
+        text = self.scrape()
+
+        self.assertIn('foodtasker_request_db_queries_bucket{%s,le="0"} 0\n' % self.VIEW, text)
+        self.assertIn('foodtasker_request_db_queries_bucket{%s,le="1"} 1\n' % self.VIEW, text)
+        self.assertIn('foodtasker_request_db_queries_bucket{%s,le="+Inf"} 1\n' % self.VIEW, text)
+        self.assertIn('foodtasker_request_db_queries_sum{%s} 1\n' % self.VIEW, text)
+        for metric in METRICS:
+            self.assertIn('foodtasker_request_%s_count{%s} 1\n' % (metric, self.VIEW), text)
+
+    @override_settings(METRICS_SERVER_TIMING=True)
+    def test_server_timing(self):
+        response = self.client.get("/api/customer/restaurants/")
+        self.assertRegex(response["Server-Timing"], r'^db;dur=[\d.]+;desc="\d+ queries", view;dur=[\d.]+, serialization;dur=[\d.]+$')
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_not_sampled(self):
+        self.client.get("/api/customer/restaurants/")
+        self.assertNotIn(self.VIEW, self.scrape())
+
+    def test_token_and_staff(self):
+        # The test client's 127.0.0.1 is not allowed by default, as behind a proxy every request has it
+        self.assertEqual(self.client.get("/api/metrics/").status_code, 403)
+        self.assertEqual(self.client.get("/api/metrics/", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get("/api/metrics/", HTTP_AUTHORIZATION="Bearer ").status_code, 403)
+        self.scrape()
+
+        self.client.force_login(self.restaurant.user)
+        self.assertEqual(self.client.get("/api/metrics/").status_code, 403)
+        User.objects.filter(id=self.restaurant.user.id).update(is_staff=True)
+        self.scrape(HTTP_AUTHORIZATION="")
+
+    @override_settings(METRICS_ALLOWED_IPS=["10.0.0.1"])
+    def test_allowed_ips(self):
+        self.scrape(HTTP_AUTHORIZATION="", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(self.client.get("/api/metrics/", REMOTE_ADDR="10.0.0.2").status_code, 403)
+
+
+class ProfilingTest(FoodTaskerTestCase):
+    URL = "/api/driver/order/ready/"
+
+    def setUp(self):
+        cache.clear()
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        settings_override = override_settings(PROFILING_ENABLED=True, PROFILE_DIR=profile_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def get(self, token, url=URL, client=None):
+        return (client or self.client).get(url, HTTP_X_PROFILE=token)
+
+    def assertProfiled(self, response):
+        self.assertEqual(response["Content-Type"], "text/plain; charset=utf-8")
+        self.assertIn(b"Profile: ", response.content)
+        self.assertTrue(os.path.exists(os.path.join(settings.PROFILE_DIR, response["X-Profile-File"])))
+
+    def assertNotProfiled(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("orders", response.json())
+
+    def test_token(self):
+        token = make_profile_token(self.URL)
+        self.assertProfiled(self.get(token))
+        # Used once
+        self.assertNotProfiled(self.get(token))
+
+        # For another path, tampered, expired
+        self.assertNotProfiled(self.get(make_profile_token("/api/customer/restaurants/")))
+        self.assertNotProfiled(self.get(make_profile_token(self.URL) + "x"))
+        with mock.patch("time.time", return_value=time.time() - settings.PROFILE_TOKEN_MAX_AGE - 1):
+            expired = make_profile_token(self.URL)
+        self.assertNotProfiled(self.get(expired))
+
+    def test_staff(self):
+        self.client.force_login(self.restaurant.user)
+        self.assertNotProfiled(self.client.get(self.URL, {"profile": "1"}))
+        User.objects.filter(id=self.restaurant.user.id).update(is_staff=True)
+        self.assertProfiled(self.client.get(self.URL, {"profile": "1"}))
+
+    def test_disabled(self):
+        with override_settings(PROFILING_ENABLED=False):
+            # The middleware is left out when the client loads the middleware
+            self.assertNotProfiled(self.get(make_profile_token(self.URL), client=Client()))
+
+
+class OrderSerializerQueriesTest(FoodTaskerTestCase):
+    """
+    The queries of the serialized orders do not grow with the number of orders.
+    """
+    def add_orders(self, count, status):
+        for i in range(count):
+            driver = self.create_driver("serializer-%s-%s" % (status, Order.objects.count())) if status != Order.READY else None
+            self.create_order(status, driver=driver)
+
+    def test_serializer(self):
+        def queries(count):
+            self.add_orders(count, Order.ONTHEWAY)
+            with CaptureQueriesContext(connection) as captured:
+                data = OrderSerializer(eager_load(Order.objects.all(), OrderSerializer), many=True).data
+            self.assertEqual(len(data), Order.objects.count())
+            self.assertEqual(len(data[-1]["order_details"]), len(self.meals))
+            return len(captured)
+
+        self.assertEqual(queries(1), queries(9))
+
+    def test_ready_orders_endpoint(self):
+        def queries(count):
+            self.add_orders(count, Order.READY)
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get("/api/driver/order/ready/")
+            self.assertEqual(len(response.json()["orders"]), Order.objects.count())
+            return len(captured)
+
+        self.assertEqual(queries(1), queries(9))
+
+    def test_latest_order_endpoints(self):
+        def queries():
+            counts = []
+            for url, token, key in (
+                ("/api/customer/order/latest/", "customer-token", "last_order"),
+                ("/api/driver/order/latest/", "driver-token", "order"),
+            ):
+                # Resolve the token from the database every time
+                token_cache.clear()
+                with CaptureQueriesContext(connection) as captured:
+                    response = self.client.get(url, {"access_token": token})
+                self.assertEqual(len(response.json()[key]["order_details"]), order.order_details.count())
+                counts.append(len(captured))
+            return counts
+
+        order = self.create_order(Order.ONTHEWAY, driver=self.driver)
+        first = queries()
+        # A bigger cart
+        for meal in self.meals:
+            OrderDetails.objects.create(order=order, meal=meal, quantity=2, sub_total=meal.price * 2)
+        self.assertEqual(first, queries())
+
+
+class ClaimOrderStressTest(FoodTaskerData, TransactionTestCase):
+    """
+    Many drivers claim the same READY orders at the same moment,
+    every order must go to exactly one of them.
+    """
+    DRIVERS = 16
+    ORDERS = 10
+
+    def setUp(self):
+        self.create_test_data()
+        self.drivers = [self.create_driver("driver-%s" % i) for i in range(self.DRIVERS)]
+
+    def claim_concurrently(self, order_id):
+        barrier = threading.Barrier(self.DRIVERS)
+        results = []
+
+        def claim(driver):
+            try:
+                barrier.wait()
+                # SQLite answers "locked" instead of waiting for a concurrent write
+                for attempt in range(100):
+                    try:
+                        claim_order(order_id, driver.id)
+                        results.append(driver.id)
+                        return
+                    except OperationalError:
+                        continue
+                raise AssertionError("The database stayed locked")
+            except OrderError:
+                pass
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=claim, args=(driver,)) for driver in self.drivers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_exactly_once(self):
+        for i in range(self.ORDERS):
+            order = self.create_order(Order.READY)
+            winners = self.claim_concurrently(order.id)
+
+            self.assertEqual(len(winners), 1)
+            order.refresh_from_db()
+            self.assertEqual(order.driver_id, winners[0])
+            self.assertEqual(order.status, Order.ONTHEWAY)
+            self.assertIsNotNone(order.picked_at)
+
+            # Free the winner so the next round is a fair race
+            Order.objects.filter(id=order.id).update(status=Order.DELIVERED)
+
+    def test_one_order_on_the_way_per_driver(self):
+        self.create_order(Order.ONTHEWAY, driver=self.driver)
+        order = self.create_order(Order.READY)
+
+        with self.assertRaisesMessage(OrderError, "Your outstanding order is not delivered yet."):
+            claim_order(order.id, self.driver.id)
+        order.refresh_from_db()
+        self.assertIsNone(order.driver_id)
+
+
+class MarkOrdersReadyTest(FoodTaskerTestCase):
+    def test_only_cooking_orders_of_the_restaurant(self):
+        cooking = [self.create_order(Order.COOKING) for i in range(2)]
+        ready = self.create_order(Order.READY)
+        other_user = User.objects.create_user("other")
+        other_restaurant = Restaurant.objects.create(user=other_user, name="Other", phone="2", address="Address", logo="logo")
+        other_order = Order.objects.create(
+            customer=self.customer, restaurant=other_restaurant, address="Address", total=1, status=Order.COOKING
+        )
+
+        self.client.force_login(self.restaurant.user)
+        response = self.client.post("/restaurant/order/", {
+            "ids": [cooking[0].id, cooking[1].id, ready.id, other_order.id, "x"]
+        }, follow=True)
+
+        self.assertEqual(
+            set(Order.objects.filter(status=Order.READY).values_list("id", flat=True)),
+            {cooking[0].id, cooking[1].id, ready.id}
+        )
+        other_order.refresh_from_db()
+        self.assertEqual(other_order.status, Order.COOKING)
+
+        messages = [str(message) for message in response.context["messages"]]
+        self.assertIn("Ready: order %s, %s." % (cooking[0].id, cooking[1].id), messages)
+        self.assertIn("Order %s is already Ready." % ready.id, messages)
+        self.assertIn("Order %s was not found." % other_order.id, messages)
+        self.assertIn("Order x is invalid.", messages)
+
+    def test_constant_queries(self):
+        def queries(count):
+            ids = [self.create_order(Order.COOKING).id for i in range(count)]
+            with CaptureQueriesContext(connection) as captured:
+                ready_ids, skipped = mark_orders_ready(self.restaurant.id, ids)
+            self.assertEqual(ready_ids, set(ids))
+            return len(captured)
+
+        self.assertEqual(queries(2), queries(20))
+
+    def test_messages_sort_ids_as_numbers(self):
+        for order_id in (9, 10):
+            Order.objects.create(
+                id=order_id, customer=self.customer, restaurant=self.restaurant, address="Address", total=1, status=Order.READY
+            )
+        self.client.force_login(self.restaurant.user)
+        response = self.client.post("/restaurant/order/", {"ids": [10, 9]}, follow=True)
+        self.assertIn("Order 9, 10 is already Ready.", [str(message) for message in response.context["messages"]])
+
+
+class OrderBoardTest(FoodTaskerTestCase):
+    def test_constant_queries(self):
+        self.client.force_login(self.restaurant.user)
+
+        def queries(count):
+            for i in range(count):
+                self.create_order(Order.ONTHEWAY, driver=self.driver)
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get("/restaurant/order/", {"status": "all"})
+            self.assertEqual(len(response.context["orders"]), Order.objects.count())
+            return len(captured)
+
+        self.assertEqual(queries(2), queries(20))
+
+    def test_active_orders_by_default(self):
+        cooking = self.create_order(Order.COOKING)
+        self.create_order(Order.DELIVERED, driver=self.driver)
+        self.client.force_login(self.restaurant.user)
+
+        response = self.client.get("/restaurant/order/")
+        self.assertEqual([order.id for order in response.context["orders"]], [cooking.id])
+
+    def test_dates_in_restaurant_timezone(self):
+        # 22:30 on Jan 1st and 01:30 on Jan 2nd in Kolkata, both on Jan 1st in UTC
+        Restaurant.objects.filter(id=self.restaurant.id).update(timezone="Asia/Kolkata")
+        evening, night = self.create_order(Order.DELIVERED), self.create_order(Order.DELIVERED)
+        Order.objects.filter(id=evening.id).update(created_at=datetime(2024, 1, 1, 17, tzinfo=dt_timezone.utc))
+        Order.objects.filter(id=night.id).update(created_at=datetime(2024, 1, 1, 20, tzinfo=dt_timezone.utc))
+        self.client.force_login(self.restaurant.user)
+
+        def board(**params):
+            response = self.client.get("/restaurant/order/", {"status": "all", **params})
+            return {order.id for order in response.context["orders"]}
+
+        # Either date can be left open
+        self.assertEqual(board(start="2024-01-02"), {night.id})
+        self.assertEqual(board(end="2024-01-02"), {evening.id})
+        self.assertEqual(board(start="2024-01-01", end="2024-01-02"), {evening.id})
+
+        response = self.client.get("/restaurant/order/", {"start": "2024-01-02", "end": "2024-01-01"})
+        self.assertEqual(response.status_code, 302)
+
+
+class NearbyOrdersTest(FoodTaskerTestCase):
+    def setUp(self):
+        # The index lives in the process, start from the database of this test
+        ready_orders.clear()
+        # San Francisco, and New York for the restaurant of another city
+        Restaurant.objects.filter(id=self.restaurant.id).update(latitude=37.78, longitude=-122.41)
+        other_user = User.objects.create_user("new-york")
+        self.other_restaurant = Restaurant.objects.create(
+            user=other_user, name="New York", phone="2", address="Address", logo="logo", latitude=40.71, longitude=-74.0
+        )
+
+    def nearby(self, **params):
+        response = self.client.get("/api/driver/order/nearby/", {"access_token": "driver-token", **params})
+        return response.json()
+
+    def test_only_orders_around_the_driver(self):
+        response = self.client.post("/api/driver/location/update/", {"access_token": "driver-token", "location": ""})
+        self.assertEqual(response.json()["status"], "failed")
+        self.assertEqual(self.nearby()["error"], "Update your location first.")
+
+        near = self.create_order(Order.READY)
+        Order.objects.create(
+            customer=self.customer, restaurant=self.other_restaurant, address="Address", total=1, status=Order.READY
+        )
+        self.client.post("/api/driver/location/update/", {"access_token": "driver-token", "location": "37.77, -122.42"})
+
+        orders = self.nearby()["orders"]
+        self.assertEqual([order["id"] for order in orders], [near.id])
+        self.assertLess(orders[0]["distance"], 2)
+        self.assertEqual(self.nearby(radius="0.5")["orders"], [])
+
+    def test_index_follows_the_orders(self):
+        self.client.post("/api/driver/location/update/", {"access_token": "driver-token", "location": "37.77, -122.42"})
+        self.assertEqual(self.nearby()["orders"], [])
+
+        # Made ready and picked up by this process
+        order = self.create_order(Order.COOKING)
+        with self.captureOnCommitCallbacks(execute=True):
+            mark_orders_ready(self.restaurant.id, [order.id])
+        self.assertEqual([order["id"] for order in self.nearby()["orders"]], [order.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            claim_order(order.id, self.create_driver("other-driver").id)
+        self.assertEqual(self.nearby()["orders"], [])
+        self.assertEqual(len(ready_orders.get()), 0)
+
+    def test_restaurant_gets_coordinates(self):
+        self.client.post("/api/driver/location/update/", {"access_token": "driver-token", "location": "37.77, -122.42"})
+        Restaurant.objects.filter(id=self.restaurant.id).update(latitude=None, longitude=None)
+        order = self.create_order(Order.READY)
+        self.assertEqual(self.nearby()["orders"], [])
+
+        # Its ready orders join the index, without waiting for the next load
+        restaurant = Restaurant.objects.get(id=self.restaurant.id)
+        restaurant.latitude, restaurant.longitude = 37.78, -122.41
+        restaurant.save()
+        self.assertEqual([order["id"] for order in self.nearby()["orders"]], [order.id])
+
+        # and leave it with the coordinates
+        restaurant.latitude = restaurant.longitude = None
+        restaurant.save()
+        self.assertEqual(self.nearby()["orders"], [])
+
+    def test_location_of_older_apps(self):
+        self.client.post("/api/driver/location/update/", {"access_token": "driver-token", "location": "37.77, -122.42"})
+        self.create_order(Order.READY)
+        self.assertEqual(len(self.nearby()["orders"]), 1)
+
+        # Not "lat, long", kept for the customers, but the driver has no coordinates anymore
+        response = self.client.post("/api/driver/location/update/", {"access_token": "driver-token", "location": "Near the park"})
+        self.assertEqual(response.json(), {"status": "success"})
+        self.assertEqual(
+            Driver.objects.filter(id=self.driver.id).values_list("location", "latitude", "longitude").get(),
+            ("Near the park", None, None)
+        )
+        self.assertEqual(self.nearby()["error"], "Update your location first.")
+
+
+class DispatchTest(FoodTaskerTestCase):
+    def test_nearest_idle_drivers(self):
+        Restaurant.objects.filter(id=self.restaurant.id).update(latitude=37.78, longitude=-122.41)
+        orders = [self.create_order(Order.READY) for i in range(2)]
+        # 100 m and 9 km away, a busy driver next door and one too far
+        near, far, busy, too_far = [self.create_driver(name) for name in ("near", "far", "busy", "too-far")]
+        for driver, latitude in ((near, 37.781), (far, 37.70), (busy, 37.78), (too_far, 37.0)):
+            Driver.objects.filter(id=driver.id).update(latitude=latitude, longitude=-122.41)
+        self.create_order(Order.ONTHEWAY, driver=busy)
+
+        # Orders, drivers and one UPDATE, in a savepoint inside the test's transaction
+        with self.assertNumQueries(5):
+            result = dispatch_orders()
+
+        self.assertEqual((result["orders"], result["drivers"]), (2, 3))
+        self.assertEqual(sorted(result["assigned"]), [(orders[0].id, near.id), (orders[1].id, far.id)])
+        self.assertEqual(
+            set(Order.objects.filter(id__in=[orders[0].id, orders[1].id]).values_list("status", "driver_id")),
+            {(Order.ONTHEWAY, near.id), (Order.ONTHEWAY, far.id)}
+        )
+
+    def test_greedy_solver(self):
+        # Without SciPy, an order with no driver in reach leaves the driver to the next one
+        for solver in (linear_sum_assignment, None):
+            with mock.patch("coreapp.dispatch.linear_sum_assignment", solver):
+                pairs = assign([(10, 10), (37.77, -122.42)], [(37.771, -122.421)], 10)
+            self.assertEqual([(order, driver) for order, driver, distance in pairs], [(1, 0)])
+
+        with mock.patch("coreapp.dispatch.linear_sum_assignment", None):
+            pairs = assign([(37.77, -122.42), (37.78, -122.42)], [(37.78, -122.42), (37.0, -122.42)], 10)
+        # The oldest order takes the nearest driver, the other one is too far for the second order
+        self.assertEqual([(order, driver) for order, driver, distance in pairs], [(0, 0)])
+
+    @override_settings(DISPATCH_MODE=True)
+    def test_drivers_can_not_pick(self):
+        order = self.create_order(Order.READY)
+        with self.assertRaisesMessage(OrderError, "Orders are assigned by the dispatcher."):
+            claim_order(order.id, self.driver.id)
+
+
+# Nothing is written by the thread within the test, flush() is called instead
+@override_settings(LOCATION_FLUSH_INTERVAL=3600)
+class LocationBufferTest(FoodTaskerTestCase):
+    def tearDown(self):
+        location_buffer.clear()
+
+    def test_latest_location_written_once(self):
+        self.create_order(Order.ONTHEWAY, driver=self.driver)
+        self.client.post("/api/driver/location/update/", {"access_token": "driver-token", "location": "37.70, -122.40"})
+        # With the access token cached, a ping does not reach the database
+        with self.assertNumQueries(0):
+            self.client.post("/api/driver/location/update/", {"access_token": "driver-token", "location": "37.71, -122.41"})
+
+        # Read from memory before it is written
+        self.assertEqual(Driver.objects.get(id=self.driver.id).location, "")
+        response = self.client.get("/api/customer/driver/location/", {"access_token": "customer-token"})
+        self.assertEqual(response.json()["location"], "37.71, -122.41")
+
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(location_buffer.flush(), 1)
+        updates = [query["sql"] for query in captured if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn("avatar", updates[0])
+
+        driver = Driver.objects.get(id=self.driver.id)
+        self.assertEqual((driver.location, driver.latitude, driver.longitude), ("37.71, -122.41", 37.71, -122.41))
+        self.assertIsNotNone(driver.location_at)
+        self.assertEqual(location_buffer.flush(), 0)
+
+    def test_newer_location_of_another_worker(self):
+        self.create_order(Order.ONTHEWAY, driver=self.driver)
+        self.client.post("/api/driver/location/update/", {"access_token": "driver-token", "location": "37.70, -122.40"})
+
+        # Another worker has written a position received after the pending one
+        Driver.objects.filter(id=self.driver.id).update(
+            location="37.72, -122.42", latitude=37.72, longitude=-122.42, location_at=timezone.now()
+        )
+        location_buffer.flush()
+        self.assertEqual(
+            Driver.objects.filter(id=self.driver.id).values_list("location", "latitude", "longitude").get(),
+            ("37.72, -122.42", 37.72, -122.42)
+        )
+
+        # Once written the buffer does not answer anymore, the database does
+        self.assertIsNone(location_buffer.get(self.driver.id))
+        response = self.client.get("/api/customer/driver/location/", {"access_token": "customer-token"})
+        self.assertEqual(response.json()["location"], "37.72, -122.42")
+
+    def test_late_batch_upload(self):
+        self.create_order(Order.ONTHEWAY, driver=self.driver)
+        self.client.post("/api/driver/location/update/", {"access_token": "driver-token", "location": "37.72, -122.42"})
+
+        def upload(seconds_ago, location):
+            points = [[time.time() - seconds_ago, *map(float, location.split(","))]]
+            self.client.post("/api/driver/location/batch/", {"access_token": "driver-token", "points": json.dumps(points)})
+            response = self.client.get("/api/customer/driver/location/", {"access_token": "customer-token"})
+            return response.json()["location"]
+
+        # Points from before the live location, it waits in the buffer or is written already
+        self.assertEqual(upload(600, "37.70, -122.40"), "37.72, -122.42")
+        location_buffer.flush()
+        self.assertEqual(upload(300, "37.71, -122.41"), "37.72, -122.42")
+
+        # A newer point is written straight away
+        self.assertEqual(upload(0, "37.73, -122.43"), "37.73, -122.43")
+        self.assertEqual(Driver.objects.get(id=self.driver.id).location, "37.73, -122.43")
+
+
+@override_settings(TRAJECTORY_SEGMENT_POINTS=100)
+class TrajectoryTest(FoodTaskerTestCase):
+    def upload(self, points):
+        response = self.client.post("/api/driver/location/batch/", {"access_token": "driver-token", "points": json.dumps(points)})
+        return response.json()
+
+    def test_segments_and_downsampling(self):
+        order = self.create_order(Order.ONTHEWAY, driver=self.driver)
+        # Points every 5 seconds, uploaded 60 at a time, and one upload sent twice
+        started = int(time.time()) - 3600
+        points = [[started + 5 * i, 37.77 + i * 1e-5, -122.42 + i * 1e-5] for i in range(250)]
+        for start in range(0, 250, 60):
+            self.assertEqual(self.upload(points[start:start + 60])["stored"], len(points[start:start + 60]))
+        self.assertEqual(self.upload(points[180:240])["stored"], 0)
+
+        segments = TrajectorySegment.objects.filter(order=order)
+        self.assertEqual(sorted(segment.points for segment in segments), [50, 100, 100])
+        # 12 bytes per point
+        self.assertEqual(sum(len(segment.coordinates) + len(segment.deltas) for segment in segments), 250 * 12)
+        self.assertEqual(Driver.objects.get(id=self.driver.id).location, "%s, %s" % tuple(points[-1][1:]))
+
+        response = self.client.get("/api/order/trajectory/%s/" % order.id, {"access_token": "customer-token", "max_points": 50})
+        data = response.json()
+        self.assertEqual(data["total"], 250)
+        self.assertEqual(len(data["points"]), 50)
+        for received, sent in ((data["points"][0], points[0]), (data["points"][-1], points[-1])):
+            for a, b in zip(received, sent):
+                self.assertAlmostEqual(a, b, places=4)
+
+    def test_only_the_customer_and_the_driver(self):
+        order = self.create_order(Order.ONTHEWAY, driver=self.driver)
+        self.assertEqual(self.upload([[time.time(), 95, 0]])["error"], "A point is out of range.")
+
+        other = self.create_driver("other")
+        AccessToken.objects.create(user=other.user, token="other-token", expires=timezone.now() + timedelta(hours=1))
+        response = self.client.get("/api/order/trajectory/%s/" % order.id, {"access_token": "other-token"})
+        self.assertEqual(response.status_code, 404)
+
+
+    def test_late_upload_does_not_move_the_driver_back(self):
+        self.create_order(Order.ONTHEWAY, driver=self.driver)
+        self.client.post("/api/driver/location/update/", {"access_token": "driver-token", "location": "37.72, -122.42"})
+
+        # Points recorded offline 10 minutes ago are kept in the route, the driver stays where they are
+        with mock.patch.object(pubsub_hub, "publish") as publish:
+            self.assertEqual(self.upload([[time.time() - 600, 37.70, -122.40]])["stored"], 1)
+        publish.assert_not_called()
+        self.assertEqual(Driver.objects.get(id=self.driver.id).location, "37.72, -122.42")
+
+        with mock.patch.object(pubsub_hub, "publish") as publish:
+            self.upload([[time.time(), 37.73, -122.43]])
+        publish.assert_called_once_with(driver_channel(self.driver.id), {"event": "location", "location": "37.73, -122.43"})
+        self.assertEqual(Driver.objects.get(id=self.driver.id).location, "37.73, -122.43")
+
+    def test_timestamps_near_now(self):
+        self.create_order(Order.ONTHEWAY, driver=self.driver)
+        now = time.time()
+        for timestamp in (1e12, now + settings.TRAJECTORY_MAX_CLOCK_SKEW + 60, now - settings.TRAJECTORY_MAX_AGE - 60, 0, -1):
+            self.assertEqual(
+                self.upload([[now, 37.77, -122.42], [timestamp, 37.77, -122.42]])["error"],
+                "A point has a timestamp too far from now.", timestamp
+            )
+        self.assertEqual(TrajectorySegment.objects.count(), 0)
+        self.assertEqual(self.upload([[now - 60, 37.77, -122.42], [now + 10, 37.77, -122.42]])["stored"], 2)
+
+
+class OrderExportTest(FoodTaskerTestCase):
+    def export(self, **params):
+        self.client.force_login(self.restaurant.user)
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get("/restaurant/order/export/", params)
+            content = b"".join(response.streaming_content).decode()
+        return content, len(captured)
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_csv_and_ndjson(self):
+        orders = [self.create_order(Order.DELIVERED, driver=self.driver) for i in range(5)]
+        Order.objects.filter(id=orders[0].id).update(created_at=timezone.now() - timedelta(days=400))
+
+        content, queries = self.export()
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0][:3], ["order_id", "created_at", "status"])
+        # One row per meal, oldest order first
+        self.assertEqual(len(rows), 1 + 5 * 3)
+        self.assertEqual([row[0] for row in rows[1::3]], [str(order.id) for order in orders])
+        # The session, the user and the restaurant, the orders through one cursor, the details of each chunk of 2
+        self.assertEqual(queries, 3 + 1 + 3)
+
+        start = (timezone.localdate() - timedelta(days=30)).isoformat()
+        content, queries = self.export(format="ndjson", start=start)
+        lines = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([line["id"] for line in lines], [order.id for order in orders[1:]])
+        self.assertEqual([detail["meal"] for detail in lines[0]["order_details"]], [meal.name for meal in self.meals])
+
+    def test_csv_formulas_are_text(self):
+        order = self.create_order(Order.DELIVERED, driver=self.driver)
+        Order.objects.filter(id=order.id).update(address='=HYPERLINK("http://example.com")')
+        User.objects.filter(id=self.customer.user.id).update(first_name="@SUM(A1)", last_name="")
+        Meal.objects.filter(id=self.meals[0].id).update(name="+1")
+
+        content, queries = self.export()
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[1][3:6], ["'@SUM(A1)", "driver", "'=HYPERLINK(\"http://example.com\")"])
+        self.assertEqual(rows[1][7], "'+1")
+        self.assertEqual(rows[2][7], self.meals[1].name)
+
+        # NDJSON is not opened by spreadsheets, it keeps the values as they are
+        content, queries = self.export(format="ndjson")
+        self.assertEqual(json.loads(content)["customer"], "@SUM(A1)")
+
+    def test_dates_in_restaurant_timezone(self):
+        # 23:50 on Jan 1st in Kolkata, still 18:20 in UTC, and 00:10 on Jan 2nd
+        Restaurant.objects.filter(id=self.restaurant.id).update(timezone="Asia/Kolkata")
+        before, after = self.create_order(Order.DELIVERED), self.create_order(Order.DELIVERED)
+        Order.objects.filter(id=before.id).update(created_at=datetime(2024, 1, 1, 18, 20, tzinfo=dt_timezone.utc))
+        Order.objects.filter(id=after.id).update(created_at=datetime(2024, 1, 1, 18, 40, tzinfo=dt_timezone.utc))
+
+        def exported(**params):
+            content, queries = self.export(format="ndjson", **params)
+            return [json.loads(line)["id"] for line in content.splitlines()]
+
+        self.assertEqual(exported(start="2024-01-02"), [after.id])
+        self.assertEqual(exported(end="2024-01-02"), [before.id])
+        # The timestamps are written in the restaurant's timezone too
+        content, queries = self.export(format="ndjson", start="2024-01-02")
+        self.assertTrue(json.loads(content)["created_at"].startswith("2024-01-02T00:10:00+05:30"))
+
+
+class BenchmarkTest(TestCase):
+    """
+    The seeded data has orders in every status and the benchmark
+    has a request for every route of coreapp/urls.py.
+    """
+    def test_every_route(self):
+        seed_data(restaurants=2, meals=3, customers=12, drivers=4, orders=40)
+        self.assertEqual(
+            set(Order.objects.values_list("status", flat=True)),
+            {status for status, name in Order.STATUS_CHOICES}
+        )
+
+        results = run_benchmark(iterations=1, warmup=0)
+        self.assertEqual(results["skipped"], [])
+        self.assertEqual(set(results["routes"]), set(coreapp_routes()))
+        for route, result in results["routes"].items():
+            self.assertNotEqual(result["status"], 500, route)
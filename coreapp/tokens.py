@@ -0,0 +1,121 @@
+from collections import namedtuple
+from functools import wraps
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils import timezone
+from oauth2_provider.models import AccessToken
+from coreapp.cache import LRUCache
+
+
+# Who an access token belongs to.
+# Only ids are cached, never model instances, so cached entries can be
+# shared between threads safely.
+TokenIdentity = namedtuple("TokenIdentity", ("user_id", "customer_id", "driver_id", "expires"))
+
+# Tokens are cached until they expire, or for TOKEN_CACHE_TTL seconds,
+# whichever is first. A token revoked or expired in this process is dropped
+# at once (see coreapp.signals), the other processes keep trusting it for
+# TOKEN_CACHE_TTL seconds at most, so keep it short.
+token_cache = LRUCache(maxsize=settings.TOKEN_CACHE_SIZE, ttl=settings.TOKEN_CACHE_TTL, name="token")
+
+
+def _token_query(token):
+    # Follow user, customer and driver in the same query.
+    return AccessToken.objects.select_related("user__customer", "user__driver").filter(
+        token=token,
+        expires__gt=timezone.now()
+    )
+
+
+def _cache_identity(token, access_token):
+    if access_token is None or access_token.user is None:
+        return None
+
+    user = access_token.user
+    identity = TokenIdentity(
+        user_id=user.id,
+        customer_id=user.customer.id if hasattr(user, "customer") else None,
+        driver_id=user.driver.id if hasattr(user, "driver") else None,
+        expires=access_token.expires,
+    )
+    token_cache.set(token, identity, expires_at=access_token.expires.timestamp())
+    return identity
+
+
+def resolve_token(token):
+    """
+    Returns the TokenIdentity of a valid access token or None.
+    A cached token costs no query, otherwise it costs exactly one.
+    """
+    if not token:
+        return None
+
+    identity = token_cache.get(token)
+    if identity is not None:
+        return identity
+
+    return _cache_identity(token, _token_query(token).first())
+
+
+async def aresolve_token(token):
+    """
+    resolve_token() for async views, a cached token does not leave the event loop.
+    """
+    if not token:
+        return None
+
+    identity = token_cache.get(token)
+    if identity is not None:
+        return identity
+
+    return _cache_identity(token, await _token_query(token).afirst())
+
+
+def invalidate_token(token):
+    token_cache.delete(token)
+
+
+def _check_identity(request, identity, role):
+    if identity is None or (role and getattr(identity, role + "_id") is None):
+        return JsonResponse({"status": "failed", "error": "Invalid access token."}, status=401)
+
+    request.identity = identity
+    request.customer_id = identity.customer_id
+    request.driver_id = identity.driver_id
+    return None
+
+
+def token_required(role=None):
+    """
+    Decorator for the APIs which take an `access_token` param.
+
+    It resolves the token, checks that the user has the given role
+    ("customer" or "driver") and sets request.identity, request.customer_id
+    and request.driver_id before calling the view.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            token = request.POST.get("access_token") or request.GET.get("access_token")
+            error = _check_identity(request, resolve_token(token), role)
+            if error:
+                return error
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def atoken_required(role=None):
+    """
+    token_required() for async views.
+    """
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            token = request.POST.get("access_token") or request.GET.get("access_token")
+            error = _check_identity(request, await aresolve_token(token), role)
+            if error:
+                return error
+            return await view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,206 @@
+import json
+import sys
+from array import array
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from coreapp.models import Order, TrajectorySegment
+
+
+# DELIVERY TRAJECTORIES
+
+# The driver app collects its GPS points and uploads them in batches to
+# driver/location/batch/, they are added to the trajectory of the order on
+# the way. A point is 12 bytes in a TrajectorySegment (see coreapp.models)
+# and a segment holds TRAJECTORY_SEGMENT_POINTS of them, instead of a row,
+# its index entries and a request per point.
+#
+# A point is (milliseconds since the epoch, latitude, longitude). The
+# coordinates are float32, precise to about a meter.
+
+# Arrays are stored little-endian whatever the machine
+BIG_ENDIAN = sys.byteorder == "big"
+# An unsigned 32 bit integer, "I" on every common platform
+DELTA_TYPE = "I" if array("I").itemsize == 4 else "L"
+# A longer gap between two points starts a new segment (about 49 days)
+MAX_DELTA = 2 ** 32 - 1
+
+
+class TrajectoryError(Exception):
+    pass
+
+
+def _pack(values, typecode):
+    values = array(typecode, values)
+    if BIG_ENDIAN:
+        values.byteswap()
+    return values.tobytes()
+
+
+def _unpack(data, typecode):
+    values = array(typecode)
+    values.frombytes(bytes(data))
+    if BIG_ENDIAN:
+        values.byteswap()
+    return values
+
+
+def _milliseconds(moment):
+    return round(moment.timestamp() * 1000)
+
+
+def _datetime(milliseconds):
+    return datetime.fromtimestamp(milliseconds / 1000, tz=dt_timezone.utc)
+
+
+def point_time(point):
+    # When the driver was at a point of parse_points(), an aware datetime
+    return _datetime(point[0])
+
+
+def parse_points(data):
+    """
+      params:
+        1. data ---> JSON [[timestamp, lat, long], ...], timestamp in seconds since the epoch, eg.
+                     [[1700000000.5, 37.77, -122.42], [1700000005, 37.771, -122.421]]
+      returns:
+        [(milliseconds, latitude, longitude)] oldest first, one point per millisecond
+
+    A point must be from the last TRAJECTORY_MAX_AGE seconds, and at most
+    TRAJECTORY_MAX_CLOCK_SKEW seconds ahead of the server clock.
+    """
+    try:
+        points = [(round(float(t) * 1000), float(lat), float(lng)) for t, lat, lng in json.loads(data)]
+    except (TypeError, ValueError, OverflowError):
+        raise TrajectoryError("points must look like [[timestamp, lat, long], ...].")
+
+    if not points:
+        raise TrajectoryError("No points.")
+    if len(points) > settings.TRAJECTORY_MAX_UPLOAD:
+        raise TrajectoryError("At most %s points per upload." % settings.TRAJECTORY_MAX_UPLOAD)
+    now = _milliseconds(timezone.now())
+    oldest = now - settings.TRAJECTORY_MAX_AGE * 1000
+    newest = now + settings.TRAJECTORY_MAX_CLOCK_SKEW * 1000
+    for milliseconds, latitude, longitude in points:
+        # NaN fails these comparisons too
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise TrajectoryError("A point is out of range.")
+        if not oldest <= milliseconds <= newest:
+            raise TrajectoryError("A point has a timestamp too far from now.")
+
+    # The latest point of each millisecond wins
+    return sorted(dict((point[0], point) for point in points).values())
+
+
+def _new_segment(order_id, driver_id, points):
+    times = [milliseconds for milliseconds, latitude, longitude in points]
+    return TrajectorySegment(
+        order_id=order_id,
+        driver_id=driver_id,
+        started_at=_datetime(times[0]),
+        ended_at=_datetime(times[-1]),
+        points=len(points),
+        coordinates=_pack([value for point in points for value in point[1:]], "f"),
+        deltas=_pack([0] + [b - a for a, b in zip(times, times[1:])], DELTA_TYPE),
+    )
+
+
+def store_points(order_id, driver_id, points):
+    """
+    Adds points of parse_points() to the trajectory of an order.
+    Points not newer than the trajectory are skipped, so an upload sent again stores nothing.
+      returns:
+        the number of points stored
+
+    The last segment is filled up first, then new segments are written with one INSERT.
+    """
+    size = settings.TRAJECTORY_SEGMENT_POINTS
+    with transaction.atomic():
+        # One upload of the order at a time
+        Order.objects.select_for_update().filter(id=order_id).values_list("id").first()
+        last = TrajectorySegment.objects.filter(order_id=order_id).order_by("-started_at").first()
+
+        if last is not None:
+            previous = _milliseconds(last.ended_at)
+            points = [point for point in points if point[0] > previous]
+        stored = len(points)
+
+        # Fill the last segment
+        if last is not None and points:
+            room = 0
+            while room < min(size - last.points, len(points)) and points[room][0] - previous <= MAX_DELTA:
+                previous = points[room][0]
+                room += 1
+            if room:
+                added, points = points[:room], points[room:]
+                times = [_milliseconds(last.ended_at)] + [milliseconds for milliseconds, latitude, longitude in added]
+                last.coordinates = bytes(last.coordinates) + _pack([value for point in added for value in point[1:]], "f")
+                last.deltas = bytes(last.deltas) + _pack([b - a for a, b in zip(times, times[1:])], DELTA_TYPE)
+                last.points += room
+                last.ended_at = _datetime(times[-1])
+                last.save(update_fields=["coordinates", "deltas", "points", "ended_at"])
+
+        # The rest in new segments
+        chunks = []
+        for point in points:
+            if not chunks or len(chunks[-1]) >= size or point[0] - chunks[-1][-1][0] > MAX_DELTA:
+                chunks.append([])
+            chunks[-1].append(point)
+        TrajectorySegment.objects.bulk_create([_new_segment(order_id, driver_id, chunk) for chunk in chunks])
+
+    return stored
+
+
+def load_trajectory(order_id):
+    """
+      returns:
+        every point of the order's trajectory, [(milliseconds, latitude, longitude)] oldest first
+    """
+    points = []
+    for segment in TrajectorySegment.objects.filter(order_id=order_id).order_by("started_at"):
+        coordinates = _unpack(segment.coordinates, "f")
+        milliseconds = _milliseconds(segment.started_at)
+        for i, delta in enumerate(_unpack(segment.deltas, DELTA_TYPE)):
+            milliseconds += delta
+            points.append((milliseconds, coordinates[2 * i], coordinates[2 * i + 1]))
+    return points
+
+
+def downsample(points, max_points):
+    """
+    At most max_points (2 or more) of the points, evenly spread, the first and the last one included.
+    """
+    if len(points) <= max_points:
+        return points
+    step = (len(points) - 1) / (max_points - 1)
+    return [points[round(i * step)] for i in range(max_points)]
+
+
+def get_max_points(request):
+    """
+    The `max_points` param, TRAJECTORY_MAX_POINTS at most.
+    """
+    max_points = settings.TRAJECTORY_MAX_POINTS
+    try:
+        max_points = int(request.GET.get("max_points", max_points))
+    except ValueError:
+        pass
+    return max(2, min(max_points, settings.TRAJECTORY_MAX_POINTS))
+
+
+def visible_order(order_id, customer_id, driver_id):
+    """
+    The id of the order when it is one of the customer or of the driver, or None.
+    """
+    orders = Order.objects.none()
+    if customer_id is not None:
+        orders |= Order.objects.filter(id=order_id, customer_id=customer_id)
+    if driver_id is not None:
+        orders |= Order.objects.filter(id=order_id, driver_id=driver_id)
+    return orders.values_list("id", flat=True).first()
+
+
+def trajectory_json(points):
+    # Seconds since the epoch, and the float32 noise rounded away (5 decimals is about a meter)
+    return [[milliseconds / 1000, round(latitude, 5), round(longitude, 5)] for milliseconds, latitude, longitude in points]
@@ -1,8 +1,13 @@
 
-from . import views, apis
+from . import views, apis, async_apis, streams, metrics
+from django.conf import settings
 from django.urls import path, include
 from django.contrib.auth import views as auth_view
 
+# The JSON APIs are the async views of async_apis.py when ASYNC_APIS is True
+# (served by ASGI), the sync views of apis.py otherwise.
+api = async_apis if settings.ASYNC_APIS else apis
+
 
 urlpatterns = [
     # Web View - Restaurant
@@ -16,6 +21,7 @@ urlpatterns = [
     path('meal/add_meal/', views.restaurant_add_meal, name='restaurant_add_meal'),
     path('meal/edit_meal/<int:meal_id>', views.restaurant_edit_meal, name='restaurant_edit_meal'),
     path('order/', views.restaurant_order, name='restaurant_order'),
+    path('order/export/', views.restaurant_order_export, name='restaurant_order_export'),
     path('report/', views.restaurant_report, name='restaurant_report'),
 
     # APIs
@@ -24,27 +30,42 @@ urlpatterns = [
     path('social/', include('rest_framework_social_oauth2.urls')),
 
     # API for customer
-    path('customer/restaurants/', apis.customer_get_restaurants), 
-    path('customer/meals/<int:restaurant_id>', apis.customer_get_meals), 
-    path('customer/payment_intent/', apis.create_payment_intent),
-    path('customer/order/add/', apis.customer_add_order), 
-    path('customer/order/latest/', apis.customer_get_latest_order), 
-    path('customer/order/latest_status/', apis.customer_get_latest_order_status), 
-    path('customer/driver/location/', apis.customer_get_driver_location),
+    path('customer/restaurants/', api.customer_get_restaurants), 
+    path('customer/meals/<int:restaurant_id>', api.customer_get_meals), 
+    path('customer/payment_intent/', api.create_payment_intent),
+    path('customer/order/add/', api.customer_add_order), 
+    path('customer/order/latest/', api.customer_get_latest_order), 
+    path('customer/order/latest_status/', api.customer_get_latest_order_status), 
+    path('customer/driver/location/', api.customer_get_driver_location),
+    # Push version of customer/driver/location/ (needs ASGI)
+    path('customer/driver/location/stream/', streams.customer_stream_driver_location),
+    # Route of a delivery, for its customer and its driver
+    path('order/trajectory/<int:order_id>/', api.get_order_trajectory),
     
 
     # API for Restaurant
-    path('restaurant/order/notification/<last_request_time>/', apis.restaurant_order_notification),
+    path('restaurant/order/notification/<last_request_time>/', api.restaurant_order_notification),
+    # Push version of restaurant/order/notification/ (needs ASGI)
+    path('restaurant/order/stream/', streams.restaurant_stream_orders),
 
     # API for Driver
-    path('driver/order/ready/', apis.driver_get_ready_orders),
-    path('driver/order/pick/', apis.driver_pick_order),
-    path('driver/order/latest/', apis.driver_get_latest_order),
-    path('driver/order/complete/', apis.driver_complete_order),
-    path('driver/order/revenue/', apis.driver_get_revenue),
-    path('driver/location/update/', apis.driver_update_location),
-    path('driver/profile/', apis.driver_get_profile),
-    path('driver/profile/update/', apis.driver_update_profile),
+    path('driver/order/ready/', api.driver_get_ready_orders),
+    # Push version of driver/order/ready/ (needs ASGI)
+    path('driver/order/ready/stream/', streams.driver_stream_ready_orders),
+    # The ready orders nearest to the driver
+    path('driver/order/nearby/', api.driver_get_nearby_orders),
+    path('driver/order/pick/', api.driver_pick_order),
+    path('driver/order/latest/', api.driver_get_latest_order),
+    path('driver/order/complete/', api.driver_complete_order),
+    path('driver/order/revenue/', api.driver_get_revenue),
+    path('driver/location/update/', api.driver_update_location),
+    # Many timestamped points in one request
+    path('driver/location/batch/', api.driver_upload_locations),
+    path('driver/profile/', api.driver_get_profile),
+    path('driver/profile/update/', api.driver_update_profile),
+
+    # Prometheus metrics of the requests
+    path('metrics/', metrics.metrics_view),
 
 ]
 
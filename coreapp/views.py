@@ -1,12 +1,19 @@
 from django.shortcuts import render, redirect,HttpResponse
+from django.http import StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from .forms import UserForm, RestaurantForm, AccountForm, MealForm
 from django.contrib.auth.models import User
 from django.contrib.auth import login, authenticate
 from django.utils import timezone
-from django.db.models import Sum, Count, Case,When
 from django.contrib import messages
-from coreapp.models import Meal, Order, Driver
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Prefetch
+from coreapp.models import Meal, Order, OrderDetails, RestaurantDailyStats, RestaurantMealStats, RestaurantDriverStats
+from coreapp.exports import EXPORT_FORMATS, export_orders, export_content, filter_created, get_export_range
+from coreapp.orders import mark_orders_ready
+from coreapp.pagination import keyset_paginate, InvalidCursor
+from coreapp.reports import get_timezone, get_date_range, InvalidRange
 
 
 # Create your views here.
@@ -88,65 +95,155 @@ def restaurant_edit_meal(request,meal_id):
 
 
 
+# Status filters of the order board ---> the statuses shown
+ORDER_BOARD_FILTERS = {
+    "active": [Order.COOKING, Order.READY, Order.ONTHEWAY],
+    "all": [status for status, name in Order.STATUS_CHOICES],
+    **{str(status): [status] for status, name in Order.STATUS_CHOICES},
+}
+
 @login_required(login_url='sign_in/')
 def restaurant_order(request):
+    """
+      params (GET):
+        1. status (optional) ---> "active" (default, not delivered yet), "all" or one status number
+        2. start, end (optional) ---> YYYY-MM-DD, orders created in [start, end) in the restaurant's timezone,
+           either one can be left open
+        3. cursor (optional) ---> the next page
+    """
     if request.method == "POST":
-        order = Order.objects.get(id=request.POST["id"])
-        if order.status == Order.COOKING:
-            order.status = Order.READY
-            order.save()
+        # The checked orders, or the one of a row's Ready button.
+        # Only COOKING orders of this restaurant are moved, see mark_orders_ready().
+        ready_ids, skipped = mark_orders_ready(
+            request.user.restaurant.id,
+            request.POST.getlist("ids") or request.POST.getlist("id")
+        )
+        if ready_ids:
+            messages.success(request, "Ready: order %s." % ", ".join(str(order_id) for order_id in sorted(ready_ids)))
+        # One message per reason, eg. "Order 3, 5 is already Ready."
+        reasons = {}
+        for order_id, reason in skipped.items():
+            reasons.setdefault(reason, []).append(order_id)
+        for reason, order_ids in reasons.items():
+            # The ids are kept as numbers, so 9 comes before 10. Only the
+            # invalid ones are text, and they all have the same reason.
+            messages.warning(request, "Order %s %s." % (", ".join(str(order_id) for order_id in sorted(order_ids)), reason))
+
+        # Redirect to the same page and filters, so reloading does not post the orders again
+        return redirect(request.get_full_path())
+
+    status = request.GET.get("status", "active")
+    if status not in ORDER_BOARD_FILTERS:
+        status = "active"
+    orders = Order.objects.filter(restaurant=request.user.restaurant, status__in=ORDER_BOARD_FILTERS[status])
+
+    # The same dates as the export, a day starts at midnight where the restaurant is
+    try:
+        start, end = get_export_range(request.GET)
+        orders = filter_created(orders, start, end, get_timezone(request.user.restaurant.timezone))
+    except InvalidRange as e:
+        messages.error(request, str(e))
+        return redirect('restaurant_order')
+
+    # Everything the template shows is loaded with 2 queries for the whole page:
+    # the orders joined with customer, driver and their users, then the details with their meals.
+    orders = orders.select_related("customer__user", "driver__user").prefetch_related(
+        Prefetch("order_details", queryset=OrderDetails.objects.select_related("meal"))
+    )
+    try:
+        page, next_cursor = keyset_paginate(request, orders, settings.ORDER_BOARD_PAGE_SIZE)
+    except InvalidCursor as e:
+        messages.error(request, str(e))
+        return redirect('restaurant_order')
+
+    next_url = None
+    if next_cursor:
+        query = request.GET.copy()
+        query["cursor"] = next_cursor
+        next_url = "?" + query.urlencode()
+
+    return render(request,'restaurant/order.html',{
+        "orders": page,
+        "next_url": next_url,
+        "status": status,
+        "statuses": Order.STATUS_CHOICES,
+        "start": request.GET.get("start", ""),
+        "end": request.GET.get("end", ""),
+    })
 
-    order = Order.objects.filter(restaurant=request.user.restaurant)
-    return render(request,'restaurant/order.html',{"orders":order})
+
+@login_required(login_url='sign_in/')
+def restaurant_order_export(request):
+    """
+    Downloads the order history, see coreapp.exports.
+      params (GET):
+        1. format (optional) ---> "csv" (default, one row per meal) or "ndjson" (one line per order)
+        2. status (optional) ---> "all" (default), "active" or one status number
+        3. start, end (optional) ---> YYYY-MM-DD, orders created in [start, end) in the restaurant's timezone,
+           the whole history by default
+    """
+    export_format = request.GET.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        export_format = "csv"
+    status = request.GET.get("status", "all")
+    if status not in ORDER_BOARD_FILTERS:
+        status = "all"
+
+    # The days start at midnight where the restaurant is
+    restaurant = request.user.restaurant
+    try:
+        tz = get_timezone(restaurant.timezone)
+        start, end = get_export_range(request.GET)
+    except InvalidRange as e:
+        messages.error(request, str(e))
+        return redirect('restaurant_order')
+
+    # Nothing is read yet, the orders are read chunk by chunk while the response is sent
+    orders = export_orders(restaurant, ORDER_BOARD_FILTERS[status], start, end, tz)
+    file_format = EXPORT_FORMATS[export_format]
+    response = StreamingHttpResponse(export_content(orders, export_format), content_type=file_format.content_type)
+    response["Content-Disposition"] = 'attachment; filename="orders-%s-%s.%s"' % (
+        restaurant.id, timezone.localdate(timezone=tz).isoformat(), file_format.extension
+    )
+    return response
 
 
 @login_required(login_url='sign_in/')
 def restaurant_report(request):
-    from datetime import timedelta
-    # annotate() clause returns a QuerySet.
-    # Annotation of an object creates a separate summary for each object in a queryset.
-    # annote() allows to access field of related database using __  eg...orderdetails__quantity
+    # The report only reads the rollups of coreapp.rollups,
+    # its cost does not grow with the order history.
+    restaurant = request.user.restaurant
 
     # GETTING Top 3 meals
-    top3_meals = Meal.objects.filter(restaurant = request.user.restaurant)\
-        .annotate(total_order=Sum('orderdetails__quantity'))\
-        .order_by("-total_order")[:3]
+    top3_meals = RestaurantMealStats.objects.filter(restaurant = restaurant)\
+        .select_related("meal")\
+        .order_by("-quantity")[:3]
 
     meal = {
-        "labels": [meal.name for meal in top3_meals],
-        "data": [meal.total_order or 0 for meal in top3_meals]
+        "labels": [stats.meal.name for stats in top3_meals],
+        "data": [stats.quantity for stats in top3_meals]
     }
 
     # Getting top 3 drivers
-    top3_drivers = Driver.objects.annotate(
-        total_order=Count(
-            Case(
-                When(order__restaurant=request.user.restaurant, then=1)
-            )
-        )
-    )
+    top3_drivers = RestaurantDriverStats.objects.filter(restaurant = restaurant)\
+        .select_related("driver__user")\
+        .order_by("-deliveries")[:3]
 
     driver = {
-        "labels": [driver.user.get_full_name() for driver in top3_drivers],
-        "data":[driver.total_order or 0 for driver in top3_drivers]
+        "labels": [stats.driver.user.get_full_name() for stats in top3_drivers],
+        "data": [stats.deliveries for stats in top3_drivers]
     }
 
-    # Calculate the weekdays
-    revenue = []
-    orders = []
-    today = timezone.now()
-    current_weekdays = [today + timedelta(days= i) for i in range(0 - today.weekday(), 7 - today.weekday())]
-
-    for day in current_weekdays:
-        delivered_orders = Order.objects.filter(
-            restaurant = request.user.restaurant,
-            status = Order.DELIVERED,
-            created_at__year = day.year,
-            created_at__month = day.month,
-            created_at__day = day.day
-        )
+    # Revenue and orders of the current week, Monday to Sunday
+    # in the restaurant's timezone, like the days of the rollups
+    start, end = get_date_range({"period": "week"}, get_timezone(restaurant.timezone))
+    daily_stats = {
+        stats.date: stats
+        for stats in RestaurantDailyStats.objects.filter(restaurant = restaurant, date__gte = start, date__lt = end)
+    }
+    current_weekdays = [start + timedelta(days = i) for i in range(7)]
 
-        revenue.append(sum(order.total for order in delivered_orders))
-        orders.append(delivered_orders.count())
+    revenue = [daily_stats[day].revenue if day in daily_stats else 0 for day in current_weekdays]
+    orders = [daily_stats[day].orders if day in daily_stats else 0 for day in current_weekdays]
 
-    return render(request,'restaurant/report.html', {"revenue":revenue,"orders":orders,"meal":meal,"driver":driver})
\ No newline at end of file
+    return render(request,'restaurant/report.html', {"revenue":revenue,"orders":orders,"meal":meal,"driver":driver})
@@ -3,6 +3,10 @@ ASGI config for foodtasker project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The streaming APIs of coreapp.streams (Server-Sent Events) are served from
+here, eg. `uvicorn foodtasker.asgi:application`. The in-process pub/sub hub
+(coreapp.pubsub) only reaches the streams of the same worker process.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
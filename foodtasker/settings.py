@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -59,6 +60,9 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'coreapp.profiling.ProfilingMiddleware',
+    # Last, so what it times is the view
+    'coreapp.metrics.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'foodtasker.urls'
@@ -162,4 +166,137 @@ SOCIAL_AUTH_FACEBOOK_SCOPE = ['email']
 SOCIAL_AUTH_FACEBOOK_PROFILE_EXTRA_PARAMS = {
     'fields': 'id, name, email, picture.type(large)'
 }
-STRIPE_API_KEY = 'sk_test_51ONaT0IokxG2NNSNjZThAE9GIIIUACM79HRreApmV2WbFgSCIyY5KDpoSMdF42wOSYo1KMgEMZpKklvZqnfjF6qZ00tJdSdr6w'
\ No newline at end of file
+STRIPE_API_KEY = 'sk_test_51ONaT0IokxG2NNSNjZThAE9GIIIUACM79HRreApmV2WbFgSCIyY5KDpoSMdF42wOSYo1KMgEMZpKklvZqnfjF6qZ00tJdSdr6w'
+
+# Access tokens resolved by coreapp.tokens are cached in memory.
+# TOKEN_CACHE_SIZE ---> Maximum number of cached tokens.
+# TOKEN_CACHE_TTL ---> Seconds a token is trusted before it is checked against the database again,
+#   it is also how long another process may still accept a revoked token.
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 5
+
+# Keyset pagination of the list APIs (see coreapp.pagination)
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+# Orders per page of the restaurant order board
+ORDER_BOARD_PAGE_SIZE = 50
+
+# The menu snapshots of coreapp.menus live in the default cache.
+# Use a cache shared by all the workers (eg. Redis) in production, with the
+# local memory cache a worker only sees the meal changes it saved itself
+# until MENU_SNAPSHOT_TIMEOUT (seconds) runs out.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+MENU_SNAPSHOT_TIMEOUT = 300
+
+# Memoized Cloudinary urls (see coreapp.images)
+IMAGE_URL_CACHE_SIZE = 10000
+# Responsive sizes of the logos and meal images sent to the mobile apps.
+# Each one is a set of Cloudinary transformation options.
+CLOUDINARY_IMAGE_VARIANTS = {
+    'thumbnail': {'width': 200, 'height': 200, 'crop': 'fill', 'quality': 'auto', 'fetch_format': 'auto'},
+    'full': {'width': 1080, 'crop': 'limit', 'quality': 'auto', 'fetch_format': 'auto'},
+}
+
+# Server-Sent Events streams of coreapp.streams (in seconds)
+STREAM_HEARTBEAT = 15
+STREAM_MAX_DURATION = 15 * 60
+
+# Longest custom date range of the revenue reports, in days
+REPORT_MAX_DAYS = 366
+
+# Serve the JSON APIs with the async views of coreapp.async_apis.
+# Turn it on when the project runs under ASGI (foodtasker.asgi), keep it
+# off under WSGI, where the sync views of coreapp.apis are faster.
+ASYNC_APIS = False
+
+# Payment gateway of coreapp.payments: 'stripe', or 'fake' to check out
+# offline (development, load tests) with FAKE_PAYMENT_LATENCY seconds per call.
+PAYMENT_GATEWAY = 'stripe'
+# (connect, read) timeouts of a Stripe request, in seconds
+STRIPE_TIMEOUT = (3, 10)
+STRIPE_MAX_NETWORK_RETRIES = 2
+# Most connections open to Stripe at the same time, per process
+STRIPE_POOL_SIZE = 10
+FAKE_PAYMENT_LATENCY = 0.2
+
+# Request metrics of coreapp.metrics, exposed at /api/metrics/ for Prometheus.
+# METRICS_SAMPLE_RATE ---> Share of the requests measured, 0 to 1.
+# METRICS_SERVER_TIMING ---> Send the measurements in a Server-Timing header.
+# METRICS_TOKEN ---> Prometheus sends "Authorization: Bearer <token>" (bearer_token in
+#   its scrape config). None turns it off, then only staff users can read the metrics.
+# METRICS_ALLOWED_IPS ---> Addresses which may read the metrics without the token.
+#   This is REMOTE_ADDR, behind a reverse proxy on the same host every request
+#   comes from 127.0.0.1, so only list addresses which reach Django directly.
+METRICS_SAMPLE_RATE = 1.0
+METRICS_SERVER_TIMING = DEBUG
+METRICS_TOKEN = None
+METRICS_ALLOWED_IPS = []
+
+# On-demand profiling of one request (see coreapp.profiling), with an
+# X-Profile header from `manage.py profile_token <path>` or ?profile=1 as a staff user.
+# PROFILING_ENABLED ---> Off by default, a profiled request shows the code paths of the project.
+# PROFILE_TOKEN_MAX_AGE ---> Seconds a profile token stays valid, it profiles one request.
+# PROFILE_DIR ---> Where the profiles are written, the newest PROFILE_KEEP are kept.
+# PROFILE_TOP ---> Functions listed in the summary.
+PROFILING_ENABLED = False
+PROFILE_TOKEN_MAX_AGE = 300
+PROFILE_DIR = Path(tempfile.gettempdir()) / 'foodtasker-profiles'
+PROFILE_KEEP = 50
+PROFILE_TOP = 30
+
+# Nearby ready orders of coreapp.geo
+# NEARBY_RADIUS_KM ---> Default search radius around the driver, NEARBY_MAX_RADIUS_KM at most.
+# GEO_CELL_DEGREES ---> Cell size of the in-memory grid, 0.05 degrees is about 5.5 km.
+# READY_ORDERS_INDEX_TTL ---> Seconds before the grid is loaded again from the
+#   database, to see the orders moved by the other workers.
+NEARBY_RADIUS_KM = 10
+NEARBY_MAX_RADIUS_KM = 50
+GEO_CELL_DEGREES = 0.05
+READY_ORDERS_INDEX_TTL = 30
+
+# Batch dispatch of coreapp.dispatch, run by `manage.py dispatch_orders`.
+# With DISPATCH_MODE on the drivers can not pick orders themselves.
+# DISPATCH_INTERVAL ---> Seconds between two dispatches.
+# DISPATCH_MAX_KM ---> Longest distance between a driver and the restaurant.
+# DISPATCH_MAX_ORDERS ---> Oldest ready orders taken by one dispatch.
+# DISPATCH_BATCH_SIZE, DISPATCH_CANDIDATES ---> Bigger problems are solved
+#   DISPATCH_BATCH_SIZE orders at a time, each one against its
+#   DISPATCH_CANDIDATES nearest drivers.
+# DISPATCH_UPDATE_SIZE ---> Orders per UPDATE when the assignments are saved.
+DISPATCH_MODE = False
+DISPATCH_INTERVAL = 10
+DISPATCH_MAX_KM = 10
+DISPATCH_MAX_ORDERS = 5000
+DISPATCH_BATCH_SIZE = 500
+DISPATCH_CANDIDATES = 8
+DISPATCH_UPDATE_SIZE = 500
+
+# Write-behind driver locations of coreapp.locations
+# LOCATION_FLUSH_INTERVAL ---> Seconds between two writes of the buffered
+#   locations, 0 writes each one in its request.
+# LOCATION_FLUSH_SIZE ---> Drivers per UPDATE, a full buffer is written before the interval is over.
+LOCATION_FLUSH_INTERVAL = 2
+LOCATION_FLUSH_SIZE = 1000
+
+# Delivery trajectories of coreapp.trajectories
+# TRAJECTORY_SEGMENT_POINTS ---> Points per stored segment.
+# TRAJECTORY_MAX_UPLOAD ---> Points per request to driver/location/batch/.
+# TRAJECTORY_MAX_POINTS ---> Points returned by order/trajectory/, the route is downsampled to them.
+# TRAJECTORY_MAX_AGE ---> Seconds back a point can be, an app may upload the points it kept offline.
+# TRAJECTORY_MAX_CLOCK_SKEW ---> Seconds a point can be ahead of the server clock.
+TRAJECTORY_SEGMENT_POINTS = 1000
+TRAJECTORY_MAX_UPLOAD = 1000
+TRAJECTORY_MAX_POINTS = 500
+TRAJECTORY_MAX_AGE = 24 * 60 * 60
+TRAJECTORY_MAX_CLOCK_SKEW = 5 * 60
+
+# Order export of coreapp.exports
+# EXPORT_CHUNK_SIZE ---> Orders fetched at a time (and their details with one query), the memory
+#   used by an export does not depend on the number of orders.
+# EXPORT_BUFFER_SIZE ---> Characters sent at a time.
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_BUFFER_SIZE = 64 * 1024